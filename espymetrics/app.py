@@ -1,97 +1,496 @@
 # -*- coding: utf-8 -*-
 
-import json
 import argparse
 import datetime
+import threading
+from functools import partial
 
-
-from clastic import Application, Middleware, render_basic, MetaApplication
-from clastic.errors import BadRequest
+from clastic import (Application, Middleware, Response, render_basic,
+                     MetaApplication)
+from clastic.errors import (BadRequest, RequestedRangeNotSatisfiable,
+                            RequestEntityTooLarge, UnsupportedMediaType,
+                            Conflict)
 from clastic.middleware import GetParamMiddleware
 
-from dal import LineDAL
+from dal import LineDAL, SQLiteDAL, ColumnarDAL, jsoncodec
+from dal.common import MESSAGE_PROTO
+from dal.environments import ENV_ID_KEY, split_environment, expand_record
+from dal.batch_writer import BatchWriter, DURABILITY_MODES, DEFAULT_DURABILITY
+from dal.query_cache import QueryCache
+from content_encoding import (decode_body, UnsupportedEncoding,
+                              DecodedTooLarge, DEFAULT_MAX_DECODED_SIZE)
+from ingest_server import IngestServer
+from prefork import serve_prefork
 
 
 PORT = 8888
 META_PORT = 8889
 DEFAULT_DAL = 'line'
 DEFAULT_PREFIX = 'metrics_data'
+DEFAULT_TABLE_NAME = 'on_import_data'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# group-by paths polled by dashboards, counted as records are written
+DEFAULT_GROUP_BYS = ('username', 'python$version_info$0', 'linux_dist$name')
+# high-cardinality paths, approximately counted as records are written
+DEFAULT_APPROX_GROUP_BYS = ('uuid', 'hostfqdn')
+DEFAULT_QUERY_CACHE_SIZE = 128
 
 
 def main():
     prs = argparse.ArgumentParser()
     prs.add_argument('--debug', action='store_true')
+    prs.add_argument('--dal', choices=('line', 'sql', 'columnar'),
+                     default=DEFAULT_DAL)
+    prs.add_argument('--group-by', action='append', dest='group_bys',
+                     help='group-by path to materialize counts for.'
+                     ' May be repeated. Defaults to %r.'
+                     % (DEFAULT_GROUP_BYS,))
+    prs.add_argument('--approx-group-by', action='append',
+                     dest='approx_group_bys',
+                     help='group-by path to maintain approximate counts for'
+                     ' (line DAL only). May be repeated. Defaults to %r.'
+                     % (DEFAULT_APPROX_GROUP_BYS,))
+    prs.add_argument('--durability', choices=DURABILITY_MODES,
+                     default=DEFAULT_DURABILITY,
+                     help='acknowledge imports after their batch is flushed'
+                     ' (default), or as soon as they are enqueued')
+    prs.add_argument('--no-batch', action='store_true',
+                     help='write each import synchronously, without batching')
+    prs.add_argument('--json-backend',
+                     choices=jsoncodec.get_available_backends(),
+                     help='JSON library to use. Defaults to the fastest'
+                     ' installed, currently %r.' % jsoncodec.backend_name)
+    prs.add_argument('--segment-size', type=int,
+                     help='roll the line store over to a new compressed'
+                     ' segment at this many megabytes')
+    prs.add_argument('--segment-age', type=float,
+                     help='roll the line store over to a new compressed'
+                     ' segment after this many hours')
+    prs.add_argument('--scan-processes', type=int, default=1,
+                     help='count unlimited group-bys over the line store in'
+                     ' this many worker processes. Defaults to 1, scanning'
+                     ' in the serving process; see'
+                     ' tools/bench_parallel_scan.py before raising it.')
+    prs.add_argument('--query-cache-size', type=int,
+                     default=DEFAULT_QUERY_CACHE_SIZE,
+                     help='number of /count results to cache. 0 disables'
+                     ' the cache. Defaults to %r.'
+                     % DEFAULT_QUERY_CACHE_SIZE)
+    prs.add_argument('--ingest-port', type=int,
+                     help='also serve /v1/on_import and'
+                     ' /v1/on_import_batch on this port, from a'
+                     ' single-threaded event loop suited to many'
+                     ' keep-alive connections')
+    prs.add_argument('--workers', type=int, default=1,
+                     help='serve from this many forked processes, with'
+                     ' writes funneled to the parent process (line and'
+                     ' sql DALs only)')
     opts, _ = prs.parse_known_args()
     debug = opts.debug
+    group_bys = opts.group_bys or DEFAULT_GROUP_BYS
+    approx_group_bys = opts.approx_group_bys or DEFAULT_APPROX_GROUP_BYS
+    if opts.json_backend:
+        jsoncodec.set_backend(opts.json_backend)
+    dal_kwargs = {}
+    if opts.segment_size:
+        dal_kwargs['segment_size'] = opts.segment_size * 1024 * 1024
+    if opts.segment_age:
+        dal_kwargs['segment_age'] = opts.segment_age * 3600
+    if opts.workers > 1:
+        if opts.dal == 'columnar' or opts.ingest_port:
+            prs.error('--workers does not support the columnar DAL'
+                      ' or --ingest-port')
+        _serve_workers(opts, group_bys, approx_group_bys, dal_kwargs)
+        return
+    if opts.dal == 'line':
+        dal_kwargs['scan_processes'] = opts.scan_processes
 
-    v1_app = create_v1_app()
+    v1_app = create_v1_app(dal_name=opts.dal,
+                           group_bys=group_bys,
+                           approx_group_bys=approx_group_bys,
+                           batch_writes=not opts.no_batch,
+                           durability=opts.durability,
+                           query_cache_size=opts.query_cache_size,
+                           **dal_kwargs)
     app = Application([('/v1', v1_app)])
     meta_app = MetaApplication()
     if debug:
         app.add(('/', meta_app))
 
-    app.serve(port=PORT, threaded=True)
+    serve_kwargs = {}
+    if opts.ingest_port:
+        data_store = v1_app.resources['data_store']
+        prepare_record = partial(prepare_import_record,
+                                 environments=data_store.environments)
+        ingest_server = IngestServer(('', opts.ingest_port), data_store,
+                                     prepare_record=prepare_record)
+        ingest_thread = threading.Thread(target=ingest_server.serve_forever,
+                                         name='IngestServer')
+        ingest_thread.daemon = True
+        ingest_thread.start()
+        # the reloader runs main() in a second process, which couldn't
+        # bind the ingest port again
+        serve_kwargs['use_reloader'] = False
+
+    app.serve(port=PORT, threaded=True, **serve_kwargs)
+
+    return
+
 
+def _serve_workers(opts, group_bys, approx_group_bys, dal_kwargs):
+    # the parent only writes, so it needs no scan pool, and workers
+    # only scan in parallel if asked to, as they already share the CPUs
+    data_store = create_data_store(dal_name=opts.dal, group_bys=group_bys,
+                                   approx_group_bys=approx_group_bys,
+                                   **dal_kwargs)
+    read_kwargs = dict(dal_kwargs)
+    if opts.dal == 'line':
+        read_kwargs.update(read_only=True,
+                           scan_processes=opts.scan_processes)
+    else:
+        # indexed by the parent, the only process to write, DDL included
+        read_kwargs.update(autoinitdb=False, autoindex_threshold=0)
+        group_bys = ()
+
+    def create_worker_app(wrap_store):
+        read_store = create_data_store(dal_name=opts.dal,
+                                       group_bys=group_bys,
+                                       approx_group_bys=approx_group_bys,
+                                       **read_kwargs)
+        v1_app = create_v1_app(data_store=wrap_store(read_store),
+                               query_cache_size=opts.query_cache_size)
+        app = Application([('/v1', v1_app)])
+        if opts.debug:
+            app.add(('/', MetaApplication()))
+        return app
+
+    def wrap_writer(data_store):
+        if opts.no_batch:
+            return data_store
+        return BatchWriter(data_store, durability=opts.durability)
+
+    serve_prefork('0.0.0.0', PORT, opts.workers, data_store,
+                  create_worker_app, wrap_writer=wrap_writer)
     return
 
 
-def create_v1_app(dal_name=DEFAULT_DAL, file_path=None):
+def create_data_store(dal_name=DEFAULT_DAL, file_path=None,
+                      group_bys=DEFAULT_GROUP_BYS,
+                      approx_group_bys=DEFAULT_APPROX_GROUP_BYS,
+                      **dal_kwargs):
+    """Extra keyword arguments are passed through to the DAL."""
+    dal_kwargs['group_by_paths'] = group_bys
     if dal_name == 'line':
         dal_type = LineDAL
+        dal_kwargs['approx_group_by_paths'] = approx_group_bys
     elif dal_name == 'sql':
-        pass
+        dal_type = SQLiteDAL
+        dal_kwargs.update(table_name=DEFAULT_TABLE_NAME,
+                          message_proto=MESSAGE_PROTO)
+    elif dal_name == 'columnar':
+        dal_type = ColumnarDAL
+        dal_kwargs['message_proto'] = MESSAGE_PROTO
     else:
         raise ValueError('unrecognized DAL name: %r' % dal_name)
 
     if file_path is None:
         file_path = DEFAULT_PREFIX + dal_type._extension
 
-    data_store = dal_type(file_path)
+    return dal_type(file_path, **dal_kwargs)
+
+
+def create_v1_app(dal_name=DEFAULT_DAL, file_path=None,
+                  group_bys=DEFAULT_GROUP_BYS,
+                  approx_group_bys=DEFAULT_APPROX_GROUP_BYS, batch_writes=True,
+                  durability=DEFAULT_DURABILITY,
+                  query_cache_size=DEFAULT_QUERY_CACHE_SIZE, data_store=None,
+                  **dal_kwargs):
+    """Serves *data_store* if set, or else a new store of the named DAL,
+    created with the extra keyword arguments. A *data_store* is used
+    as is, without a BatchWriter."""
+    if data_store is None:
+        data_store = create_data_store(dal_name, file_path, group_bys,
+                                       approx_group_bys, **dal_kwargs)
+        if batch_writes:
+            data_store = BatchWriter(data_store, durability=durability)
+    if query_cache_size:
+        data_store = QueryCache(data_store, max_size=query_cache_size)
 
     rdm = RequestDataMiddleware()
-    gpm = GetParamMiddleware({'raw_query': str, 'group_by': str, 'limit': int})
+    gpm = GetParamMiddleware({'raw_query': str, 'group_by': str, 'limit': int,
+                              'since': int, 'until': int, 'bucket': str,
+                              'approx': str})
+
+    environments = getattr(data_store, 'environments', None)
 
     return Application([('/on_import', on_import_endpoint, render_basic),
+                        ('/on_import_batch', on_import_batch_endpoint,
+                         render_basic),
                         ('/count', get_count_data, render_basic),
+                        ('/cache_stats', get_cache_stats, render_basic),
+                        ('/environments', get_environments, render_basic),
                         ('/download/import', get_import_data, render_basic)],
-                       resources={'data_store': data_store},
+                       resources={'data_store': data_store,
+                                  'environments': environments},
                        middlewares=[gpm, rdm])
 
 
 class RequestDataMiddleware(Middleware):
+    """Provides the request body, decompressed if the client sent it
+    with a Content-Encoding (see content_encoding.py), up to
+    *max_decoded_size* bytes."""
     provides = ('request_data',)
 
-    def __init__(self, as_text=False):
+    def __init__(self, as_text=False,
+                 max_decoded_size=DEFAULT_MAX_DECODED_SIZE):
         self.as_text = as_text
+        self.max_decoded_size = max_decoded_size
 
     def request(self, next, request):
-        return next(request_data=request.get_data(as_text=self.as_text))
+        content_encoding = request.headers.get('Content-Encoding')
+        if not content_encoding:
+            return next(request_data=request.get_data(as_text=self.as_text))
+        try:
+            data = decode_body(request.get_data(), content_encoding,
+                               max_size=self.max_decoded_size)
+        except UnsupportedEncoding as ue:
+            raise UnsupportedMediaType(str(ue))
+        except DecodedTooLarge as dtl:
+            raise RequestEntityTooLarge(str(dtl))
+        except ValueError as ve:
+            raise BadRequest(str(ve))
+        if self.as_text:
+            data = data.decode('utf-8', 'replace')
+        return next(request_data=data)
+
+
+def on_import_endpoint(request_data, data_store, environments):
+    """Acknowledges the env_id of the record's environment, if it
+    was stored, after which the client may send just the env_id."""
+    record = prepare_import_record(request_data, environments)
+    data_store.add_record(record)
+    ret = {'success': True}
+    if ENV_ID_KEY in record:
+        ret[ENV_ID_KEY] = record[ENV_ID_KEY]
+    return ret
 
 
-def on_import_endpoint(request_data, data_store):
+def on_import_batch_endpoint(request_data, data_store, environments):
+    """Imports a JSON Lines body, one record per line, as spooled by
+    the client (see client/collect.py). The batch is checked in full
+    before any of it is stored, and stored with one write."""
+    records = []
+    for line_no, line in enumerate(request_data.split('\n'), 1):
+        if not line.strip():
+            continue
+        try:
+            records.append(prepare_import_record(line, environments))
+        except Conflict as ce:  # a subclass of BadRequest
+            raise Conflict('line %s: %s' % (line_no, ce.detail))
+        except BadRequest as bre:
+            raise BadRequest('line %s: %s' % (line_no, bre.detail))
+    if not records:
+        raise BadRequest('expected json lines body')
+    data_store.add_records(records)
+    return {'success': True, 'record_count': len(records)}
+
+
+def prepare_import_record(request_data, environments=None):
+    """Validates an import body and returns the record to store, with
+    server_time set. Shared with the IngestServer.
+
+    With *environments*, an EnvironmentTable, the record's environment
+    is stored there, and the record's encoded form has its env_id
+    instead (see dal/environments.py). Records sent with just an
+    env_id get their environment filled back in, or raise Conflict if
+    the env_id is unknown, for the client to resend them in full.
+    Without it, env_ids are dropped, as they couldn't be resolved."""
     if not request_data:
         raise BadRequest('expected json body')
-    data = json.loads(request_data)
-    data['server_time'] = str(datetime.datetime.utcnow())
-    data_store.add_record(data)
-    return {'success': True}
+    try:
+        data = jsoncodec.loads(request_data)
+    except ValueError:
+        raise BadRequest('expected json body')
+    if not isinstance(data, dict):
+        raise BadRequest('expected json object')
+    server_time = str(datetime.datetime.utcnow())
+    if environments is not None:
+        env, rest = split_environment(data)
+        if env:
+            env_id = environments.add(env)
+            rest[ENV_ID_KEY] = data[ENV_ID_KEY] = env_id
+            rest['server_time'] = data['server_time'] = server_time
+            return jsoncodec.EncodedRecord(data, jsoncodec.dumps(rest))
+        if ENV_ID_KEY in data:
+            env = environments.get(data[ENV_ID_KEY])
+            if env is None:
+                raise Conflict('unknown %s: %r' % (ENV_ID_KEY,
+                                                    data[ENV_ID_KEY]))
+            data = expand_record(data, env)
+    elif ENV_ID_KEY in data:
+        del data[ENV_ID_KEY]
+        request_data = jsoncodec.dumps(data)
+    if 'server_time' not in data:
+        # the body was just validated, so it can be stored as sent,
+        # plus server_time, instead of being re-encoded
+        encoded = jsoncodec.splice_field(request_data,
+                                         'server_time', server_time)
+        data = jsoncodec.EncodedRecord(data, encoded)
+    data['server_time'] = server_time
+    return data
 
 
-def get_count_data(data_store, group_by, limit):
+def get_count_data(data_store, group_by, limit, since, until, bucket,
+                   approx):
     """\
     A very basic counting/grouping function for analytics data.
 
     From a browser, try <url>?group_by=username&limit=100
 
-    Records are read in reverse, so a limit of 100 means the 100 most
-    recent records.  If no limit is provided, all records are counted.
+    A limit of 100 means the 100 most recent records, found by seeking
+    through the store's offset index. If no limit is provided, all
+    records are counted.
+
+    Alternatively, *since* and *until* (UTC Unix timestamps) count the
+    records received in a time range, and *bucket* (hour or day)
+    splits counts by time, e.g., <url>?group_by=username&bucket=day
+
+    With approx=true, the number of distinct keys is estimated and
+    only the most frequent keys are counted, in bounded memory. This
+    is meant for paths with many distinct values, like uuid.
+    """
+    if approx and approx.lower() in ('1', 'true', 'yes'):
+        if since is not None or until is not None or bucket is not None:
+            raise BadRequest('approx cannot be combined with since, until,'
+                             ' or bucket')
+        select_approx = getattr(data_store, 'select_approx', None)
+        if select_approx is None:
+            raise BadRequest('this data store does not support approx')
+        return select_approx(group_by=group_by, limit=limit)
+    if since is None and until is None and bucket is None:
+        return data_store.select_records(group_by=group_by, limit=limit)
+    if limit:
+        raise BadRequest('limit cannot be combined with since, until,'
+                         ' or bucket')
+    select_buckets = getattr(data_store, 'select_buckets', None)
+    if select_buckets is None:
+        raise BadRequest('this data store does not support time ranges')
+    try:
+        return select_buckets(group_by=group_by, since=since, until=until,
+                              bucket=bucket)
+    except ValueError as ve:
+        raise BadRequest(str(ve))
+
+
+def get_cache_stats(data_store):
+    "Hit and miss counts of the /count cache, for sizing it."
+    get_stats = getattr(data_store, 'get_cache_stats', None)
+    if get_stats is None:
+        return {'enabled': False}
+    ret = get_stats()
+    ret['enabled'] = True
+    return ret
+
+
+def get_environments(environments):
+    """The environments of records stored with an env_id, by env_id.
+    Exports of the line store need these to fill records back in."""
+    if environments is None:
+        return {}
+    return environments.to_dict()
+
+
+def get_import_data(request, data_store, since, until):
+    """\
+    Streams the store in chunks, across segments if there are
+    several. *since* and *until* are optional record numbers, so an
+    incremental export can pass the X-Next-Since header of its
+    previous export as *since* and only download new records. Byte
+    ranges (the Range header) are relative to the since/until window,
+    so interrupted exports can be resumed.
+
+    Lines are no longer self-contained, a break from earlier exports:
+    those stored with an env_id lack their environment fields (uname,
+    linux_dist, and all of python but argv), which are served by
+    /v1/environments, keyed by env_id. To restore a line, merge each
+    of those fields into the line's own, as
+    dal.environments.expand_record() does.
     """
-    ret = data_store.select_records(group_by=group_by, limit=limit)
+    status = 200
+    headers = {'Accept-Ranges': 'bytes'}
+    # pin the end of open-ended exports of line-based stores, so that
+    # X-Next-Since is exact even as new records are being appended
+    record_count = getattr(data_store, 'total_count', None)
+    if until is None and record_count is not None:
+        until = record_count
+        headers['X-Next-Since'] = str(record_count)
+    try:
+        parts = data_store.open_export(since, until)
+    except ValueError as ve:
+        raise BadRequest(str(ve))
+    length = sum([stop - start for _, start, stop in parts])
+    if request.range is not None:
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            _close_parts(parts)
+            raise RequestedRangeNotSatisfiable()
+        status = 206
+        content_range = request.range.make_content_range(length)
+        headers['Content-Range'] = str(content_range)
+        parts = _slice_parts(parts, *byte_range)
+        length = byte_range[1] - byte_range[0]
+    headers['Content-Length'] = str(length)
+
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and len(parts) == 1 \
+            and isinstance(parts[0][0], file):
+        # a single uncompressed part is handed over as the file itself,
+        # seeked to its start, so servers can sendfile() it. the store
+        # may be appended to during the export, so Content-Length is
+        # what ends the response. (werkzeug's development server, as of
+        # 0.9.4, doesn't provide a file_wrapper.)
+        file_obj, start, _ = parts[0]
+        file_obj.seek(start)
+        body = file_wrapper(file_obj, DOWNLOAD_CHUNK_SIZE)
+    else:
+        body = _iter_parts(parts)
+    return Response(body, status=status, headers=headers,
+                    mimetype='application/octet-stream',
+                    direct_passthrough=True)
+
+
+def _slice_parts(parts, start, stop):
+    "Narrow (file_obj, start, stop) parts to a range of their total bytes."
+    ret, pos = [], 0
+    for file_obj, p_start, p_stop in parts:
+        lo = max(start - pos, 0)
+        hi = min(stop - pos, p_stop - p_start)
+        if lo < hi:
+            ret.append((file_obj, p_start + lo, p_start + hi))
+        else:
+            file_obj.close()
+        pos += p_stop - p_start
     return ret
 
 
-def get_import_data(data_store):
-    return open(data_store.file_path, 'rb').read()
+def _close_parts(parts):
+    for file_obj, _, _ in parts:
+        file_obj.close()
+
+
+def _iter_parts(parts, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    try:
+        for file_obj, start, stop in parts:
+            file_obj.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = file_obj.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    finally:
+        _close_parts(parts)
 
 
 if __name__ == '__main__':
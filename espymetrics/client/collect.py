@@ -1,14 +1,41 @@
 # -*- coding: utf-8 -*-
+"""Collects information about the importing program and its host, and
+sends it to the espymetrics server.
 
+This runs on every import of an instrumented package, so it's kept
+cheap. Facts which only change with the host or the interpreter, like
+the FQDN, uname, and library versions, are probed once and cached on
+disk, in DEFAULT_FACTS_PATH, keyed by hostname, interpreter path, and
+boot ID, for up to FACTS_MAX_AGE seconds. The modules the probes need,
+like platform and ssl, are only imported on a cache miss, and the FQDN
+lookup, which can block on DNS, gets at most FQDN_TIMEOUT seconds. A
+probe which fails, like an FQDN lookup which times out, isn't retried
+for FAILED_FACT_MAX_AGE seconds, so a host with slow DNS doesn't pay
+for the timeout on every import.
+
+Most of a record, its host environment, is the same on every send.
+Records carry an env_id, a hash of the environment, and once a server
+has acknowledged an env_id, records are sent to it with just the
+env_id in place of the environment. Acknowledged env_ids are kept in
+DEFAULT_ENVS_PATH. If the server doesn't know the env_id after all,
+it responds 409 Conflict, and the record is sent again in full.
+
+To keep collection off the import path entirely, see deferred.py.
+"""
+
+import io
+import os
 import sys
-import json
 import time
 import uuid
+import zlib
 import socket
 import getpass
 import datetime
-import platform
+import calendar
+import threading
 import socklusion
+import spool
 
 try:
     from strutils import escape_shell_args
@@ -19,36 +46,224 @@ except ImportError:
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 8888
 DEFAULT_PATH = '/v1/on_import'
+DEFAULT_BATCH_PATH = '/v1/on_import_batch'
+DEFAULT_SPOOL_PATH = os.path.expanduser('~/.espymetrics_spool.jsonl')
+SPOOL_MAX_BYTES = 256 * 1024
+SPOOL_MAX_AGE = 3600.0  # seconds
+SPOOL_REJECTED_STATUSES = (400, 413, 415)  # bad content, not worth resending
+DEFAULT_FACTS_PATH = os.path.expanduser('~/.espymetrics_facts.json')
+FACTS_MAX_AGE = 24 * 3600.0  # seconds
+FQDN_TIMEOUT = 1.0  # seconds
+FAILED_FACT_MAX_AGE = 600.0  # seconds until a failed probe is retried
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+DEFAULT_ENVS_PATH = os.path.expanduser('~/.espymetrics_envs.json')
+ENVS_PER_SERVER = 16  # acknowledged env_ids remembered per server
+ENV_ID_KEY = 'env_id'
+# the fields of the host environment, split from records as the server
+# splits them (see dal/environments.py)
+ENV_FIELDS = ('uname', 'linux_dist', 'python')
+RECORD_SUBFIELDS = {'python': ('argv',)}
 TIMEOUT = 5.0
+GZIP_LEVEL = 6
 
 INSTANCE_ID = uuid.uuid4()
 IS_64BIT = sys.maxsize > 2 ** 32
 HAVE_UCS4 = getattr(sys, 'maxunicode', 0) > 65536
-HAVE_READLINE = True
-try:
-    import readline
-except Exception:
-    HAVE_READLINE = False
 
-try:
-    import sqlite3
-    SQLITE_VERSION = sqlite3.sqlite_version
-except Exception:
-    SQLITE_VERSION = ''
+TIME_INFO = {'utc': str(datetime.datetime.utcnow()),
+             'std_utc_offset': -time.timezone / 3600.0}
 
+_json = None
 
-try:
-    import ssl
-    OPENSSL_VERSION = ssl.OPENSSL_VERSION
-except Exception:
-    OPENSSL_VERSION = ''
 
+def get_json_lib():
+    """Returns the fastest installed JSON library, in the same order of
+    preference as the server's (see dal/jsoncodec.py). It's imported on
+    first use, not with this module, which is on the import path."""
+    global _json
+    if _json is None:
+        try:
+            import ujson as json
+        except ImportError:
+            try:
+                import simplejson as json
+            except ImportError:
+                import json
+        _json = json
+    return _json
 
-TIME_INFO = {'utc': str(datetime.datetime.utcnow()),
-             'std_utc_offset': -time.timezone / 3600.0}
+
+def _get_fqdn(timeout=FQDN_TIMEOUT):
+    # getfqdn() can block on DNS for much longer than an import should
+    # take, so it gets *timeout* seconds, after which None is returned
+    # and the thread is left to finish on its own
+    result = []
+    thread = threading.Thread(target=lambda: result.append(socket.getfqdn()),
+                              name='getfqdn')
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return result[0] if result else None
+
+
+def _get_uname():
+    import platform
+    uname = platform.uname()
+    return {'system': uname[0],
+            'node': uname[1],
+            'release': uname[2],  # linux: distro name
+            'version': uname[3],  # linux: kernel version
+            'machine': uname[4],
+            'processor': uname[5]}
+
+
+def _get_linux_dist():
+    import platform
+    try:
+        linux_dist = platform.linux_distribution()
+    except AttributeError:
+        linux_dist = ('', '')  # removed in Python 3.8
+    return {'name': linux_dist[0],
+            'version': linux_dist[1]}
+
+
+def _get_compiler():
+    import platform
+    return platform.python_compiler()
+
+
+def _get_build_date():
+    import platform
+    return platform.python_build()[1]
 
 
-def get_python_info():
+def _get_openssl_version():
+    try:
+        import ssl
+        return ssl.OPENSSL_VERSION
+    except Exception:
+        return ''
+
+
+def _get_sqlite_version():
+    try:
+        import sqlite3
+        return sqlite3.sqlite_version
+    except Exception:
+        return ''
+
+
+def _get_have_readline():
+    try:
+        import readline
+    except Exception:
+        return False
+    return True
+
+
+# each returns the fact's value, or None if it isn't known this time,
+# in which case the failure is cached, for a shorter time
+FACT_PROBES = {'hostfqdn': _get_fqdn,
+               'uname': _get_uname,
+               'linux_dist': _get_linux_dist,
+               'compiler': _get_compiler,
+               'build_date': _get_build_date,
+               'openssl_version': _get_openssl_version,
+               'sqlite_version': _get_sqlite_version,
+               'have_readline': _get_have_readline}
+TIMED_PROBES = ('hostfqdn',)  # probes which take a timeout argument
+
+
+def _get_facts_key():
+    # home directories may be shared between hosts, so the key
+    # includes the hostname. the boot ID changes on reboot, when
+    # things like the kernel may have been upgraded.
+    try:
+        with open(BOOT_ID_PATH) as f:
+            boot_id = f.read().strip()
+    except (IOError, OSError):
+        boot_id = ''
+    return '%s:%s:%s' % (socket.gethostname(), sys.executable, boot_id)
+
+
+def _load_json(path):
+    json = get_json_lib()
+    try:
+        with open(path, 'rb') as f:
+            entries = json.loads(f.read())
+    except Exception:
+        return {}  # missing or corrupt, it's started over
+    return entries if isinstance(entries, dict) else {}
+
+
+def _save_json(path, entries):
+    # written to a temporary file and renamed into place, so readers
+    # never see a partial file
+    json = get_json_lib()
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(entries))
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def get_host_facts(facts_path=DEFAULT_FACTS_PATH, max_age=FACTS_MAX_AGE,
+                   probe_timeout=FQDN_TIMEOUT):
+    """Returns a dict of the facts in FACT_PROBES, from the cache at
+    *facts_path* where possible, probing for the rest and caching
+    them. Facts whose probe failed, like an FQDN lookup which timed
+    out, are left out, and not probed again for FAILED_FACT_MAX_AGE
+    seconds. Probes which can block get at most *probe_timeout*
+    seconds. With no *facts_path*, everything is probed."""
+    now = time.time()
+    key = _get_facts_key()
+    entries = _load_json(facts_path) if facts_path else {}
+    entry = entries.get(key)
+    try:
+        if not (0 <= now - entry['time'] < max_age
+                and isinstance(entry['facts'], dict)
+                and isinstance(entry.get('failed', {}), dict)):
+            entry = None
+    except Exception:
+        entry = None
+    if entry is None:
+        entry = {'time': now, 'facts': {}}
+    facts = entry['facts']
+    # when each fact's probe last failed
+    failed = entry.setdefault('failed', {})
+    missing = [name for name in FACT_PROBES if name not in facts
+               and not 0 <= now - failed.get(name, -1) < FAILED_FACT_MAX_AGE]
+    if not missing:
+        return facts
+    for name in missing:
+        if name in TIMED_PROBES:
+            value = FACT_PROBES[name](timeout=probe_timeout)
+        else:
+            value = FACT_PROBES[name]()
+        if value is None:
+            failed[name] = now
+        else:
+            facts[name] = value
+            failed.pop(name, None)
+    if facts_path:
+        # expired entries, like those from before the last reboot, are
+        # dropped as the file is rewritten
+        entries = dict([(k, v) for k, v in entries.items()
+                        if isinstance(v, dict)
+                        and 0 <= now - v.get('time', 0) < max_age])
+        entries[key] = entry
+        _save_json(facts_path, entries)
+    return facts
+
+
+def get_python_info(facts=None):
+    if facts is None:
+        facts = get_host_facts()
     ret = {}
     ret['argv'] = escape_shell_args(sys.argv)
     ret['bin'] = sys.executable
@@ -59,59 +274,395 @@ def get_python_info():
     # the unparsable version string, we're still transmitting it.
     ret['version'] = sys.version
 
-    ret['compiler'] = platform.python_compiler()
-    ret['build_date'] = platform.python_build()[1]
+    ret['compiler'] = facts['compiler']
+    ret['build_date'] = facts['build_date']
     ret['version_info'] = list(sys.version_info)
-    ret['openssl_version'] = OPENSSL_VERSION
-    ret['sqlite_version'] = SQLITE_VERSION
+    ret['openssl_version'] = facts['openssl_version']
+    ret['sqlite_version'] = facts['sqlite_version']
     ret['have_ucs4'] = HAVE_UCS4
-    ret['have_readline'] = HAVE_READLINE
+    ret['have_readline'] = facts['have_readline']
     return ret
 
 
-def get_all_info():
+def get_all_info(facts_path=DEFAULT_FACTS_PATH, probe_timeout=FQDN_TIMEOUT):
+    """Returns the record to send. See get_host_facts() for
+    *facts_path* and *probe_timeout*."""
+    facts = get_host_facts(facts_path, probe_timeout=probe_timeout)
     ret = {}
     ret['username'] = getpass.getuser()
     ret['uuid'] = str(INSTANCE_ID)
     ret['hostname'] = socket.gethostname()
-    ret['hostfqdn'] = socket.getfqdn()
-    uname = platform.uname()
-    ret['uname'] = {'system': uname[0],
-                    'node': uname[1],
-                    'release': uname[2],  # linux: distro name
-                    'version': uname[3],  # linux: kernel version
-                    'machine': uname[4],
-                    'processor': uname[5]}
-    linux_dist = platform.linux_distribution()
-    ret['linux_dist'] = {'name': linux_dist[0],
-                         'version': linux_dist[1]}
-
-    ret['python'] = get_python_info()
+    ret['hostfqdn'] = facts.get('hostfqdn', ret['hostname'])
+    ret['uname'] = facts['uname']
+    ret['linux_dist'] = facts['linux_dist']
+
+    ret['python'] = get_python_info(facts)
     ret['time'] = TIME_INFO
     return ret
 
 
-def build_post_message(data, host=DEFAULT_HOST, path=DEFAULT_PATH):
+def split_environment(data_dict):
+    """Returns an (env, rest) pair: the environment fields of
+    *data_dict*, and the rest of it."""
+    env, rest = {}, dict(data_dict)
+    for field in ENV_FIELDS:
+        if field not in rest:
+            continue
+        value = rest.pop(field)
+        keep = RECORD_SUBFIELDS.get(field)
+        if keep and isinstance(value, dict):
+            kept = dict([(k, value[k]) for k in keep if k in value])
+            if kept:
+                rest[field] = kept
+            value = dict([(k, v) for k, v in value.items() if k not in keep])
+            if not value:
+                continue
+        env[field] = value
+    return env, rest
+
+
+def get_env_id(env):
+    """Hashes the canonical JSON encoding of *env*, as the server does.
+    ujson and simplejson encode it the same as the standard library."""
+    import hashlib
+    json = get_json_lib()
+    if json.__name__ == 'ujson':
+        encoded = json.dumps(env, sort_keys=True,
+                             escape_forward_slashes=False)
+    else:
+        encoded = json.dumps(env, sort_keys=True, separators=(',', ':'))
+    if not isinstance(encoded, bytes):
+        encoded = encoded.encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:20]
+
+
+def _get_server_key(host, port):
+    return '%s:%s' % (host, port)
+
+
+def _update_acked_envs(envs_path, host, port, env_id, acked):
+    entries = _load_json(envs_path)
+    key = _get_server_key(host, port)
+    prev_env_ids = entries.get(key, [])
+    env_ids = [e for e in prev_env_ids if e != env_id]
+    if acked:
+        env_ids = (env_ids + [env_id])[-ENVS_PER_SERVER:]
+    if env_ids != prev_env_ids:
+        entries[key] = env_ids
+        _save_json(envs_path, entries)
+
+
+def _get_acked_env_ids(envs_path, host, port):
+    if not envs_path:
+        return None
+    return _load_json(envs_path).get(_get_server_key(host, port), [])
+
+
+def _build_import_body(data_dict, acked_env_ids):
+    json = get_json_lib()
+    if acked_env_ids is None:
+        return json.dumps(data_dict), None, False
+    env, rest = split_environment(data_dict)
+    if not env:
+        return json.dumps(data_dict), None, False
+    env_id = get_env_id(env)
+    if env_id in acked_env_ids:
+        rest[ENV_ID_KEY] = env_id
+        return json.dumps(rest), env_id, True
+    return json.dumps(dict(data_dict, env_id=env_id)), env_id, False
+
+
+def build_import_body(data_dict, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                      envs_path=DEFAULT_ENVS_PATH):
+    """Returns a (body, env_id, is_short) tuple for sending *data_dict*
+    to the server at *host* and *port*. The body has the env_id of the
+    record's environment, and if the server acknowledged it, per
+    *envs_path*, leaves the environment out. With no *envs_path*, the
+    body is the record as is, and env_id None."""
+    return _build_import_body(data_dict,
+                              _get_acked_env_ids(envs_path, host, port))
+
+
+def parse_response(response):
+    "Returns the status and body of the raw HTTP *response*."
+    head, _, body = (response or b'').partition(b'\r\n\r\n')
+    try:
+        return int(head.split(None, 2)[1]), body
+    except (IndexError, ValueError):
+        return None, body
+
+
+def check_env_response(status, body, env_id, is_short, host=DEFAULT_HOST,
+                       port=DEFAULT_PORT, envs_path=DEFAULT_ENVS_PATH):
+    """Notes what the server's response to a body from
+    build_import_body() says about its env_id: acknowledged, or
+    unknown. Returns True if the record needs to be sent again, in
+    full."""
+    json = get_json_lib()
+    if not env_id or not envs_path:
+        return False
+    if is_short:
+        if status != 409:
+            return False
+        _update_acked_envs(envs_path, host, port, env_id, acked=False)
+        return True
+    if status != 200:
+        return False
+    try:
+        acked_id = json.loads(body).get(ENV_ID_KEY)
+    except Exception:
+        return False  # e.g., a server which doesn't store environments
+    if acked_id == env_id:
+        _update_acked_envs(envs_path, host, port, env_id, acked=True)
+    return False
+
+
+def gzip_bytes(data, level=GZIP_LEVEL):
+    "The inverse of strutils.gunzip_bytes()."
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def build_post_message(data, host=DEFAULT_HOST, path=DEFAULT_PATH,
+                       compress=False):
+    """With *compress*, the body is gzipped, which the server decodes
+    per the Content-Encoding header."""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
     msg_lines = ['POST %s HTTP/1.0' % path,
-                 'Host: %s' % host,
-                 'Content-Length: ' + str(len(data)),
-                 '',
-                 data]
-    msg = '\r\n'.join(msg_lines)
-    return msg.encode('utf-8')
+                 'Host: %s' % host]
+    if compress:
+        data = gzip_bytes(data)
+        msg_lines.append('Content-Encoding: gzip')
+    msg_lines.extend(['Content-Length: ' + str(len(data)),
+                      '',
+                      ''])
+    return '\r\n'.join(msg_lines).encode('utf-8') + data
 
 
 def send_import_analytics(host=DEFAULT_HOST, port=DEFAULT_PORT, data_dict=None,
-                          timeout=TIMEOUT, path=DEFAULT_PATH, wrap_ssl=False):
+                          timeout=TIMEOUT, path=DEFAULT_PATH, wrap_ssl=False,
+                          in_process=False, spool_path=None, compress=False,
+                          envs_path=DEFAULT_ENVS_PATH):
+    """Sends from a child process by default, returning its (stdout,
+    stderr). With *in_process*, sends from a background thread
+    instead, returning a socklusion.SendThread (or None). With
+    *compress*, the body is gzipped. See build_import_body() for
+    *envs_path*. Records the server can't fill back in from their
+    env_id are sent again, in full, and the response is to that.
+
+    With *in_process*, if records are waiting in the spool at
+    *spool_path*, the record is sent along with them, as a batch,
+    instead of on its own."""
+    json = get_json_lib()
     if data_dict is None:
         data_dict = get_all_info()
-    msg = build_post_message(json.dumps(data_dict), host=host, path=path)
-    return socklusion.send_data(msg,
-                                host=host,
-                                port=port,
-                                wrap_ssl=wrap_ssl,
-                                timeout=timeout,
-                                want_response=True)
+    if spool_path and in_process and os.path.exists(spool_path):
+        return spool_import_analytics(host=host, port=port,
+                                      data_dict=data_dict, timeout=timeout,
+                                      wrap_ssl=wrap_ssl,
+                                      spool_path=spool_path, max_bytes=0,
+                                      compress=compress)
+    body, env_id, is_short = build_import_body(data_dict, host=host,
+                                               port=port,
+                                               envs_path=envs_path)
+    msg = build_post_message(body, host=host, path=path, compress=compress)
+
+    def check_response(response, is_short=is_short):
+        status, response_body = parse_response(response)
+        return check_env_response(status, response_body, env_id, is_short,
+                                  host=host, port=port, envs_path=envs_path)
+
+    def get_full_msg():
+        body = json.dumps(dict(data_dict, env_id=env_id))
+        return build_post_message(body, host=host, path=path,
+                                  compress=compress)
+
+    if in_process:
+        def on_sent(thread):
+            if not check_response(thread.response):
+                return
+            response_stream = io.BytesIO()
+            socklusion.send_data_child(get_full_msg(), thread.host,
+                                       response_stream=response_stream,
+                                       **thread.kwargs)
+            thread.response = response_stream.getvalue()
+            check_response(thread.response, is_short=False)
+
+        return socklusion.send_data_async(msg,
+                                          host=host,
+                                          port=port,
+                                          wrap_ssl=wrap_ssl,
+                                          timeout=timeout,
+                                          want_response=True,
+                                          callback=on_sent)
+    ret = socklusion.send_data(msg,
+                               host=host,
+                               port=port,
+                               wrap_ssl=wrap_ssl,
+                               timeout=timeout,
+                               want_response=True)
+    if check_response(ret[0]):
+        ret = socklusion.send_data(get_full_msg(),
+                                   host=host,
+                                   port=port,
+                                   wrap_ssl=wrap_ssl,
+                                   timeout=timeout,
+                                   want_response=True)
+        check_response(ret[0], is_short=False)
+    return ret
+
+
+def send_many_import_analytics(data_dicts, host=DEFAULT_HOST,
+                               port=DEFAULT_PORT, timeout=TIMEOUT,
+                               path=DEFAULT_PATH, wrap_ssl=False,
+                               connection=None, compress=False,
+                               envs_path=DEFAULT_ENVS_PATH):
+    """For batch jobs which send many records. Sends each of
+    *data_dicts* as its own import, pipelined over one persistent
+    connection, and returns the responses, as (status, body) pairs.
+    Pass a transport.PersistentConnection as *connection* to keep
+    using it across calls, otherwise one is opened and closed. See
+    transport.py. With *compress*, each body is gzipped. *envs_path*
+    is as in send_import_analytics()."""
+    json = get_json_lib()
+    import transport
+
+    acked_env_ids = _get_acked_env_ids(envs_path, host, port)
+    prepared = [_build_import_body(data_dict, acked_env_ids)
+                for data_dict in data_dicts]
+    own_connection = connection is None
+    if own_connection:
+        connection = transport.PersistentConnection(host, port,
+                                                    wrap_ssl=wrap_ssl,
+                                                    timeout=timeout)
+    try:
+        responses = _post_many(connection, path,
+                               [body for body, _, _ in prepared], compress)
+        resend, checked = [], set()
+        for i, (status, response_body) in enumerate(responses):
+            _, env_id, is_short = prepared[i]
+            if is_short and status == 409:
+                resend.append(i)
+            elif is_short or status != 200:
+                continue
+            if env_id in checked:
+                continue  # the same for every record with the env_id
+            checked.add(env_id)
+            check_env_response(status, response_body, env_id, is_short,
+                               host=host, port=port, envs_path=envs_path)
+        if resend:
+            full_bodies = [json.dumps(dict(data_dicts[i],
+                                           env_id=prepared[i][1]))
+                           for i in resend]
+            full_responses = _post_many(connection, path, full_bodies,
+                                        compress)
+            resent = set()
+            for i, response in zip(resend, full_responses):
+                responses[i] = response
+                env_id = prepared[i][1]
+                if env_id not in resent and response[0] == 200:
+                    resent.add(env_id)
+                    check_env_response(response[0], response[1], env_id,
+                                       False, host=host, port=port,
+                                       envs_path=envs_path)
+    finally:
+        if own_connection:
+            connection.close()
+    return responses
+
+
+def _post_many(connection, path, bodies, compress):
+    content_encoding = None
+    if compress:
+        bodies = [gzip_bytes(body if isinstance(body, bytes)
+                             else body.encode('utf-8'))
+                  for body in bodies]
+        content_encoding = 'gzip'
+    return connection.post_many(path, bodies,
+                                content_encoding=content_encoding)
+
+
+def _get_spool_age(spool_path):
+    # from the collection time of the oldest record
+    json = get_json_lib()
+    try:
+        utc = json.loads(spool.read_first_line(spool_path))['time']['utc']
+        started = time.strptime(utc[:19], '%Y-%m-%d %H:%M:%S')
+    except Exception:
+        return None
+    return time.time() - calendar.timegm(started)
+
+
+def spool_import_analytics(host=DEFAULT_HOST, port=DEFAULT_PORT,
+                           data_dict=None, timeout=TIMEOUT,
+                           path=DEFAULT_BATCH_PATH, wrap_ssl=False,
+                           spool_path=DEFAULT_SPOOL_PATH,
+                           max_bytes=SPOOL_MAX_BYTES, max_age=SPOOL_MAX_AGE,
+                           compress=False):
+    """Appends the record to a local spool, and sends the spool as one
+    batch once it reaches *max_bytes* in size, or once its oldest
+    record is *max_age* seconds old. Returns the batch's
+    socklusion.SendThread, or None if nothing was sent. Batches which
+    fail to send are spooled again, and batches the server rejects are
+    set aside (see the spool module). If the spool can't be written, or
+    is full, the record is sent on its own. Errors are swallowed, as
+    elsewhere in the client, and return None. With *compress*, batches
+    are gzipped, which shrinks them several times over, as records
+    repeat many of the same long strings."""
+    try:
+        json = get_json_lib()
+        if data_dict is None:
+            data_dict = get_all_info()
+        line = json.dumps(data_dict) + '\n'
+        try:
+            size = spool.append_lines(spool_path, line)
+        except (IOError, OSError):
+            return send_import_analytics(host=host, port=port,
+                                         data_dict=data_dict,
+                                         timeout=timeout, wrap_ssl=wrap_ssl,
+                                         in_process=True, compress=compress)
+        if size < max_bytes:
+            age = _get_spool_age(spool_path)
+            if age is not None and age < max_age:
+                return None
+        return send_spool(host=host, port=port, timeout=timeout, path=path,
+                          wrap_ssl=wrap_ssl, spool_path=spool_path,
+                          compress=compress)
+    except Exception:
+        return None  # never an error in the host program
+
+
+def send_spool(host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=TIMEOUT,
+               path=DEFAULT_BATCH_PATH, wrap_ssl=False,
+               spool_path=DEFAULT_SPOOL_PATH, compress=False):
+    "Sends every spooled record as one batch, from a background thread."
+    try:
+        claimed_path, data = spool.claim(spool_path)
+    except (IOError, OSError):
+        return None
+    if claimed_path is None:
+        return None
+
+    def on_sent(thread):
+        status, _ = parse_response(thread.response)
+        # only a batch refused for its content would fail again. no
+        # response, a server error, or a server without the batch
+        # path, is worth another try later.
+        rejected = status in SPOOL_REJECTED_STATUSES
+        spool.release(claimed_path, sent=status == 200, rejected=rejected)
+
+    msg = build_post_message(data, host=host, path=path, compress=compress)
+    ret = socklusion.send_data_async(msg,
+                                     host=host,
+                                     port=port,
+                                     wrap_ssl=wrap_ssl,
+                                     timeout=timeout,
+                                     want_response=True,
+                                     callback=on_sent)
+    if ret is None:
+        spool.release(claimed_path, sent=False)
+    return ret
 
 
 def main():
@@ -123,14 +674,36 @@ def main():
     prs.add_argument('--port', default=DEFAULT_PORT, type=int)
     prs.add_argument('--path', default=DEFAULT_PATH)
     prs.add_argument('--verbose', action='store_true')
+    prs.add_argument('--thread', action='store_true',
+                     help='send from a background thread instead of a'
+                     ' child process')
+    prs.add_argument('--spool', action='store_true',
+                     help='spool the record locally, and send spooled'
+                     ' records in batches')
+    prs.add_argument('--spool-path', default=DEFAULT_SPOOL_PATH)
+    prs.add_argument('--gzip', action='store_true',
+                     help='gzip request bodies')
     args = prs.parse_args()
     data_dict = get_all_info()
     if args.verbose:
         pprint(data_dict)
-    output = send_import_analytics(host=args.host,
-                                   port=args.port,
-                                   data_dict=data_dict,
-                                   path=args.path)
+    if args.spool:
+        output = spool_import_analytics(host=args.host,
+                                        port=args.port,
+                                        data_dict=data_dict,
+                                        spool_path=args.spool_path,
+                                        compress=args.gzip)
+    else:
+        output = send_import_analytics(host=args.host,
+                                       port=args.port,
+                                       data_dict=data_dict,
+                                       path=args.path,
+                                       in_process=args.thread,
+                                       spool_path=args.spool_path,
+                                       compress=args.gzip)
+    if isinstance(output, socklusion.SendThread):
+        output.join(TIMEOUT)
+        output = output.error or output.response
     if args.verbose:
         print(output)
     return
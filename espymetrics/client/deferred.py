@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Collects and sends analytics after an instrumented package's import,
+instead of during it.
+
+Calling send_import_analytics() on import means the import pays for
+importing collect, for its probes, and for starting the send. Instead,
+defer_import_analytics() only registers the work, and imports nothing
+but atexit. The work is done later, on a daemon thread: either at
+interpreter exit (the default), or *delay* seconds after the import.
+
+The work has a hard wall-clock budget, from when it starts. Its socket
+operations time out within what's left of the budget, and once the
+budget is spent, nothing more is done. At exit, the program waits for
+the work for at most the rest of its budget, after which the thread is
+abandoned and the record dropped. So the program's exit is held up by
+at most *budget* seconds in total, whatever the mode.
+
+With a delay, the work shares the process with the program. On Python
+2, importing collect in the thread holds the import lock, so an import
+made by the program at that moment waits for it. The default delay
+leaves time for the program's own imports to finish first.
+
+Deferred records are sent on their own, not spooled, and like
+collect.send_import_analytics(), with just their env_id in place of
+their environment once the server has acknowledged it.
+"""
+
+import time
+import atexit
+
+DEFAULT_BUDGET = 0.5  # seconds
+DEFAULT_DELAY = 1.0  # seconds after the import, for when='thread'
+JOIN_INTERVAL = 0.005  # seconds
+WHEN_CHOICES = ('exit', 'thread')
+
+
+class DeferredSend(object):
+    """Collects and sends one record, once, on a daemon thread. After
+    it's done, *response* holds the server's response, and *error* any
+    exception raised."""
+    def __init__(self, host=None, port=None, path=None, wrap_ssl=False,
+                 compress=False, budget=DEFAULT_BUDGET):
+        # defaults are collect's, which isn't imported until the work
+        # starts
+        self.host = host
+        self.port = port
+        self.path = path
+        self.wrap_ssl = wrap_ssl
+        self.compress = compress
+        self.budget = float(budget)
+        self.deadline = None
+        self.thread = None
+        self.response = None
+        self.error = None
+        self._start_token = [True]  # popped by whichever caller starts
+
+    def start(self):
+        "Start the work, if it hasn't been started yet."
+        import threading
+        try:
+            self._start_token.pop()  # atomic, so the work starts once
+        except IndexError:
+            return
+        self.deadline = time.time() + self.budget
+        thread = threading.Thread(target=self._run,
+                                  name='espymetrics-deferred')
+        thread.daemon = True
+        thread.start()
+        self.thread = thread
+
+    def finish(self):
+        """Registered with atexit. Starts the work, if it hasn't been
+        started, and waits for the rest of its budget."""
+        self.start()
+        thread = self.thread
+        if thread is None:
+            return  # being started on the timer thread right now
+        # joined in short steps, as Python 2's timed waits sleep for
+        # up to 50ms at a time, which would add to the exit
+        while thread.is_alive():
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                break
+            thread.join(min(remaining, JOIN_INTERVAL))
+        return
+
+    def _get_remaining(self):
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise RuntimeError('deferred analytics over budget (%ss)'
+                               % self.budget)
+        return remaining
+
+    def _run(self):
+        import io
+        try:
+            import collect
+            import socklusion
+            # a probe on a cache miss, like the FQDN lookup, gets at
+            # most half of what's left, leaving the rest for the send
+            probe_timeout = min(collect.FQDN_TIMEOUT,
+                                self._get_remaining() / 2)
+            data_dict = collect.get_all_info(probe_timeout=probe_timeout)
+            host = self.host or collect.DEFAULT_HOST
+            port = self.port or collect.DEFAULT_PORT
+            path = self.path or collect.DEFAULT_PATH
+            body, env_id, is_short = collect.build_import_body(
+                data_dict, host=host, port=port)
+            for _ in range(2):
+                msg = collect.build_post_message(body, host=host, path=path,
+                                                 compress=self.compress)
+                remaining = self._get_remaining()
+                response_stream = io.BytesIO()
+                socklusion.send_data_child(
+                    msg, host, port=port,
+                    wrap_ssl=self.wrap_ssl,
+                    timeout=remaining, socket_timeout=remaining,
+                    want_response=True, response_stream=response_stream)
+                self.response = response_stream.getvalue()
+                status, response_body = collect.parse_response(self.response)
+                if not collect.check_env_response(status, response_body,
+                                                  env_id, is_short,
+                                                  host=host, port=port):
+                    break
+                # the server didn't know the env_id, so send it all
+                body = collect.get_json_lib().dumps(
+                    dict(data_dict, env_id=env_id))
+                is_short = False
+        except Exception as e:
+            self.error = e
+        except:
+            # past its budget at exit, the thread may outlive parts of
+            # the interpreter, which is already shutting down
+            pass
+        return
+
+
+def defer_import_analytics(host=None, port=None, path=None, wrap_ssl=False,
+                           compress=False, when='exit', delay=DEFAULT_DELAY,
+                           budget=DEFAULT_BUDGET):
+    """Registers collecting and sending the import analytics for later,
+    *when* at 'exit', or on a 'thread' started *delay* seconds from
+    now. The work gets *budget* seconds. *host*, *port*, *path*,
+    *wrap_ssl*, and *compress* are as in
+    collect.send_import_analytics(). Returns the DeferredSend."""
+    if when not in WHEN_CHOICES:
+        raise ValueError('when expected one of %r, not %r'
+                         % (WHEN_CHOICES, when))
+    deferred = DeferredSend(host=host, port=port, path=path,
+                            wrap_ssl=wrap_ssl, compress=compress,
+                            budget=budget)
+    atexit.register(deferred.finish)
+    if when == 'thread':
+        import threading
+        timer = threading.Timer(delay, deferred.start)
+        timer.daemon = True
+        timer.start()
+    return deferred
@@ -1,27 +1,44 @@
 # -*- coding: utf-8 -*-
-
+"""Sends data over a socket without blocking or crashing the sending
+program.
+
+send_data() hands the data to a child Python process, which sends it
+and outlives the parent if necessary. send_data_async() sends it from
+a daemon thread instead, skipping the cost of starting an interpreter.
+Errors in the thread are recorded, not raised. At interpreter exit,
+unfinished sends get up to EXIT_WAIT seconds, in total, to complete,
+after which they're abandoned, so the program's exit is never held up
+for longer.
+
+Instrumented programs pay for importing this module, so ssl,
+subprocess, and optparse are only imported when used.
+"""
+
+import io
 import os
-import ssl
 import sys
 import time
+import atexit
 import socket
-import optparse
-import subprocess
+import threading
 
 
 DEFAULT_TIMEOUT = 60.0
 DEFAULT_SOCKET_TIMEOUT = 5.0
+EXIT_WAIT = 1.0  # max seconds to wait for in-process sends at exit
 
 PYTHON = sys.executable
 CUR_FILE = os.path.abspath(__file__)
 
 
 def get_opt_map(values_obj):
+    import optparse
     attr_names = set(dir(values_obj)) - set(dir(optparse.Values()))
     return dict([(an, getattr(values_obj, an)) for an in attr_names])
 
 
 def parse_args():
+    import optparse
     prs = optparse.OptionParser()
     prs.add_option('--host', default='127.0.0.1')
     prs.add_option('--port', type=int)
@@ -68,6 +85,7 @@ def send_data_child(data,
     max_time = start_time + timeout
     sock = socket.socket()
     if wrap_ssl:
+        import ssl
         sock = ssl.wrap_socket(sock)
     sock.settimeout(socket_timeout)
     sock.connect((host, port))
@@ -89,6 +107,7 @@ def send_data_child(data,
 
 def send_data(data, host, port=None, wrap_ssl=None, timeout=None,
               socket_timeout=None, want_response=False):
+    import subprocess
     cmd_tokens = [PYTHON, CUR_FILE, '--child', '--host', host]
     if port:
         cmd_tokens += ['--port', str(port)]
@@ -114,6 +133,77 @@ def send_data(data, host, port=None, wrap_ssl=None, timeout=None,
         return None, None
 
 
+class SendThread(threading.Thread):
+    """Runs send_data_child() in the background. Once finished,
+    *response* holds the bytes received, if any, and *error* any
+    exception raised. If set, *callback* is then called with the
+    thread, and any exception it raises is ignored."""
+    def __init__(self, data, host, callback=None, **kwargs):
+        threading.Thread.__init__(self, name='socklusion')
+        self.daemon = True
+        self.data = data
+        self.host = host
+        self.callback = callback
+        self.kwargs = kwargs
+        self.response = None
+        self.error = None
+
+    def run(self):
+        response_stream = io.BytesIO()
+        try:
+            send_data_child(self.data, self.host,
+                            response_stream=response_stream, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        self.response = response_stream.getvalue()
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception:
+                pass
+        with _pending_lock:
+            _pending.remove(self)
+
+
+_pending = []  # unfinished SendThreads, waited on at exit
+_pending_lock = threading.Lock()
+
+
+def send_data_async(data, host, port=None, wrap_ssl=None, timeout=None,
+                    socket_timeout=DEFAULT_SOCKET_TIMEOUT,
+                    want_response=False, callback=None):
+    """Like send_data(), but in-process, from a daemon thread. Returns
+    the SendThread, or None if it couldn't be started."""
+    thread = SendThread(data, host, callback=callback, port=port,
+                        wrap_ssl=wrap_ssl, timeout=timeout,
+                        socket_timeout=socket_timeout,
+                        want_response=want_response)
+    with _pending_lock:
+        _pending.append(thread)
+    try:
+        thread.start()
+    except Exception:
+        with _pending_lock:
+            _pending.remove(thread)
+        return None
+    return thread
+
+
+def _wait_at_exit(timeout=EXIT_WAIT):
+    deadline = time.time() + timeout
+    with _pending_lock:
+        threads = list(_pending)
+    for thread in threads:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        thread.join(remaining)
+    return
+
+
+atexit.register(_wait_at_exit)
+
+
 def main():
     opts, args = parse_args()
     data = get_data()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""A local spool file of JSON lines, for sending records in batches.
+
+Any number of processes can append to the spool, one line per record.
+To send the batch, one process claims the spool by renaming it, and
+the next record starts a new spool. If sending fails for want of a
+connection, or on a server error, the claimed lines are appended back
+to the spool, to be sent later. A batch the server rejects outright
+would only be rejected again, so it's set aside in a ".rejected" file
+of its own instead. Only the newest MAX_REJECTED of those are kept.
+The spool is capped at MAX_SIZE bytes; past that, appends raise
+SpoolFull, and failed batches which no longer fit are dropped.
+
+Appends and claims take an exclusive lock on the spool file (where
+fcntl is available), and appenders check that the file they locked
+is still the spool, not one just claimed, so no line can be written
+to a spool after it's been read for sending.
+"""
+
+import os
+import glob
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # e.g., on Windows, appends are best effort
+
+CLAIM_EXT = '.sending'
+REJECTED_EXT = '.rejected'
+MAX_SIZE = 1024 * 1024  # the ingest server's default max body size
+MAX_REJECTED = 10
+STALE_CLAIM_AGE = 600  # seconds until an unsent claim is given back
+
+
+class SpoolFull(IOError):
+    pass
+
+
+def _lock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+
+def _get_ino(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+
+def append_lines(spool_path, data, max_size=MAX_SIZE):
+    """Appends *data*, one or more whole lines, to the spool. Returns
+    the spool's size afterward, in bytes. Raises SpoolFull, writing
+    nothing, if the spool would grow past *max_size* bytes."""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    while True:
+        fd = os.open(spool_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o600)
+        try:
+            _lock(fd)
+            if _get_ino(spool_path) != os.fstat(fd).st_ino:
+                continue  # claimed since we opened it, try the new one
+            if max_size and os.fstat(fd).st_size + len(data) > max_size:
+                raise SpoolFull('spool full: %r' % spool_path)
+            os.write(fd, data)
+            return os.fstat(fd).st_size
+        finally:
+            os.close(fd)  # and unlock
+
+
+def read_first_line(spool_path):
+    try:
+        with open(spool_path, 'rb') as f:
+            return f.readline()
+    except (IOError, OSError):
+        return ''
+
+
+def _get_claim_path(spool_path):
+    return '%s.%s.%s%s' % (spool_path, os.getpid(),
+                           int(time.time() * 1000), CLAIM_EXT)
+
+
+def claim(spool_path):
+    """Moves the spool aside for sending, returning the claimed path
+    and its contents, or (None, None) if the spool is empty. Claims
+    left behind by processes which exited mid-send are given back to
+    the spool first."""
+    _release_stale_claims(spool_path)
+    try:
+        fd = os.open(spool_path, os.O_RDONLY)
+    except OSError:
+        return None, None
+    try:
+        _lock(fd)
+        if _get_ino(spool_path) != os.fstat(fd).st_ino:
+            return None, None  # another process claimed it first
+        claimed_path = _get_claim_path(spool_path)
+        os.rename(spool_path, claimed_path)
+        os.utime(claimed_path, None)  # marks the time of the claim
+        with os.fdopen(os.dup(fd), 'rb') as f:
+            data = f.read()
+    finally:
+        os.close(fd)
+    if not data:
+        os.remove(claimed_path)
+        return None, None
+    return claimed_path, data
+
+
+def release(claimed_path, sent, rejected=False):
+    """Removes the claimed lines if they were *sent*, sets them aside
+    if they were *rejected* by the server, and otherwise appends them
+    back to the spool, unless it's too full to take them."""
+    spool_path = claimed_path.rsplit('.', 3)[0]
+    if rejected:
+        rejected_path = claimed_path[:-len(CLAIM_EXT)] + REJECTED_EXT
+        os.rename(claimed_path, rejected_path)
+        _remove_old_rejected(spool_path)
+        return
+    if not sent:
+        with open(claimed_path, 'rb') as f:
+            try:
+                append_lines(spool_path, f.read())
+            except SpoolFull:
+                pass  # the newer records are kept instead
+    os.remove(claimed_path)
+
+
+def _release_stale_claims(spool_path):
+    cutoff = time.time() - STALE_CLAIM_AGE
+    for claimed_path in glob.glob(spool_path + '.*' + CLAIM_EXT):
+        try:
+            if os.path.getmtime(claimed_path) >= cutoff:
+                continue
+            # renamed first, so only one process gives it back
+            own_path = _get_claim_path(spool_path)
+            os.rename(claimed_path, own_path)
+            release(own_path, sent=False)
+        except (IOError, OSError):
+            pass  # released by another process
+
+
+def _remove_old_rejected(spool_path, max_rejected=MAX_REJECTED):
+    rejected_paths = glob.glob(spool_path + '.*' + REJECTED_EXT)
+    # oldest first, by the claim time in their names
+    rejected_paths.sort(key=lambda path: int(path.split('.')[-2]))
+    for rejected_path in rejected_paths[:-max_rejected]:
+        try:
+            os.remove(rejected_path)
+        except OSError:
+            pass  # removed by another process
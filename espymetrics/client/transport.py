@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""Posts many requests over a persistent HTTP/1.1 connection, for
+batch jobs which send many records.
+
+socklusion opens a new connection for every message, so each record
+pays for a TCP handshake, and with wrap_ssl, a TLS handshake too. A
+PersistentConnection keeps its connection open between requests, and
+pipelines them: up to *max_pipeline* requests are written before their
+responses are read, so a batch isn't paced by round trips.
+
+Pipelining is only safe with servers which keep connections alive. A
+server which closes the connection after a response may reset it,
+discarding responses still in flight. So on each new connection, the
+first response is awaited before any more requests are written, and
+servers which close after every response (like the HTTP/1.0
+development server) get one request per connection.
+
+When a server closes the connection after a response, as the response
+said it would, requests written after it weren't processed, and are
+sent again on a new connection. The same goes for a reused connection
+which the server closed (or reset) while it was idle, found before
+any bytes of a response came back. Losing the connection any other
+way, including timing out, raises a PipelineError, as the requests in
+flight may or may not have been processed.
+
+TLS connections share one SSLContext, and where Python supports it
+(3.6 and up), each resumes the previous connection's TLS session,
+skipping most of the handshake. As with socklusion's wrap_ssl,
+certificates aren't verified.
+"""
+
+import errno
+import socket
+
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_MAX_PIPELINE = 32
+READ_SIZE = 64 * 1024
+# errnos of a connection the server closed, as opposed to, e.g., a
+# timeout, which is a socket.error too, but with no errno
+CLOSED_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+class PipelineError(IOError):
+    """Raised when a connection is lost with requests in flight.
+    *responses* holds the responses received before then."""
+    def __init__(self, message, responses):
+        super(PipelineError, self).__init__(message)
+        self.responses = responses
+
+
+class _ConnectionClosed(Exception):
+    pass
+
+
+class PersistentConnection(object):
+    def __init__(self, host, port=None, wrap_ssl=False,
+                 timeout=DEFAULT_TIMEOUT, max_pipeline=DEFAULT_MAX_PIPELINE):
+        self.host = host
+        self.port = port or (443 if wrap_ssl else 80)
+        self.wrap_ssl = wrap_ssl
+        self.timeout = timeout
+        self.max_pipeline = max(1, int(max_pipeline))
+
+        self.connect_count = 0
+        self.tls_resume_count = 0  # connections which resumed a session
+
+        self._sock = None
+        self._buf = b''
+        self._can_pipeline = False  # the server kept this connection alive
+        self._ssl_context = None
+        self._tls_session = None
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.wrap_ssl:
+            sock = self._wrap_ssl(sock)
+        self._sock, self._buf, self._can_pipeline = sock, b'', False
+        self.connect_count += 1
+
+    def _wrap_ssl(self, sock):
+        import ssl
+        if self._ssl_context is None:
+            protocol = getattr(ssl, 'PROTOCOL_TLS_CLIENT',
+                               ssl.PROTOCOL_SSLv23)
+            context = ssl.SSLContext(protocol)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            self._ssl_context = context
+        kwargs = {}
+        if self._tls_session is not None:
+            kwargs['session'] = self._tls_session
+        sock = self._ssl_context.wrap_socket(sock, server_hostname=self.host,
+                                             **kwargs)
+        if getattr(sock, 'session_reused', False):
+            self.tls_resume_count += 1
+        return sock
+
+    def close(self):
+        if self._sock is None:
+            return
+        # TLS 1.3 sends session tickets after the handshake, so the
+        # session is only saved once the connection has been used
+        self._tls_session = getattr(self._sock, 'session', None)
+        try:
+            self._sock.close()
+        except socket.error:
+            pass
+        self._sock, self._buf = None, b''
+
+    def _recv(self):
+        data = self._sock.recv(READ_SIZE)
+        if not data:
+            raise _ConnectionClosed()
+        self._buf += data
+
+    def _read_until(self, terminator):
+        while True:
+            index = self._buf.find(terminator)
+            if index >= 0:
+                ret = self._buf[:index]
+                self._buf = self._buf[index + len(terminator):]
+                return ret
+            self._recv()
+
+    def _read_exact(self, size):
+        while len(self._buf) < size:
+            self._recv()
+        ret, self._buf = self._buf[:size], self._buf[size:]
+        return ret
+
+    def _read_to_close(self):
+        while True:
+            try:
+                self._recv()
+            except _ConnectionClosed:
+                break
+        ret, self._buf = self._buf, b''
+        return ret
+
+    def _read_response(self):
+        "Returns the next response's status, body, and keep-alive."
+        lines = self._read_until(b'\r\n\r\n').split(b'\r\n')
+        version, status = lines[0].split(None, 2)[:2]
+        status = int(status)
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+        if status == 100:
+            return self._read_response()
+        connection = headers.get(b'connection', b'').lower()
+        if version == b'HTTP/1.1':
+            keep_alive = connection != b'close'
+        else:
+            keep_alive = connection == b'keep-alive'
+        if b'content-length' in headers:
+            body = self._read_exact(int(headers[b'content-length']))
+        else:
+            # chunked responses aren't supported, and responses without
+            # a length end with the connection
+            body = self._read_to_close()
+            keep_alive = False
+        return status, body, keep_alive
+
+    def _build_request(self, path, body, content_type, content_encoding):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        head = ['POST %s HTTP/1.1' % path,
+                'Host: %s' % self.host,
+                'Content-Type: %s' % content_type]
+        if content_encoding:
+            head.append('Content-Encoding: %s' % content_encoding)
+        head.extend(['Content-Length: %d' % len(body), '', ''])
+        return '\r\n'.join(head).encode('utf-8') + body
+
+    def post_many(self, path, bodies, content_type='application/json',
+                  content_encoding=None):
+        """Posts each of *bodies* to *path*, pipelined, and returns
+        their responses, as (status, body) pairs, in order. The
+        connection is left open for the next call. *content_encoding*
+        labels bodies the caller has already encoded, e.g., 'gzip'."""
+        requests = [self._build_request(path, body, content_type,
+                                        content_encoding)
+                    for body in bodies]
+        responses = []
+        while len(responses) < len(requests):
+            responses.extend(self._post_pipelined(requests[len(responses):],
+                                                  responses))
+        return responses
+
+    def post(self, path, body, content_type='application/json',
+             content_encoding=None):
+        return self.post_many(path, [body], content_type,
+                              content_encoding)[0]
+
+    def _post_pipelined(self, requests, prev_responses):
+        # returns the responses to as many of *requests* as the
+        # connection lasts for, in order
+        reused = self._sock is not None
+        if not reused:
+            self._connect()
+        responses = []
+        written = 0
+        try:
+            while len(responses) < len(requests):
+                limit = self.max_pipeline if self._can_pipeline else 1
+                end = min(len(requests), len(responses) + limit)
+                if written < end:
+                    self._sock.sendall(b''.join(requests[written:end]))
+                    written = end
+                status, body, keep_alive = self._read_response()
+                responses.append((status, body))
+                if not keep_alive:
+                    self.close()  # the rest are sent on a new connection
+                    break
+                self._can_pipeline = True
+        except (socket.error, _ConnectionClosed) as e:
+            got_bytes = bool(self._buf)
+            self.close()
+            closed = (isinstance(e, _ConnectionClosed)
+                      or getattr(e, 'errno', None) in CLOSED_ERRNOS)
+            if reused and closed and not responses and not got_bytes:
+                return []  # closed while idle, sent on a new connection
+            if isinstance(e, _ConnectionClosed):
+                e = 'connection closed by server'
+            raise PipelineError('%s, with %d of %d requests answered'
+                                % (e, len(responses), written),
+                                prev_responses + responses)
+        return responses
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Decoding of compressed request bodies, per their Content-Encoding.
+Shared by the app's RequestDataMiddleware and the IngestServer, so
+/v1/on_import and /v1/on_import_batch take compressed bodies on both
+the app's port and the ingest port.
+
+Clients may gzip import bodies (see client/collect.py), which shrinks
+batches of similar records several times over. Decompressed sizes are
+capped, as a small gzip body can expand to gigabytes.
+"""
+
+import zlib
+
+DEFAULT_MAX_DECODED_SIZE = 16 * 1024 * 1024
+GZIP_ENCODINGS = ('gzip', 'x-gzip')
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+class DecodedTooLarge(ValueError):
+    pass
+
+
+def decode_body(data, content_encoding,
+                max_size=DEFAULT_MAX_DECODED_SIZE):
+    """Returns the bytes *data*, decoded per *content_encoding*, the
+    value of the Content-Encoding header, if any. Raises
+    UnsupportedEncoding for encodings other than gzip, DecodedTooLarge
+    if the decoded body would exceed *max_size* bytes, and ValueError
+    for corrupt data."""
+    encoding = (content_encoding or '').strip().lower()
+    if not encoding or encoding == 'identity':
+        return data
+    if encoding not in GZIP_ENCODINGS:
+        raise UnsupportedEncoding('unsupported content encoding: %s'
+                                  % content_encoding)
+    # as boltons.strutils.gunzip_bytes(), but with the output bounded
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        ret = decompressor.decompress(data, max_size + 1)
+    except zlib.error as ze:
+        raise ValueError('invalid gzip body: %s' % ze)
+    if len(ret) > max_size:
+        raise DecodedTooLarge('decoded body exceeds %s bytes' % max_size)
+    if not _is_complete(decompressor):
+        raise ValueError('invalid gzip body: truncated')
+    return ret
+
+
+def _is_complete(decompressor):
+    # whether the gzip stream ended, trailer and all, its CRC checked
+    if hasattr(decompressor, 'eof'):  # Python 3.3+
+        return decompressor.eof
+    # on Python 2, input after the end of the stream is left in
+    # unused_data, while a truncated stream goes on consuming it
+    if decompressor.unused_data:
+        return True
+    try:
+        decompressor.decompress(b'\0', 1)
+    except zlib.error:
+        return False
+    return bool(decompressor.unused_data)
@@ -1,2 +1,4 @@
 
 from line_dal import LineDAL
+from sqlite_dal import SQLiteDAL
+from columnar_dal import ColumnarDAL
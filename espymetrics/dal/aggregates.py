@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""Aggregates over records, shared by the DALs.
+
+``GroupCount`` is a single group-by count, the building block of
+``select_records``. ``GroupCounters`` is a set of GroupCounts for
+registered group-by paths, materialized as records are written, so
+that dashboards polling the same paths all day don't rescan the store
+on every request. GroupCounters are snapshotted to disk alongside the
+store, and the snapshot notes how many lines it covers, so the owning
+DAL can catch it up after a restart.
+
+``GroupRollup`` splits a group-by count by the hour of each record's
+``server_time``, so that counts over time ranges, per hour or per day,
+don't rescan the store either. GroupCounters keep a rollup for each
+registered path. So that they don't grow by the hour forever, hours
+more than ROLLUP_HOURS_KEPT behind the latest are compacted into
+their days, and ranges reaching back that far are rounded out to
+whole days.
+
+``ApproxGroupCount`` is a group-by count in bounded memory, for paths
+with too many distinct values to count exactly. See dal/sketches.py.
+"""
+
+import os
+import json
+import datetime
+from collections import Counter
+
+from paths import parse_group_by, parse_path, format_key, MISSING
+from sketches import HyperLogLog, SpaceSaving
+
+TIME_PATH = 'server_time'
+HOUR_FORMAT = '%Y-%m-%d %H'
+APPROX_TOP_COUNT = 100  # most frequent keys reported by approx counts
+# buckets are prefixes of hour keys, e.g., '2016-04-20' of '2016-04-20 09'
+BUCKET_LENGTHS = {'hour': len('YYYY-MM-DD HH'), 'day': len('YYYY-MM-DD')}
+ROLLUP_HOURS_KEPT = 7 * 24  # by the hour, before compaction into days
+
+_get_time = parse_path(TIME_PATH)
+
+
+class GroupCount(object):
+    """Counts of string keys, the common case, are kept by raw value,
+    and only formatted when results are requested, so counting them
+    doesn't allocate a string per record. Other keys are counted by
+    their formatted string, as values like True and 1, or -8 and -8.0,
+    are equal, but formatted differently."""
+    def __init__(self, group_by, counts=None, error_count=0):
+        self.group_by = group_by
+        self._get_key = parse_group_by(group_by)
+        self.counts = Counter(counts or {})
+        self.error_count = error_count
+
+    def add(self, record):
+        self.add_key(self._get_key(record))
+
+    def add_key(self, key_val, count=1):
+        """Count a key already extracted from a record, or MISSING, once,
+        or *count* times, for stores which count keys themselves."""
+        if key_val is MISSING:
+            self.error_count += count
+            return
+        if not isinstance(key_val, basestring):
+            key_val = format_key(key_val)
+        self.counts[key_val] += count
+
+    def copy(self):
+        return GroupCount(self.group_by, self.counts, self.error_count)
+
+    def update(self, other):
+        "Add the counts of *other*, a GroupCount of the same group-by."
+        self.counts.update(other.counts)
+        self.error_count += other.error_count
+
+    @property
+    def record_count(self):
+        "Records counted, whether or not they had a key."
+        return sum(self.counts.values()) + self.error_count
+
+    def get_formatted_counts(self):
+        ret = Counter()
+        for key_val, count in self.counts.items():
+            ret[format_key(key_val)] += count
+        return ret
+
+    def to_result(self, record_count):
+        # records with no key at all are still counted, as misses
+        if not record_count:
+            return {'record_count': 0}  # no records yet
+        counts = self.get_formatted_counts()
+        ret = {'counts': counts,
+               'grouped_key_count': len(counts),
+               'record_count': record_count,
+               'grouped_by': self.group_by}
+        if self.error_count:
+            ret['error_count'] = self.error_count
+        return ret
+
+
+def get_hour(server_time):
+    """Returns the hour key ('YYYY-MM-DD HH') of a server_time string,
+    as written by the app, or MISSING."""
+    if not isinstance(server_time, basestring) or len(server_time) < 13 \
+            or server_time[4] != '-' or server_time[10] != ' ':
+        return MISSING
+    return server_time[:13]
+
+
+def get_record_hour(record):
+    return get_hour(_get_time(record))
+
+
+def check_bucket(bucket):
+    if bucket is not None and bucket not in BUCKET_LENGTHS:
+        raise ValueError('expected bucket to be one of %r, not %r'
+                         % (sorted(BUCKET_LENGTHS), bucket))
+
+
+def timestamp_to_hour(timestamp, round_up=False):
+    """Returns the hour key of a UTC Unix *timestamp*, rounded down to
+    the start of its hour, or up to the start of the next one."""
+    if round_up:
+        timestamp = -(-timestamp // 3600) * 3600
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime(HOUR_FORMAT)
+
+
+class GroupRollup(object):
+    """GroupCounts for one group-by, one per hour. Records without a
+    server_time aren't counted. Hours more than *hours_kept* behind the
+    latest are merged into a GroupCount for their day, keyed by the
+    day ('YYYY-MM-DD'). With no *hours_kept*, every hour is kept."""
+    def __init__(self, group_by, hours=None, hours_kept=ROLLUP_HOURS_KEPT):
+        self.group_by = group_by
+        self.hours_kept = hours_kept
+        self._get_key = parse_group_by(group_by)
+        self.hours = hours or {}  # hour or day key -> GroupCount
+
+    def add(self, record):
+        self.add_key(get_record_hour(record), self._get_key(record))
+
+    def add_key(self, hour, key_val):
+        if hour is MISSING:
+            return
+        try:
+            group_count = self.hours[hour]
+        except KeyError:
+            group_count = self.hours[hour] = GroupCount(self.group_by)
+            if self.hours_kept:
+                self._compact(hour)
+        group_count.add_key(key_val)
+
+    def _compact(self, latest_hour):
+        try:
+            latest = datetime.datetime.strptime(latest_hour, HOUR_FORMAT)
+        except ValueError:
+            return
+        cutoff = latest - datetime.timedelta(hours=self.hours_kept)
+        cutoff = cutoff.strftime(HOUR_FORMAT)
+        day_len = BUCKET_LENGTHS['day']
+        old_hours = [key for key in self.hours
+                     if len(key) > day_len and key < cutoff]
+        if not old_hours:
+            return
+        # merged into a copy, which replaces the dict whole, so that
+        # readers never see an hour both on its own and in its day
+        hours = dict(self.hours)
+        for hour in old_hours:
+            group_count = hours.pop(hour)
+            day = hour[:day_len]
+            if day in hours:
+                merged = hours[day].copy()
+                merged.update(group_count)
+                group_count = merged
+            hours[day] = group_count
+        self.hours = hours
+
+    def get_result(self, start=None, stop=None, bucket=None):
+        """Returns counts for the hours from *start* up to but not
+        including *stop*, both hour keys. Without a *bucket*, the
+        result is shaped like select_records()'s. Otherwise, it has a
+        result per 'hour' or 'day', under 'buckets'."""
+        check_bucket(bucket)
+        bucket_len = BUCKET_LENGTHS.get(bucket)
+        merged = {}
+        for hour, group_count in self.hours.items():
+            first = last = hour
+            if len(hour) == BUCKET_LENGTHS['day']:
+                # a compacted day counts whole, if the range overlaps it
+                first, last = hour + ' 00', hour + ' 23'
+            if (start and last < start) or (stop and first >= stop):
+                continue
+            bucket_key = hour[:bucket_len] if bucket_len else None
+            try:
+                target = merged[bucket_key]
+            except KeyError:
+                target = merged[bucket_key] = GroupCount(self.group_by)
+            # copied first, as the current hour may be counting
+            target.counts.update(dict(group_count.counts))
+            target.error_count += group_count.error_count
+
+        if bucket is None:
+            group_count = merged.get(None, GroupCount(self.group_by))
+            return group_count.to_result(group_count.record_count)
+        buckets = dict([(bucket_key, gc.to_result(gc.record_count))
+                        for bucket_key, gc in merged.items()])
+        return {'buckets': buckets,
+                'bucket': bucket,
+                'grouped_by': self.group_by,
+                'record_count': sum([gc.record_count
+                                     for gc in merged.values()])}
+
+    def get_state(self):
+        return dict([(hour, {'counts': gc.get_formatted_counts(),
+                             'error_count': gc.error_count})
+                     for hour, gc in self.hours.items()])
+
+    @classmethod
+    def from_state(cls, group_by, state):
+        hours = dict([(hour, GroupCount(group_by,
+                                        counts=gc_state['counts'],
+                                        error_count=gc_state['error_count']))
+                      for hour, gc_state in state.items()])
+        return cls(group_by, hours)
+
+
+class ApproxGroupCount(object):
+    """Estimates the number of distinct keys, and counts the most
+    frequent ones, in a fixed amount of memory."""
+    def __init__(self, group_by, distinct=None, top=None, error_count=0):
+        self.group_by = group_by
+        self._get_key = parse_group_by(group_by)
+        self.distinct = distinct or HyperLogLog()
+        self.top = top or SpaceSaving()
+        self.error_count = error_count
+        self.key_count = 0  # records with a key
+
+    def add(self, record):
+        self.add_key(self._get_key(record))
+
+    def add_key(self, key_val):
+        if key_val is MISSING:
+            self.error_count += 1
+            return
+        key = format_key(key_val)
+        self.key_count += 1
+        self.distinct.add(key)
+        self.top.add(key)
+
+    def to_result(self, record_count):
+        if not record_count:
+            return {'record_count': 0}  # no records yet
+        top = self.top.get_top(APPROX_TOP_COUNT)
+        ret = {'counts': dict([(key, count) for key, count, _ in top]),
+               'count_errors': dict([(key, error)
+                                     for key, count, error in top]),
+               'grouped_key_count': self.distinct.estimate(),
+               'grouped_key_count_error': self.distinct.std_error,
+               'record_count': record_count,
+               'grouped_by': self.group_by,
+               'approx': True}
+        if self.error_count:
+            ret['error_count'] = self.error_count
+        return ret
+
+    def get_state(self):
+        return {'distinct': self.distinct.get_state(),
+                'top': self.top.get_state(),
+                'error_count': self.error_count,
+                'key_count': self.key_count}
+
+    @classmethod
+    def from_state(cls, group_by, state):
+        ret = cls(group_by,
+                  distinct=HyperLogLog.from_state(state['distinct']),
+                  top=SpaceSaving.from_state(state['top']),
+                  error_count=state['error_count'])
+        ret.key_count = state['key_count']
+        return ret
+
+
+class GroupCounters(object):
+    def __init__(self):
+        self.line_count = 0  # how many lines of the store are counted
+        self.group_counts = {}
+        self.rollups = {}
+        self.approx_counts = {}
+
+    @classmethod
+    def from_path(cls, counters_path):
+        ret = cls()
+        try:
+            with open(counters_path, 'rb') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return ret
+        ret.line_count = state['line_count']
+        rollup_states = state.get('rollups', {})
+        for group_by, gc_state in state['group_counts'].items():
+            if group_by not in rollup_states:
+                continue  # from before rollups, so rebuild both
+            gc = GroupCount(group_by,
+                            counts=gc_state['counts'],
+                            error_count=gc_state['error_count'])
+            ret.group_counts[group_by] = gc
+            ret.rollups[group_by] = GroupRollup.from_state(
+                group_by, rollup_states[group_by])
+        for group_by, ac_state in state.get('approx_counts', {}).items():
+            ret.approx_counts[group_by] = ApproxGroupCount.from_state(
+                group_by, ac_state)
+        return ret
+
+    def get_state(self):
+        """Returns a snapshot of the counters, which shares nothing with
+        them, to be saved with save_state(), e.g., after releasing the
+        lock held while counting."""
+        gc_states = dict([(gb, {'counts': gc.get_formatted_counts(),
+                                'error_count': gc.error_count})
+                          for gb, gc in self.group_counts.items()])
+        rollup_states = dict([(gb, rollup.get_state())
+                              for gb, rollup in self.rollups.items()])
+        ac_states = dict([(gb, ac.get_state())
+                          for gb, ac in self.approx_counts.items()])
+        return {'line_count': self.line_count,
+                'group_counts': gc_states,
+                'rollups': rollup_states,
+                'approx_counts': ac_states}
+
+    @staticmethod
+    def save_state(counters_path, state):
+        tmp_path = counters_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(state))  # dumps() encodes in C, dump() doesn't
+        os.rename(tmp_path, counters_path)
+        return
+
+    def save(self, counters_path):
+        self.save_state(counters_path, self.get_state())
+
+    def reset(self):
+        self.line_count = 0
+        for group_by in list(self.group_counts):
+            self.group_counts[group_by] = GroupCount(group_by)
+            self.rollups[group_by] = GroupRollup(group_by)
+        for group_by in list(self.approx_counts):
+            self.approx_counts[group_by] = ApproxGroupCount(group_by)
+
+    def __contains__(self, group_by):
+        return group_by in self.group_counts
+
+    def set_group_count(self, group_count, rollup=None):
+        group_by = group_count.group_by
+        self.group_counts[group_by] = group_count
+        self.rollups[group_by] = rollup or GroupRollup(group_by)
+
+    def has_approx_count(self, group_by):
+        return group_by in self.approx_counts
+
+    def set_approx_count(self, approx_count):
+        self.approx_counts[approx_count.group_by] = approx_count
+
+    def add_record(self, record):
+        hour = get_record_hour(record)
+        for group_by, gc in self.group_counts.items():
+            key_val = gc._get_key(record)
+            gc.add_key(key_val)
+            self.rollups[group_by].add_key(hour, key_val)
+        for ac in self.approx_counts.values():
+            ac.add(record)
+        self.line_count += 1
+
+    def get_result(self, group_by):
+        return self.group_counts[group_by].to_result(self.line_count)
+
+    def get_rollup_result(self, group_by, start=None, stop=None,
+                          bucket=None):
+        return self.rollups[group_by].get_result(start, stop, bucket)
+
+    def get_approx_result(self, group_by):
+        return self.approx_counts[group_by].to_result(self.line_count)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""The BatchWriter wraps a DAL to provide group-committed writes.
+
+Records are put on a bounded in-memory queue, which is drained by a
+single writer thread. The writer takes every record waiting in the
+queue, up to a maximum batch size and gathering time, then hands the
+whole batch to the DAL's add_records() and flushes once. Records that
+arrive while one batch is being written form the next, so under load
+N writes and N flushes (or N transactions) become one, while a lone
+record is written without delay.
+
+Durability is configurable:
+
+* ``'flush'`` - add_record() returns after the record's batch has been
+  written and flushed. Errors are raised to the caller. A record which
+  can't be written only fails its own caller, as the rest of its batch
+  is then written without it.
+* ``'enqueue'`` - add_record() returns as soon as the record is
+  queued. Faster, but a crash can lose queued records, and write errors
+  are only counted.
+
+If the queue is full, add_record() blocks until the writer catches up.
+
+add_record_async() takes a callback instead of blocking, for event
+loops (see ingest_server.py). The callback is called with None, or
+the write error, once the record is acknowledged per the durability
+mode. It runs on the writer thread, so it should only hand the result
+back to the caller's thread. If the queue is full, add_record_async()
+raises Queue.Full instead of blocking, and the callback isn't called.
+
+Reads (select_records(), etc.) pass through to the wrapped DAL, and
+do not see records that are still queued.
+"""
+
+import time
+import Queue
+import threading
+
+
+ACK_FLUSH = 'flush'
+ACK_ENQUEUE = 'enqueue'
+DURABILITY_MODES = (ACK_FLUSH, ACK_ENQUEUE)
+
+DEFAULT_DURABILITY = ACK_FLUSH
+DEFAULT_MAX_BATCH_SIZE = 500
+DEFAULT_MAX_DELAY = 0.05  # max seconds spent gathering one batch
+DEFAULT_MAX_QUEUE_SIZE = 10000
+
+_STOP = object()
+
+
+class _Ack(object):
+    def __init__(self, callback=None):
+        self.done = threading.Event()
+        self.error = None
+        self.callback = callback
+
+    def set(self, error=None):
+        self.error = error
+        self.done.set()
+        if self.callback is not None:
+            self.callback(error)
+
+
+class BatchWriter(object):
+    def __init__(self, data_store,
+                 durability=DEFAULT_DURABILITY,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 max_delay=DEFAULT_MAX_DELAY,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE):
+        if durability not in DURABILITY_MODES:
+            raise ValueError('expected durability to be one of %r, not %r'
+                             % (DURABILITY_MODES, durability))
+        self.data_store = data_store
+        self.durability = durability
+        self.max_batch_size = int(max_batch_size)
+        self.max_delay = float(max_delay)
+
+        self.batch_count = 0
+        self.record_count = 0
+        self.error_count = 0
+
+        self._queue = Queue.Queue(maxsize=int(max_queue_size))
+        self._thread = threading.Thread(target=self._run,
+                                        name='BatchWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __getattr__(self, name):
+        # reads and other DAL attributes go straight to the DAL
+        return getattr(self.data_store, name)
+
+    def add_record(self, indict):
+        if self.durability == ACK_ENQUEUE:
+            self._queue.put((indict, None))
+            return
+        ack = _Ack()
+        self._queue.put((indict, ack))
+        ack.done.wait()
+        if ack.error is not None:
+            raise ack.error
+        return
+
+    def add_record_async(self, indict, callback):
+        if self.durability == ACK_ENQUEUE:
+            self._queue.put_nowait((indict, None))
+            callback(None)
+            return
+        self._queue.put_nowait((indict, _Ack(callback)))
+        return
+
+    def add_records(self, records):
+        # a batch from the caller is a batch for the DAL, no need to queue
+        self.data_store.add_records(records)
+        self.data_store.flush()
+
+    def close(self):
+        self._queue.put((_STOP, None))
+        self._thread.join()
+        self.data_store.close()
+
+    def _get_batch(self):
+        # block for the first record, then take whatever else is
+        # already waiting, up to the size and time limits. records
+        # queued while a batch is being written make up the next batch.
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            if batch[-1][0] is _STOP or time.time() > deadline:
+                break
+            try:
+                batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            stopping = batch[-1][0] is _STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                self._write_batch(batch)
+            if stopping:
+                return
+
+    def _write_batch(self, batch):
+        try:
+            self.data_store.add_records([record for record, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                self._ack_batch(batch, e)
+                return
+            # the DALs encode a batch before writing any of it, so a
+            # bad record fails the batch unwritten. the records are
+            # written one at a time instead, so only the bad record's
+            # caller gets the error.
+            for item in batch:
+                self._write_batch([item])
+            return
+        try:
+            self.data_store.flush()
+        except Exception as e:
+            self._ack_batch(batch, e)
+            return
+        self._ack_batch(batch)
+        return
+
+    def _ack_batch(self, batch, error=None):
+        if error is None:
+            self.batch_count += 1
+            self.record_count += len(batch)
+        else:
+            self.error_count += len(batch)
+        for _, ack in batch:
+            if ack is not None:
+                ack.set(error)
+        return
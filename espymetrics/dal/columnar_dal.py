@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""The columnar DAL stores each field of the flattened message schema
+(see flatten_fields() in dal/sqlite_dal.py) in its own file of packed,
+fixed-width values, in a directory of your choosing:
+
+* Strings are dictionary-encoded. Each distinct value is stored once,
+  in ``<column>.dict`` (one JSON value per line), and records store
+  4-byte codes in ``<column>.col``.
+* Booleans are stored as signed bytes, integers as 8-byte longs, and
+  floats as doubles.
+
+Each column has a reserved null value, used when a record's field is
+missing, null, of the wrong type, or an integer too large to store.
+Nulls count as misses in group-bys.
+
+Group-bys may also name an object or array of the schema, like
+python, in which case its value is put back together from the columns
+under it, leaving out the nulls.
+
+Group-by counts only read the columns involved, in one pass over a
+memory map of each file. If numpy is installed, the count itself is
+vectorized; otherwise, it's a Counter over an array. Either way, no
+records are decoded. "The most recent N records" is the tail of the
+column.
+
+The drawbacks are that only fields in the message prototype are
+stored, and that records can't be exported as they were received.
+"""
+
+import os
+import sys
+import json
+import mmap
+import threading
+from array import array
+from collections import Counter
+
+from boltons.iterutils import get_path, PathAccessError
+
+from paths import GROUP_BY_SEP
+from sqlite_dal import flatten_fields, get_container_fields, get_group_key
+from aggregates import GroupCount
+from environments import EnvironmentTable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_STR, _BOOL, _INT, _FLOAT = 'str', 'bool', 'int', 'float'
+_TYPECODES = {_STR: 'I', _BOOL: 'b', _INT: 'l', _FLOAT: 'd'}
+_NULLS = {_STR: 0, _BOOL: -1, _INT: -sys.maxint - 1, _FLOAT: float('nan')}
+
+
+def _get_kind(value):
+    if isinstance(value, bool):
+        return _BOOL
+    elif isinstance(value, (int, long)):
+        return _INT
+    elif isinstance(value, float):
+        return _FLOAT
+    return _STR
+
+
+class Column(object):
+    def __init__(self, dir_path, name, kind):
+        self.name = name
+        self.kind = kind
+        self.typecode = _TYPECODES[kind]
+        self.null = _NULLS[kind]
+        self.itemsize = array(self.typecode).itemsize
+        self._max_int = (1 << (8 * self.itemsize - 1)) - 1
+        self.path = os.path.join(dir_path, name + '.col')
+        self.dict_path = os.path.join(dir_path, name + '.dict')
+
+        self._values = [None]  # code 0 is null
+        self._codes = {}
+        if self.kind == _STR:
+            self._load_dict()
+            self._dict_fh = open(self.dict_path, 'ab')
+        self._fh = open(self.path, 'ab')
+
+    def _load_dict(self):
+        good_size = 0
+        try:
+            with open(self.dict_path, 'r+b') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        f.truncate(good_size)  # partial trailing write
+                        break
+                    self._add_value(json.loads(line))
+                    good_size += len(line)
+        except IOError:
+            pass  # new column
+
+    def _add_value(self, value):
+        code = self._codes[value] = len(self._values)
+        self._values.append(value)
+        return code
+
+    @property
+    def row_count(self):
+        return os.path.getsize(self.path) // self.itemsize
+
+    def truncate(self, row_count):
+        self._fh.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(row_count * self.itemsize)
+        self._fh = open(self.path, 'ab')
+
+    def encode(self, value):
+        kind = self.kind
+        if value is None:
+            return self.null
+        if kind == _STR:
+            if not isinstance(value, basestring):
+                value = unicode(value)
+            try:
+                return self._codes[value]
+            except KeyError:
+                code = self._add_value(value)
+                self._dict_fh.write(json.dumps(value) + '\n')
+                return code
+        elif kind == _BOOL:
+            if isinstance(value, bool):
+                return int(value)
+        elif kind == _INT:
+            if isinstance(value, (int, long)) and not isinstance(value, bool):
+                if -self._max_int <= value <= self._max_int:
+                    return value
+        elif kind == _FLOAT:
+            if isinstance(value, (int, long, float)):
+                try:
+                    return float(value)
+                except OverflowError:
+                    pass
+        return self.null
+
+    def decode(self, raw_value):
+        if self.kind == _STR:
+            return self._values[raw_value]
+        elif self.kind == _BOOL:
+            return bool(raw_value)
+        return raw_value
+
+    def is_null(self, raw_value):
+        if self.kind == _FLOAT:
+            return raw_value != raw_value  # NaN
+        return raw_value == self.null
+
+    def encode_all(self, values):
+        return array(self.typecode, [self.encode(v) for v in values])
+
+    def append(self, encoded):
+        "Appends an array returned by encode_all()."
+        encoded.tofile(self._fh)
+
+    def flush(self):
+        if self.kind == _STR:
+            self._dict_fh.flush()  # codes must never precede their values
+        self._fh.flush()
+
+    def close(self):
+        if self.kind == _STR:
+            self._dict_fh.close()
+        self._fh.close()
+
+    def read_raw(self, start_row, stop_row):
+        """Returns a sequence of the raw (encoded) values in a range of
+        rows, read through a memory map."""
+        if numpy is not None:
+            return numpy.memmap(self.path, dtype=self.typecode, mode='r',
+                                offset=start_row * self.itemsize,
+                                shape=(stop_row - start_row,))
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                ret = array(self.typecode)
+                ret.fromstring(mm[start_row * self.itemsize:
+                                  stop_row * self.itemsize])
+            finally:
+                mm.close()
+        return ret
+
+    def count_raw(self, start_row, stop_row):
+        "Returns a Counter of raw values in a range of rows."
+        if stop_row <= start_row:
+            return Counter()
+        data = self.read_raw(start_row, stop_row)
+        if numpy is None:
+            return Counter(data)
+        if self.kind == _STR:
+            counts = numpy.bincount(data)
+            nonzero = numpy.flatnonzero(counts)
+            return Counter(dict(zip(nonzero.tolist(),
+                                    counts[nonzero].tolist())))
+        uniques, counts = numpy.unique(data, return_counts=True)
+        return Counter(dict(zip(uniques.tolist(), counts.tolist())))
+
+
+class ColumnarDAL(object):
+    _extension = '.cols'
+    _environments_extension = '.envs'
+
+    def __init__(self, file_path, message_proto, group_by_paths=()):
+        # group_by_paths is accepted for parity with the other DALs, but
+        # every column is equally fast to group by
+        self.file_path = file_path
+        self.message_proto = message_proto
+        self._flat_fields = flatten_fields(message_proto)
+        # environments are stored in full with each record, and only
+        # kept here for expanding records sent with just an env_id
+        self.environments = EnvironmentTable(file_path
+                                             + self._environments_extension)
+        if not os.path.isdir(file_path):
+            os.makedirs(file_path)
+
+        self._write_lock = threading.Lock()
+        self._columns = {}
+        for path, name, _ in self._flat_fields:
+            kind = _get_kind(get_path(message_proto, path))
+            self._columns[name] = Column(file_path, name, kind)
+        # the columns under each object and array, with their paths
+        # relative to it, for group-bys which name one
+        self._container_columns = {}
+        for prefix, fields in \
+                get_container_fields(self._flat_fields).items():
+            self._container_columns[prefix] = [
+                (path, self._columns[name]) for path, name in fields]
+
+        # repair any partially-written batch, so all columns line up
+        self.total_count = min([c.row_count for c in self._columns.values()])
+        for column in self._columns.values():
+            if column.row_count != self.total_count:
+                column.truncate(self.total_count)
+
+    def add_record(self, in_dict):
+        self.add_records([in_dict])
+
+    def add_records(self, in_dicts):
+        with self._write_lock:
+            # every column is encoded before any is appended to, so
+            # that an error can't leave the columns misaligned
+            encoded = []
+            for path, name, _ in self._flat_fields:
+                values = []
+                for in_dict in in_dicts:
+                    try:
+                        values.append(get_path(in_dict, path))
+                    except PathAccessError:
+                        values.append(None)
+                column = self._columns[name]
+                encoded.append((column, column.encode_all(values)))
+            for column, column_encoded in encoded:
+                column.append(column_encoded)
+            self.flush()
+            self.total_count += len(in_dicts)
+        return
+
+    def flush(self):
+        for column in self._columns.values():
+            column.flush()
+
+    def close(self):
+        with self._write_lock:
+            for column in self._columns.values():
+                column.close()
+
+    @property
+    def write_generation(self):
+        "Changes whenever records are added. See dal/query_cache.py."
+        return self.total_count
+
+    def raw_query(self, query):
+        raise NotImplementedError('columnar DAL does not support raw queries')
+
+    def open_export(self, start=None, stop=None):
+        raise ValueError('the columnar DAL does not support exports')
+
+    def _count_raw(self, columns, start_row, stop_row):
+        if len(columns) == 1:
+            return dict([((raw_value,), count) for raw_value, count
+                         in columns[0].count_raw(start_row, stop_row).items()])
+        if stop_row <= start_row:
+            return {}
+        datas = [c.read_raw(start_row, stop_row) for c in columns]
+        if numpy is not None:
+            datas = [data.tolist() for data in datas]
+        return Counter(zip(*datas))
+
+    def _get_group_columns(self, name):
+        # a list of (relative path, column) pairs, where the path of a
+        # field's own column is empty, or None if there's no such path
+        if name in self._columns:
+            return [((), self._columns[name])]
+        return self._container_columns.get(name)
+
+    def select_records(self, limit=None, group_by=None):
+        names = group_by.split(GROUP_BY_SEP) if group_by else []
+        groups = [self._get_group_columns(name.strip()) for name in names]
+        stop_row = self.total_count
+        start_row = max(stop_row - limit, 0) if limit else 0
+        if not groups or None in groups:
+            # like a path missing from every record, every row is a miss
+            row_count = stop_row - start_row
+            return GroupCount(group_by,
+                              error_count=row_count).to_result(row_count)
+        columns = [column for group in groups for _, column in group]
+
+        group_count = GroupCount(group_by)
+        raw_counts = self._count_raw(columns, start_row, stop_row)
+        for raw_key, count in raw_counts.items():
+            values = [None if c.is_null(v) else c.decode(v)
+                      for c, v in zip(columns, raw_key)]
+            group_count.add_key(get_group_key(groups, values), count)
+        return group_count.to_result(stop_row - start_row)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Deduplicated host environments: the parts of a record which only
+change with the host or the interpreter, like uname, linux_dist, and
+the Python build info, stored once instead of in every record.
+
+An environment is identified by its env_id, a hash of its canonical
+JSON encoding (see get_env_id()). The client computes the same hash,
+and once the server has acknowledged an env_id, sends records with the
+env_id in place of the environment fields (see client/collect.py).
+
+Records are stored with their env_id and dynamic fields, and the
+environment fields are filled back in from the EnvironmentTable as
+records are read. Records stored before, or sent without an env_id,
+are left as they are.
+
+The table is a JSON Lines file which is only appended to, one line per
+environment. Every process which ingests records may append to it, so
+each line is added with a single write to a file opened for appending.
+Readers pick up other processes' additions when looking up an env_id
+they don't know yet.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+from boltons.cacheutils import LRU
+
+import jsoncodec
+
+ENV_ID_KEY = 'env_id'
+# top-level fields which make up the environment, and subfields of
+# them which vary between runs, and so stay with the record
+ENV_FIELDS = ('uname', 'linux_dist', 'python')
+RECORD_SUBFIELDS = {'python': ('argv',)}
+ID_CACHE_SIZE = 1024
+
+
+def is_env_path(accessor):
+    "Whether the parsed path *accessor* may point into an environment."
+    return bool(accessor) and accessor[0] in ENV_FIELDS
+
+
+def is_split_path(accessor):
+    """Whether the parsed path *accessor* starts at a field which is
+    split between the record and its environment, like python, whose
+    argv stays with the record."""
+    return bool(accessor) and accessor[0] in RECORD_SUBFIELDS
+
+
+def get_env_id(env):
+    """Returns the env_id of *env*. Always hashed with the standard
+    library's json, as the client does, whatever the JSON backend."""
+    encoded = json.dumps(env, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()[:20]
+
+
+def split_environment(record):
+    """Returns an (env, rest) pair: a dict of the environment fields of
+    *record*, and a copy of *record* without them. env is empty if
+    *record* has none."""
+    env, rest = {}, dict(record)
+    for field in ENV_FIELDS:
+        if field not in rest:
+            continue
+        value = rest.pop(field)
+        keep = RECORD_SUBFIELDS.get(field)
+        if keep and isinstance(value, dict):
+            kept = dict([(k, value[k]) for k in keep if k in value])
+            if kept:
+                rest[field] = kept
+            value = dict([(k, v) for k, v in value.items() if k not in keep])
+            if not value:
+                continue
+        env[field] = value
+    return env, rest
+
+
+def expand_record(record, env):
+    "Returns a copy of *record* with the fields of *env* filled in."
+    ret = dict(record)
+    for field, value in env.items():
+        cur = ret.get(field)
+        if cur is None:
+            ret[field] = value
+        elif isinstance(cur, dict) and isinstance(value, dict):
+            ret[field] = dict(value, **cur)
+    return ret
+
+
+class EnvironmentTable(object):
+    def __init__(self, path):
+        self.path = path
+        self._envs = {}
+        self._size = 0  # bytes of the file loaded so far
+        self._id_cache = LRU(max_size=ID_CACHE_SIZE)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._load()
+
+    def __len__(self):
+        return len(self._envs)
+
+    def _load(self):
+        # only call with the lock held. reads complete lines appended
+        # since the last load.
+        try:
+            if os.path.getsize(self.path) <= self._size:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self._size)
+                data = f.read()
+        except (IOError, OSError):
+            return
+        data = data[:data.rfind(b'\n') + 1]
+        for line in data.splitlines():
+            try:
+                entry = json.loads(line)
+                self._envs[entry[ENV_ID_KEY]] = entry['env']
+            except (ValueError, KeyError, TypeError):
+                continue  # a line cut short by a crash
+        self._size += len(data)
+        return
+
+    def get(self, env_id):
+        "Returns the environment for *env_id*, or None if unknown."
+        try:
+            return self._envs[env_id]
+        except KeyError:
+            pass
+        except TypeError:
+            return None  # not a valid env_id
+        with self._lock:
+            self._load()
+        return self._envs.get(env_id)
+
+    def add(self, env):
+        """Stores *env*, if it isn't stored already, and returns its
+        env_id. The table is synced to disk before returning, so it
+        never lags behind the records which refer to it."""
+        # canonical encoding is slow with the standard library's json,
+        # so ids are cached by the JSON backend's faster encoding
+        key = jsoncodec.dumps(env)
+        env_id = self._id_cache.get(key)
+        if env_id is None:
+            env_id = self._id_cache[key] = get_env_id(env)
+        if env_id in self._envs:
+            return env_id
+        line = json.dumps({ENV_ID_KEY: env_id, 'env': env},
+                          sort_keys=True) + '\n'
+        with self._lock:
+            if env_id in self._envs:
+                return env_id
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+            try:
+                os.write(fd, line.encode('utf-8'))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._envs[env_id] = env
+        return env_id
+
+    def expand(self, record):
+        """Returns *record* with its environment filled in, if it was
+        stored with an env_id, or else *record* itself."""
+        env_id = record.get(ENV_ID_KEY)
+        if env_id is None:
+            return record
+        env = self.get(env_id)
+        if env is None:
+            return record
+        return expand_record(record, env)
+
+    def to_dict(self):
+        "Returns every known environment, by env_id."
+        with self._lock:
+            self._load()
+            return dict(self._envs)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""One place to encode and decode JSON, for the app and the DALs.
+
+The fastest installed backend is selected at import time: ujson, then
+simplejson, then the standard library's json. Set the
+ESPYMETRICS_JSON environment variable to a backend name, or call
+set_backend(), to choose one explicitly. All backends raise
+ValueError (or a subclass) on invalid input, and produce single-line,
+ASCII-safe output, so one store can be written by any of them.
+Records stored as sent (see EncodedRecord) keep the client's encoding,
+though, which may have raw UTF-8 instead of escapes, so stores are
+UTF-8, not ASCII.
+
+Records that arrive already encoded don't need to be encoded again
+before being appended to a JSON Lines store. The app wraps such
+records in an EncodedRecord, which carries its encoded form along
+with the decoded dict. See splice_field() for how fields added by
+the server are written into the encoded form.
+"""
+
+import os
+
+ENV_VAR = 'ESPYMETRICS_JSON'
+
+
+def _load_ujson():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return ujson.loads, dumps
+
+
+def _load_simplejson():
+    import simplejson
+    return simplejson.loads, simplejson.dumps
+
+
+def _load_stdlib():
+    import json
+    return json.loads, json.dumps
+
+
+BACKENDS = [('ujson', _load_ujson),
+            ('simplejson', _load_simplejson),
+            ('json', _load_stdlib)]
+
+backend_name = None
+loads = dumps = None
+
+
+def set_backend(name=None):
+    """Switch to the backend called *name*, or to the fastest one
+    available if *name* is None. Raises ValueError if the backend is
+    unknown or not installed."""
+    global backend_name, loads, dumps
+    for cur_name, load_backend in BACKENDS:
+        if name is not None and cur_name != name:
+            continue
+        try:
+            loads, dumps = load_backend()
+        except ImportError:
+            continue
+        backend_name = cur_name
+        return cur_name
+    raise ValueError('JSON backend not available: %r' % (name,))
+
+
+def get_available_backends():
+    ret = []
+    for name, load_backend in BACKENDS:
+        try:
+            load_backend()
+        except ImportError:
+            continue
+        ret.append(name)
+    return ret
+
+
+set_backend(os.getenv(ENV_VAR) or None)
+
+
+class EncodedRecord(dict):
+    """A record which remembers its JSON encoding. The encoded form is
+    not updated if the dict is modified after construction. It may
+    leave out the record's environment fields, in favor of its env_id
+    (see dal/environments.py), as the line DAL stores records."""
+    def __init__(self, record, encoded):
+        super(EncodedRecord, self).__init__(record)
+        self.encoded = encoded
+
+
+def encode_record(record):
+    "Returns the single-line JSON form of *record*, reusing it if known."
+    encoded = getattr(record, 'encoded', None)
+    if encoded is None:
+        encoded = dumps(record)
+    return encoded
+
+
+def splice_field(encoded, key, value):
+    """Returns *encoded*, the text of a valid JSON object, with *key*
+    set to *value*, without decoding or re-encoding the rest of the
+    object. The field is added last, so it takes precedence over any
+    existing field of the same name when decoded.
+
+    Newlines are only valid as whitespace between JSON tokens, so any
+    found are replaced with spaces, keeping the result on one line.
+    """
+    encoded = encoded.strip()
+    if '\n' in encoded or '\r' in encoded:
+        encoded = encoded.replace('\r', ' ').replace('\n', ' ')
+    field = dumps(key) + ': ' + dumps(value)
+    body = encoded[1:-1]
+    if body.strip():
+        return '{' + body + ', ' + field + '}'
+    return '{' + field + '}'
@@ -9,99 +9,653 @@ of query language, storage efficiency, and data load speeds.
 """
 
 
-import json
+import os
+import mmap
+import time
+import argparse
+import threading
 
-from collections import Counter
-from boltons import jsonutils
-
-_MISSING = object()
+import jsoncodec
+from line_index import LineIndex, DEFAULT_INDEX_INTERVAL
+from aggregates import (GroupCount, GroupCounters, GroupRollup,
+                        ApproxGroupCount, get_hour, check_bucket,
+                        timestamp_to_hour, TIME_PATH)
+from paths import MISSING
+from line_scanner import parse_line_group_by
+from environments import EnvironmentTable
+from parallel_scan import (create_pool, split_ranges, count_ranges,
+                           RANGES_PER_PROCESS)
+from segments import (SegmentManifest, open_segment, compress_segment,
+                      count_lines, GZIP_EXT, DEFAULT_COMPRESS_LEVEL)
 
 DEFAULT_FLUSH_INTERVAL = 1  # write to disk on every new record
-DEFAULT_SEP = '$'  # '$' is valid in sqlite column names without escaping
 
 
 class LineDAL(object):
+    """Segmented storage is off by default. Set *segment_size* (bytes)
+    and/or *segment_age* (seconds) to roll the active file over to a
+    sealed segment, which is gzip-compressed unless *compress_level* is
+    0. See dal/segments.py for details.
+
+    Set *scan_processes* above 1 to count unlimited group-bys that
+    aren't materialized in a pool of that many worker processes. See
+    dal/parallel_scan.py for details.
+
+    With *read_only*, the store is never written to, not even its
+    index, counters, or manifest, and reads pick up records added by
+    another process, the store's single writer. Counters for
+    group-bys the writer hasn't registered are kept in memory.
+
+    Records may be stored with an env_id in place of their environment
+    fields, which are kept once, in the *environments* table. Reads
+    fill them back in. See dal/environments.py."""
     _extension = '.jsonl'
+    _index_extension = '.idx'
+    _counters_extension = '.counts'
+    _manifest_extension = '.segments'
+    _environments_extension = '.envs'
 
-    def __init__(self, file_path, flush_interval=DEFAULT_FLUSH_INTERVAL):
+    def __init__(self, file_path, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 index_interval=DEFAULT_INDEX_INTERVAL, group_by_paths=(),
+                 segment_size=None, segment_age=None,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, scan_processes=1,
+                 approx_group_by_paths=(), read_only=False):
         self.file_path = file_path
+        self.read_only = read_only
         self.flush_interval = int(flush_interval)
+        self.index_path = file_path + self._index_extension
+        self.counters_path = file_path + self._counters_extension
+        self.manifest_path = file_path + self._manifest_extension
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.compress_level = compress_level
+        self._compress_threads = []
+        self.scan_processes = scan_processes
+        self._scan_pool = None
+        if scan_processes > 1:
+            # fork the workers early, before any of our threads start
+            self._scan_pool = create_pool(scan_processes)
+
+        self._write_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()  # for read-only stores
+        self._save_lock = threading.Lock()  # orders counter saves
+        self._saved_line_count = 0
+        self._manifest = SegmentManifest.from_path(self.manifest_path)
+        self._index = LineIndex.from_path(self.index_path,
+                                          interval=index_interval)
+        self._counters = GroupCounters.from_path(self.counters_path)
+        self.environments = EnvironmentTable(file_path
+                                             + self._environments_extension)
+        if read_only:
+            self._fh = None
+            self._manifest_ino = self._active_ino = None
+            with self._write_lock:
+                self._refresh()
+        else:
+            self._recover_segment()
+            self._fh = open(self.file_path, 'ab')
+            if self._index.catch_up(self.file_path):
+                self._index.save(self.index_path)
+        if not read_only and self._counters.line_count > self.total_count:
+            self._counters.reset()  # store was truncated or replaced
+        if self._catch_up_counters():
+            self._save_counters()
+        for group_by in group_by_paths:
+            self.register_group_by(group_by)
+        for group_by in approx_group_by_paths:
+            self.register_approx_group_by(group_by)
+        for segment in self._manifest.segments:
+            if not segment['name'].endswith(GZIP_EXT):
+                self._start_compression(segment)
+
+    @property
+    def total_count(self):
+        return self._manifest.line_count + self._index.line_count
+
+    def _get_segment_path(self, segment):
+        return os.path.join(os.path.dirname(self.file_path), segment['name'])
 
-        self._fh = open(self.file_path, 'a')
-        self.total_count = 0  # TODO: read number of existing lines in file?
+    def _recover_segment(self):
+        # adopt a segment whose rollover was interrupted before the
+        # manifest was saved
+        name = self._manifest.get_next_name(os.path.basename(self.file_path))
+        path = self._get_segment_path({'name': name})
+        if not os.path.exists(path):
+            return
+        line_count, byte_size = count_lines(path)
+        self._manifest.add_segment(name, line_count, byte_size)
+        self._manifest.save(self.manifest_path)
+        return
+
+    def _catch_up_counters(self):
+        counters = self._counters
+        start = counters.line_count
+        if start >= self.total_count:
+            return 0
+        if not counters.group_counts and not counters.approx_counts:
+            counters.line_count = self.total_count
+            return self.total_count - start
+        for record in self.iter_records(start):
+            counters.add_record(record)
+        counters.line_count = self.total_count
+        return self.total_count - start
+
+    def _save_counters(self, state=None):
+        """Saves the counters, or *state*, a snapshot of them taken
+        under the write lock. Either way, they're encoded and written
+        outside the lock, so writes don't wait on it. A snapshot older
+        than the one saved last is skipped."""
+        if self.read_only:
+            return
+        if state is None:
+            with self._write_lock:
+                state = self._counters.get_state()
+        with self._save_lock:
+            if state['line_count'] < self._saved_line_count:
+                return
+            GroupCounters.save_state(self.counters_path, state)
+            self._saved_line_count = state['line_count']
+
+    def _checkpoint(self):
+        # only call with the write lock held. returns a snapshot of the
+        # counters, for the caller to save once it releases the lock.
+        self._fh.flush()
+        self._index.save(self.index_path)
+        return self._counters.get_state()
+
+    def _refresh(self):
+        # only call with the write lock held. picks up the writer's
+        # rollovers, then the lines it appended to the active file.
+        for _ in xrange(3):
+            try:
+                active_ino = os.stat(self.file_path).st_ino
+            except OSError:
+                return  # mid-rollover, the new active file isn't there yet
+            if active_ino != self._active_ino:
+                if self._active_ino is not None:
+                    self._index.reset()  # the active file was replaced
+                self._active_ino = active_ino
+            try:
+                manifest_ino = os.stat(self.manifest_path).st_ino
+            except OSError:
+                manifest_ino = None
+            if manifest_ino != self._manifest_ino:
+                # the manifest is saved before the next active file is
+                # created, so this includes any rollover seen above
+                self._manifest = SegmentManifest.from_path(
+                    self.manifest_path)
+                self._manifest_ino = manifest_ino
+            self._index.catch_up(self.file_path)
+            try:
+                if os.stat(self.file_path).st_ino == active_ino:
+                    break
+            except OSError:
+                pass
+            # rolled over while catching up, which may have read the
+            # next active file, so start over
+        return
+
+    def _sync(self):
+        # only call with the write lock held. makes the files readable
+        # up to total_count, by flushing our writes, or by picking up
+        # the writer's.
+        if self.read_only:
+            self._refresh()
+        else:
+            self._fh.flush()
+
+    def refresh(self):
+        """Pick up records added by the writer since the last read. Only
+        read-only stores need this, and their reads call it."""
+        if not self.read_only:
+            return
+        with self._refresh_lock:
+            with self._write_lock:
+                self._refresh()
+                counters = self._counters
+                start, stop = counters.line_count, self.total_count
+            if start >= stop:
+                return
+            records = []
+            if counters.group_counts or counters.approx_counts:
+                # read outside the write lock, which reading takes
+                records = list(self.iter_records(start, stop))
+            with self._write_lock:
+                for record in records:
+                    counters.add_record(record)
+                counters.line_count = stop
+        return
 
     def add_record(self, indict):
-        self._fh.write(json.dumps(indict))
-        self._fh.write('\n')
-        self.total_count += 1
-        if self.total_count % self.flush_interval == 0:
+        self.add_records([indict])
+
+    def add_records(self, records):
+        """Append *records* with a single write. The file is flushed if
+        the batch crosses a multiple of the flush interval. Records
+        which are already encoded (see dal/jsoncodec.py) are written
+        as-is."""
+        if self.read_only:
+            raise ValueError('cannot add records to a read-only store: %r'
+                             % self.file_path)
+        encode_record = jsoncodec.encode_record
+        lines = [encode_record(record) + '\n' for record in records]
+        if not lines:
+            return
+        counters_state = None
+        with self._write_lock:
+            if self.segment_age and not self._index.line_count:
+                self._manifest.active_started = time.time()
+                self._manifest.save(self.manifest_path)
+            start_count = self.total_count
+            self._fh.write(''.join(lines))
+            for record, line in zip(records, lines):
+                self._index.add_line(len(line))
+                self._counters.add_record(record)
+            total_count = self.total_count
+            index_interval = self._index.interval
+            if self._should_roll():
+                counters_state = self._roll()
+            elif total_count // index_interval > start_count // index_interval:
+                counters_state = self._checkpoint()
+            elif (total_count // self.flush_interval
+                  > start_count // self.flush_interval):
+                self._fh.flush()
+        if counters_state is not None:
+            self._save_counters(counters_state)
+        return
+
+    def _should_roll(self):
+        if self.segment_size and self._index.byte_size >= self.segment_size:
+            return True
+        started = self._manifest.active_started
+        if self.segment_age and started:
+            return time.time() - started >= self.segment_age
+        return False
+
+    def _roll(self):
+        # only call with the write lock held. returns a snapshot of the
+        # counters, as _checkpoint() does.
+        self._fh.close()
+        manifest = self._manifest
+        name = manifest.get_next_name(os.path.basename(self.file_path))
+        os.rename(self.file_path, self._get_segment_path({'name': name}))
+        segment = manifest.add_segment(name,
+                                       self._index.line_count,
+                                       self._index.byte_size)
+        manifest.save(self.manifest_path)
+
+        self._fh = open(self.file_path, 'ab')
+        self._index.reset()
+        self._index.save(self.index_path)
+        self._start_compression(segment)
+        return self._counters.get_state()
+
+    def _start_compression(self, segment):
+        if not self.compress_level or self.read_only:
+            return
+        thread = threading.Thread(target=self._compress_segment,
+                                  args=(segment,),
+                                  name='LineDAL-compress')
+        thread.daemon = True
+        thread.start()
+        self._compress_threads.append(thread)
+
+    def _compress_segment(self, segment):
+        path = self._get_segment_path(segment)
+        gz_path = compress_segment(path, level=self.compress_level)
+        with self._write_lock:
+            segment['name'] = os.path.basename(gz_path)
+            self._manifest.save(self.manifest_path)
+        os.remove(path)  # readers retry open_segment with the .gz
+        return
+
+    def flush(self):
+        if not self.read_only:
             self._fh.flush()
 
+    def wait_for_compression(self):
+        "Wait for sealed segments being compressed in the background."
+        threads, self._compress_threads = self._compress_threads, []
+        for thread in threads:
+            thread.join()
+
+    def close(self):
+        if self._scan_pool is not None:
+            self._scan_pool.terminate()
+            self._scan_pool.join()
+        self.wait_for_compression()
+        if self.read_only:
+            return
+        with self._write_lock:
+            counters_state = self._checkpoint()
+            self._fh.close()
+        self._save_counters(counters_state)
+
+    def register_group_by(self, group_by):
+        """Materialize counts for *group_by*, so that future unlimited
+        select_records() calls grouping by it don't scan the
+        store. Counts for newly-registered paths are backfilled."""
+        if group_by in self._counters:
+            return
+        self.rebuild_group_by(group_by)
+
+    def rebuild_group_by(self, group_by):
+        """Recount *group_by* from the start of the store, registering
+        it if necessary."""
+        group_count = GroupCount(group_by)
+        rollup = GroupRollup(group_by)
+        get_key = self._parse_group_by(group_by)
+        get_time = self._parse_group_by(TIME_PATH)
+        for line in self.iter_lines(stop=self._counters.line_count):
+            key_val = get_key(line)
+            group_count.add_key(key_val)
+            rollup.add_key(get_hour(get_time(line)), key_val)
+        self._counters.set_group_count(group_count, rollup)
+        self._save_counters()
+        return
+
+    def register_approx_group_by(self, group_by):
+        """Maintain an approximate count for *group_by*, in bounded
+        memory, for use by future unlimited select_approx() calls.
+        See ApproxGroupCount in dal/aggregates.py."""
+        if self._counters.has_approx_count(group_by):
+            return
+        approx_count = ApproxGroupCount(group_by)
+        get_key = self._parse_group_by(group_by)
+        for line in self.iter_lines(stop=self._counters.line_count):
+            approx_count.add_key(get_key(line))
+        self._counters.set_approx_count(approx_count)
+        self._save_counters()
+        return
+
+    def _parse_group_by(self, group_by):
+        return parse_line_group_by(group_by, environments=self.environments)
+
     def raw_query(self, query):
         raise NotImplementedError('JSONL DAL does not support raw queries')
 
-    def select_records(self, limit=None, group_by=None):
-        ret = {}
-        ret['counts'] = counts = Counter()
-        reverse = True
-        if not limit:
-            reverse = False
-        jliter = jsonutils.JSONLIterator(open(self.file_path),
-                                         reverse=reverse)
-        if group_by:
-            group_by_path = parse_path(group_by)
-        else:
-            group_by_path = [None]
-        for i, cur_record in enumerate(jliter):
-            if limit and i > limit:
-                break
-            try:
-                key_val = get_path(cur_record, group_by_path)
-                key_val = str(key_val)
-            except (KeyError, IndexError, TypeError):
-                try:
-                    ret['error_count'] += 1
-                except KeyError:
-                    ret['error_count'] = 1
-            else:
-                counts[key_val] += 1
-        if not counts:
-            return {'record_count': 0}  # no records yet
-        ret['grouped_key_count'] = len(counts)
-        ret['record_count'] = i - 1
-        ret['grouped_by'] = group_by
+    def _open_parts(self, start=None, stop=None):
+        """Returns a list of (file_obj, start, stop, start_hint,
+        stop_hint) parts, one per segment holding lines from *start* up
+        to but not including *stop*. Line numbers span all segments,
+        but the start and stop in each part are local to that
+        segment. Hints are (offset, line_no) pairs to seek from."""
+        with self._write_lock:
+            # the active file is opened and its offsets looked up under
+            # the lock, so that a concurrent rollover can't interfere
+            self._sync()
+            segments = list(self._manifest.segments)
+            total_count = self.total_count
+            if stop is None or stop > total_count:
+                stop = total_count
+            start = max(0, min(start or 0, stop))
+            active_base = total_count - self._index.line_count
+            active_part = None
+            if stop > active_base:
+                a_start = max(start - active_base, 0)
+                a_stop = stop - active_base
+                active_part = (open(self.file_path, 'rb'), a_start, a_stop,
+                               self._index.get_offset(a_start),
+                               self._index.get_offset(a_stop))
+
+        ret = []
+        base = 0
+        for segment in segments:
+            seg_stop = base + segment['line_count']
+            if start < seg_stop and base < stop:
+                p_stop = min(stop, seg_stop) - base
+                stop_hint = (0, 0)
+                if p_stop == segment['line_count']:
+                    # the end of a segment is known from the manifest,
+                    # without decompressing the segment to find it
+                    stop_hint = (segment['byte_size'], p_stop)
+                seg_fh = open_segment(self._get_segment_path(segment))
+                ret.append((seg_fh, max(start - base, 0), p_stop,
+                            (0, 0), stop_hint))
+            base = seg_stop
+        if active_part is not None:
+            ret.append(active_part)
         return ret
 
+    def _seek_line(self, file_obj, line_no, hint=(0, 0)):
+        # positions file_obj at the start of line_no, reading forward
+        # from the hint, and returns the byte offset
+        offset, cur_line_no = hint
+        file_obj.seek(offset)
+        while cur_line_no < line_no:
+            line = file_obj.readline()
+            if not line:
+                break
+            offset += len(line)
+            cur_line_no += 1
+        return offset
 
-# known weakness of the path approach is that the dictionaries cannot
-# have string keys containing just integers
-def parse_path(path, sep=DEFAULT_SEP):
-    try:
-        path_segs = path.split(sep)
-    except:
-        raise TypeError('expected string, not %r' % path)
-    ret = []
-    for p in path_segs:
-        p = p.strip()
-        if not p:
-            continue
+    def iter_lines(self, start=0, stop=None):
+        """Iterate over the raw lines of records, from *start* up to but
+        not including *stop*, across all segments. Sealed segments
+        before *start* are skipped entirely, and the active file is
+        entered at the nearest indexed offset."""
+        parts = self._open_parts(start, stop)
         try:
-            ret.append(int(p))
-        except ValueError:
-            ret.append(p)
-    return ret
+            for file_obj, p_start, p_stop, start_hint, _ in parts:
+                self._seek_line(file_obj, p_start, start_hint)
+                for _ in xrange(p_stop - p_start):
+                    line = file_obj.readline()
+                    if not line:
+                        break
+                    if line.strip():
+                        yield line
+        finally:
+            for part in parts:
+                part[0].close()
+        return
 
+    def iter_tail_lines(self, limit):
+        """Iterate over the raw lines of the last *limit* records. Lines
+        in the active file come first, most recent first, found by
+        searching backwards for newlines in a memory map of it, so the
+        cost depends on *limit*, not on the size of the store. Any
+        lines from sealed segments follow, oldest first, as those are
+        read forwards. Callers only count lines, so the order doesn't
+        otherwise matter."""
+        with self._write_lock:
+            self._sync()
+            total_count = self.total_count
+            active_count = self._index.line_count
+            byte_size = self._index.byte_size
+            file_obj = open(self.file_path, 'rb') if byte_size else None
+        if file_obj is not None:
+            try:
+                mm = mmap.mmap(file_obj.fileno(), byte_size,
+                               access=mmap.ACCESS_READ)
+            finally:
+                file_obj.close()  # the map stays valid
+            try:
+                end = byte_size  # just past the last line's newline
+                for _ in xrange(min(limit, active_count)):
+                    start = mm.rfind('\n', 0, end - 1) + 1
+                    line = mm[start:end]
+                    if line.strip():
+                        yield line
+                    end = start
+            finally:
+                mm.close()
+        if limit > active_count:
+            for line in self.iter_lines(total_count - limit,
+                                        total_count - active_count):
+                yield line
+        return
 
-def get_path(target, path, default=_MISSING, sep=DEFAULT_SEP):
-    if isinstance(path, basestring):
-        path = parse_path(path)
-    cur = target
-    for p in path:
+    def iter_records(self, start=0, stop=None):
+        "Like iter_lines(), but decodes each line to a record."
+        loads = jsoncodec.loads
+        expand = self.environments.expand
+        for line in self.iter_lines(start, stop):
+            yield expand(loads(line))
+        return
+
+    def open_export(self, start=None, stop=None):
+        """Returns a list of (file_obj, start, stop) parts which, read in
+        order between the given byte offsets, form the lines from
+        *start* up to but not including *stop*. Compressed segments
+        are decompressed transparently. The caller closes the files."""
+        ret = []
+        parts = self._open_parts(start, stop)
         try:
-            cur = cur[p]
-        except (IndexError, KeyError, TypeError):
-            if default is not _MISSING:
-                return default
-            raise KeyError('error retrieving segment %r of path %r'
-                           % (p, path))
-    return cur
+            for file_obj, p_start, p_stop, start_hint, stop_hint in parts:
+                start_offset = self._seek_line(file_obj, p_start, start_hint)
+                if stop_hint[1] == p_stop:
+                    stop_offset = stop_hint[0]
+                else:
+                    if stop_hint[1] < p_start:
+                        stop_hint = (start_offset, p_start)  # no rewinding
+                    stop_offset = self._seek_line(file_obj, p_stop,
+                                                  stop_hint)
+                ret.append((file_obj, start_offset, stop_offset))
+        except Exception:
+            for part in parts:
+                part[0].close()
+            raise
+        return ret
+
+    def _get_scan_ranges(self):
+        # returns byte ranges covering the store, the number of lines
+        # they hold, and the sequence number of the next rollover, to
+        # check that none happened
+        with self._write_lock:
+            self._sync()
+            segments = list(self._manifest.segments)
+            active_size = self._index.byte_size
+            total_count = self.total_count
+            next_seq = self._manifest.next_seq
+        range_count = self.scan_processes * RANGES_PER_PROCESS
+        ret = []
+        for segment in segments:
+            ret.extend(split_ranges(self._get_segment_path(segment),
+                                    segment['byte_size'], range_count))
+        ret.extend(split_ranges(self.file_path, active_size, range_count))
+        return ret, total_count, next_seq
+
+    def _count_parallel(self, group_by):
+        ranges, stop, next_seq = self._get_scan_ranges()
+        group_count, record_count = count_ranges(
+            self._scan_pool, ranges, group_by,
+            env_path=self.environments.path)
+        if next_seq != self._manifest.next_seq:
+            return None  # rolled over mid-scan, the active file moved
+        return group_count, record_count, stop
+
+    def count_lines(self, group_by=None, start=0):
+        """Count *group_by* over the lines from *start* to the end of the
+        store. Returns a (GroupCount, record_count, stop) tuple, where
+        *stop* is the number of lines the store had when counted, so
+        that the count can be brought up to date later by counting
+        from there. See dal/query_cache.py."""
+        self.refresh()
+        if not start and group_by in self._counters:
+            with self._write_lock:
+                stop = self._counters.line_count
+                group_count = self._counters.group_counts[group_by].copy()
+            return group_count, stop, stop
+        if not start and group_by and self._scan_pool is not None:
+            ret = self._count_parallel(group_by)
+            if ret is not None:
+                return ret
+        with self._write_lock:
+            stop = self.total_count
+        # only the group-by field of each line is decoded
+        get_key = self._parse_group_by(group_by)
+        group_count = GroupCount(group_by)
+        record_count = 0
+        for line in self.iter_lines(start, stop):
+            record_count += 1
+            group_count.add_key(get_key(line))
+        return group_count, record_count, stop
+
+    @property
+    def write_generation(self):
+        "Changes whenever records are added. See dal/query_cache.py."
+        self.refresh()
+        return self.total_count
+
+    def select_records(self, limit=None, group_by=None):
+        self.refresh()
+        if not limit and group_by in self._counters:
+            return self._counters.get_result(group_by)
+        if not limit:
+            group_count, record_count, _ = self.count_lines(group_by)
+            return group_count.to_result(record_count)
+        get_key = self._parse_group_by(group_by)
+        group_count = GroupCount(group_by)
+        record_count = 0
+        for line in self.iter_tail_lines(limit):
+            record_count += 1
+            group_count.add_key(get_key(line))
+        return group_count.to_result(record_count)
+
+    def select_approx(self, limit=None, group_by=None):
+        """Like select_records(), but estimates the number of distinct
+        keys, and only counts the most frequent ones, in bounded
+        memory. Counts may be overestimated, by up to the amounts
+        under 'count_errors'."""
+        self.refresh()
+        if not limit and self._counters.has_approx_count(group_by):
+            return self._counters.get_approx_result(group_by)
+        if limit:
+            lines = self.iter_tail_lines(limit)
+        else:
+            lines = self.iter_lines()
+        get_key = self._parse_group_by(group_by)
+        approx_count = ApproxGroupCount(group_by)
+        record_count = 0
+        for line in lines:
+            record_count += 1
+            approx_count.add_key(get_key(line))
+        return approx_count.to_result(record_count)
+
+    def select_buckets(self, group_by=None, since=None, until=None,
+                       bucket=None):
+        """Count *group_by* over records received between *since* and
+        *until*, UTC Unix timestamps, by server_time. The range is
+        rounded out to whole hours. With a *bucket* of 'hour' or
+        'day', counts are returned per bucket. Registered group-bys
+        are counted from their hourly rollups, others by a scan."""
+        check_bucket(bucket)
+        self.refresh()
+        start = stop = None
+        if since is not None:
+            start = timestamp_to_hour(since)
+        if until is not None:
+            stop = timestamp_to_hour(until, round_up=True)
+        if group_by in self._counters:
+            return self._counters.get_rollup_result(group_by, start, stop,
+                                                    bucket)
+        # counted for this call only, so every hour can be kept
+        rollup = GroupRollup(group_by, hours_kept=None)
+        get_key = self._parse_group_by(group_by)
+        get_time = self._parse_group_by(TIME_PATH)
+        for line in self.iter_lines():
+            hour = get_hour(get_time(line))
+            if hour is MISSING or (start and hour < start) \
+                    or (stop and hour >= stop):
+                continue
+            rollup.add_key(hour, get_key(line))
+        return rollup.get_result(start, stop, bucket)
+
+
+def main():
+    prs = argparse.ArgumentParser()
+    prs.add_argument('file_path')
+    prs.add_argument('group_by', nargs='+',
+                     help='group-by paths to (re)build counters for')
+    args = prs.parse_args()
+
+    line_dal = LineDAL(args.file_path)
+    for group_by in args.group_by:
+        line_dal.rebuild_group_by(group_by)
+    line_dal.close()
+    return
+
+
+if __name__ == '__main__':
+    main()
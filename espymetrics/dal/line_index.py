@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""A sidecar offset index for line-oriented files.
+
+The index records the byte offset of every Nth line, along with the
+total line count and the number of bytes covered. This makes "the last
+N lines" and "lines M through N" direct seeks, instead of a scan from
+one end of the file or the other.
+
+The index is a cache, not a source of truth. It is saved periodically
+and on close, and whenever it is loaded, it catches up by reading any
+lines appended since it was last saved. If the data file is shorter
+than the index expects (e.g., it was truncated or replaced), the index
+is rebuilt from scratch.
+"""
+
+import os
+import json
+
+
+DEFAULT_INDEX_INTERVAL = 1000  # record the offset of every 1000th line
+
+
+class LineIndex(object):
+    def __init__(self, interval=DEFAULT_INDEX_INTERVAL):
+        self.interval = int(interval)
+        if self.interval < 1:
+            raise ValueError('expected positive index interval, not %r'
+                             % interval)
+        self.reset()
+
+    def reset(self):
+        self.line_count = 0
+        self.byte_size = 0
+        self.offsets = []  # offsets[i] is the offset of line i * interval
+
+    @classmethod
+    def from_path(cls, index_path, interval=DEFAULT_INDEX_INTERVAL):
+        ret = cls(interval=interval)
+        try:
+            with open(index_path, 'rb') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return ret  # missing or corrupt index, catch_up will rebuild
+        if state.get('interval') != ret.interval:
+            return ret
+        ret.line_count = state['line_count']
+        ret.byte_size = state['byte_size']
+        ret.offsets = state['offsets']
+        return ret
+
+    def save(self, index_path):
+        state = {'interval': self.interval,
+                 'line_count': self.line_count,
+                 'byte_size': self.byte_size,
+                 'offsets': self.offsets}
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, index_path)  # atomic on POSIX
+        return
+
+    def add_line(self, byte_len):
+        if self.line_count % self.interval == 0:
+            self.offsets.append(self.byte_size)
+        self.line_count += 1
+        self.byte_size += byte_len
+
+    def catch_up(self, file_path):
+        """Index any complete lines written to *file_path* past the
+        indexed byte size. Returns the number of lines added."""
+        try:
+            file_size = os.path.getsize(file_path)
+        except OSError:
+            file_size = 0
+        if file_size < self.byte_size:
+            self.reset()
+        if file_size == self.byte_size:
+            return 0
+        start_count = self.line_count
+        with open(file_path, 'rb') as f:
+            f.seek(self.byte_size)
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # partial trailing write, index it next time
+                self.add_line(len(line))
+        return self.line_count - start_count
+
+    def get_offset(self, line_no):
+        """Returns a (byte_offset, line_no) pair for the closest indexed
+        line at or before *line_no*."""
+        line_no = max(0, min(line_no, self.line_count))
+        if line_no == self.line_count:
+            return self.byte_size, self.line_count
+        idx = line_no // self.interval
+        return self.offsets[idx], idx * self.interval
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Targeted scanning of JSON lines, for counting by one field without
+decoding whole records.
+
+The first segment of a path is found by searching for its quoted key,
+e.g., ``"python"``, followed by a colon. Matches are checked to be
+real keys of the top-level object, not text inside a string or keys
+of nested objects, and only the matching value is decoded. The rest
+of the path is looked up in that value as usual. As with full
+decoding, the last of any duplicate keys wins.
+
+Lines which could spell the key with escape sequences fall back to
+full decoding, as do lines the scanner can't make sense of, so
+results always match those of the full decoder.
+
+Scanning is pure Python, and only beats the standard library's
+decoder. With faster JSON backends, lines are decoded in full.
+"""
+
+import re
+from json.decoder import JSONDecoder
+
+import jsoncodec
+from paths import (parse_path, parse_group_by, PathAccessor, MISSING,
+                   DEFAULT_SEP, GROUP_BY_SEP)
+from environments import (ENV_ID_KEY, is_env_path, is_split_path,
+                          expand_record)
+
+_COLON_RE = re.compile(r'\s*:\s*')
+_NOT_STRUCTURAL = ''.join([chr(i) for i in range(256)
+                           if chr(i) not in '"{}[]'])
+# keys containing these can be escaped without \u, e.g., \/ for /
+_ESCAPABLE_CHARS = frozenset('"\\/' + ''.join([chr(i) for i in range(32)]))
+
+_raw_decode = JSONDecoder().raw_decode
+
+# backends which fully decode lines more slowly than they can be
+# scanned. ujson and simplejson decode the message prototype about as
+# fast as it can be scanned for a top-level key, and faster than for a
+# nested one.
+SCANNED_BACKENDS = ('json',)
+
+
+def _is_escaped(line, pos):
+    # a quote is escaped if preceded by an odd number of backslashes
+    count = 0
+    while pos > 0 and line[pos - 1] == '\\':
+        count += 1
+        pos -= 1
+    return count % 2 == 1
+
+
+def _get_depth(line, pos):
+    """How many objects and arrays are open at *pos* in *line*, a byte
+    string, outside a string."""
+    prefix = line[:pos]
+    if '\\' in prefix:
+        prefix = prefix.replace('\\\\', '').replace('\\"', '')
+    # with escaped quotes gone, every other quote starts a string, and
+    # only brackets outside of strings are left to count
+    prefix = prefix.translate(None, _NOT_STRUCTURAL)
+    prefix = ''.join(prefix.split('"')[::2])
+    return (prefix.count('{') + prefix.count('[')
+            - prefix.count('}') - prefix.count(']'))
+
+
+def _compile_path_scanner(accessor):
+    def scan_fully(line):
+        return accessor(jsoncodec.loads(line))
+
+    if not accessor or not isinstance(accessor[0], basestring):
+        return scan_fully
+    key = accessor[0]
+    if isinstance(key, unicode):
+        try:
+            key = key.encode('ascii')
+        except UnicodeError:
+            return scan_fully  # may be stored escaped or as UTF-8
+    if _ESCAPABLE_CHARS.intersection(key):
+        return scan_fully
+    quoted_key = '"%s"' % key
+    get_rest = PathAccessor(accessor[1:]) if len(accessor) > 1 else None
+
+    def scan(line):
+        if '\\u' in line:
+            return scan_fully(line)
+        start = line.rfind(quoted_key)  # last first, as duplicates go
+        while start != -1:
+            colon = _COLON_RE.match(line, start + len(quoted_key))
+            if colon is not None and not _is_escaped(line, start) \
+                    and _get_depth(line, start) == 1:
+                try:
+                    value, _ = _raw_decode(line, colon.end())
+                except ValueError:
+                    return scan_fully(line)
+                if get_rest is None:
+                    return value
+                return get_rest(value)
+            start = line.rfind(quoted_key, 0, start)
+        return MISSING
+
+    return scan
+
+
+def _with_env_fallback(get_value, get_env_id, accessor, environments):
+    # records stored with an env_id lack the environment's fields,
+    # which are looked up in the table instead. works on lines or
+    # decoded records, per the getters passed in.
+    def get_value_or_env(target):
+        ret = get_value(target)
+        if ret is MISSING:
+            env_id = get_env_id(target)
+            if env_id is not MISSING:
+                env = environments.get(env_id)
+                if env is not None:
+                    ret = accessor(env)
+        return ret
+
+    return get_value_or_env
+
+
+def _with_env_merge(get_field, get_env_id, accessor, environments):
+    # fields split between the record and its environment, like
+    # python, are merged back together before the path is looked up,
+    # as they'd never be MISSING from the record. *get_field* gets the
+    # field's value, the first segment of *accessor*.
+    field = accessor[0]
+
+    def get_merged_value(target):
+        partial = {}
+        value = get_field(target)
+        if value is not MISSING:
+            partial[field] = value
+        env_id = get_env_id(target)
+        if env_id is not MISSING:
+            env = environments.get(env_id)
+            if env is not None:
+                partial = expand_record(partial, env)
+        return accessor(partial)
+
+    return get_merged_value
+
+
+def _join_keys(getters):
+    if len(getters) == 1:
+        return getters[0]
+
+    def get_key(target):
+        ret = tuple([getter(target) for getter in getters])
+        if MISSING in ret:
+            return MISSING
+        return ret
+
+    return get_key
+
+
+def _with_env(accessor, compile_path, get_env_id, environments):
+    # returns a getter for *accessor*, a path compiled by
+    # *compile_path*, which also looks into environments, if needed
+    if environments is None or not is_env_path(accessor):
+        return compile_path(accessor)
+    if is_split_path(accessor):
+        return _with_env_merge(compile_path(PathAccessor(accessor[:1])),
+                               get_env_id, accessor, environments)
+    return _with_env_fallback(compile_path(accessor), get_env_id, accessor,
+                              environments)
+
+
+def parse_line_group_by(group_by, sep=DEFAULT_SEP, environments=None):
+    """Like paths.parse_group_by(), but the returned function takes a
+    raw JSON line instead of a decoded record. Lines are scanned only
+    if the current JSON backend is one of SCANNED_BACKENDS. Pass an
+    EnvironmentTable as *environments* to resolve paths into the
+    environments of lines stored with an env_id (see
+    dal/environments.py)."""
+    if not group_by:
+        return parse_group_by(group_by, sep=sep)  # always MISSING
+    accessors = [parse_path(p, sep=sep) for p in group_by.split(GROUP_BY_SEP)]
+    if environments is not None \
+            and not [a for a in accessors if is_env_path(a)]:
+        environments = None  # nothing to look up
+    get_env_id = parse_path(ENV_ID_KEY)
+    if jsoncodec.backend_name not in SCANNED_BACKENDS:
+        if environments is None:
+            get_key = parse_group_by(group_by, sep=sep)
+        else:
+            get_key = _join_keys([
+                _with_env(a, lambda path: path, get_env_id, environments)
+                for a in accessors])
+        loads = jsoncodec.loads
+        return lambda line: get_key(loads(line))
+    if environments is not None:
+        get_env_id = _compile_path_scanner(get_env_id)
+    return _join_keys([_with_env(a, _compile_path_scanner, get_env_id,
+                                 environments) for a in accessors])
+
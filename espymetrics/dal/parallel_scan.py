@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Group-by counts over JSON Lines files, in parallel across a pool of
+worker processes.
+
+Files are split into byte ranges without regard for line boundaries.
+Each worker owns the lines which start inside its range: it skips
+ahead to the first line boundary at or after the start of the range,
+and reads through the line in progress at the end of it. The workers'
+counts are merged into one GroupCount, with the same record count,
+keys, and error count a serial scan would have.
+
+Compressed segments can't be split without decompressing them, so
+each is counted whole, by one worker.
+
+Workers open the store's environment table themselves, by its path,
+and keep it open between tasks, picking up environments added since.
+"""
+
+import signal
+import multiprocessing
+
+from aggregates import GroupCount
+from environments import EnvironmentTable
+from line_scanner import parse_line_group_by
+from segments import open_segment, GZIP_EXT
+
+DEFAULT_MIN_RANGE_SIZE = 4 * 1024 * 1024
+RANGES_PER_PROCESS = 4  # smaller ranges even out stragglers
+
+_environments = {}  # EnvironmentTables opened by this worker, by path
+
+
+def _init_worker():
+    # leave Ctrl-C to the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def create_pool(processes):
+    return multiprocessing.Pool(processes, initializer=_init_worker)
+
+
+def split_ranges(path, byte_size, range_count,
+                 min_range_size=DEFAULT_MIN_RANGE_SIZE):
+    "Returns up to *range_count* (path, start, stop) ranges of a file."
+    if path.endswith(GZIP_EXT) or byte_size <= min_range_size:
+        return [(path, 0, byte_size)]
+    range_size = max(byte_size // range_count + 1, min_range_size)
+    return [(path, start, min(start + range_size, byte_size))
+            for start in xrange(0, byte_size, range_size)]
+
+
+def _get_environments(env_path):
+    if env_path is None:
+        return None
+    try:
+        return _environments[env_path]
+    except KeyError:
+        ret = _environments[env_path] = EnvironmentTable(env_path)
+        return ret
+
+
+def count_range(task):
+    """Returns a (counts, error_count, record_count) tuple for the lines
+    starting between the *start* and *stop* offsets of a file."""
+    path, start, stop, group_by, env_path = task
+    get_key = parse_line_group_by(group_by,
+                                  environments=_get_environments(env_path))
+    group_count = GroupCount(group_by)
+    record_count = 0
+    with open_segment(path) as file_obj:
+        pos = 0
+        if start:
+            # the line in progress at start belongs to the previous range
+            file_obj.seek(start - 1)
+            pos = start - 1 + len(file_obj.readline())
+        while pos < stop:
+            line = file_obj.readline()
+            if not line:
+                break
+            pos += len(line)
+            if line.strip():
+                record_count += 1
+                group_count.add_key(get_key(line))
+    return dict(group_count.counts), group_count.error_count, record_count
+
+
+def count_ranges(pool, ranges, group_by, env_path=None):
+    """Counts *group_by* over (path, start, stop) *ranges* in *pool*,
+    returning a GroupCount and the number of records counted.
+    *env_path* is the path of the store's EnvironmentTable, if any."""
+    tasks = [(path, start, stop, group_by, env_path)
+             for path, start, stop in ranges]
+    group_count = GroupCount(group_by)
+    record_count = 0
+    for counts, error_count, cur_record_count in pool.imap(count_range,
+                                                           tasks):
+        group_count.counts.update(counts)
+        group_count.error_count += error_count
+        record_count += cur_record_count
+    return group_count, record_count
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Paths address values nested inside records, e.g.,
+``python$version_info$0``. Segments are separated by ``$``, which
+matches the flattened column names used by the SQLite DAL, and
+integer segments index into lists.
+
+Paths are parsed once and built into accessor functions, which are
+cached. Accessors return the MISSING sentinel when any segment is
+absent, instead of raising, as misses are common when counting over
+millions of records.
+
+Group-bys may name several comma-separated paths (``username,hostname``),
+in which case the group key is a tuple of their values.
+"""
+
+from boltons.cacheutils import LRU
+
+MISSING = _MISSING = object()
+
+DEFAULT_SEP = '$'  # '$' is valid in sqlite column names without escaping
+GROUP_BY_SEP = ','
+
+_accessor_cache = LRU(max_size=256)
+
+
+def _is_index(seg):
+    return isinstance(seg, (int, long))
+
+
+def _build_accessor(segments):
+    # paths come from requests, so accessors are closures, not
+    # generated code. misses cost no exceptions, and paths of one or
+    # two keys, the common case, get closures without a loop.
+    # builtins are bound as defaults, making them fast local lookups
+    if len(segments) == 1 and not _is_index(segments[0]):
+        key = segments[0]
+
+        def get_value(cur, isinstance=isinstance, dict=dict,
+                      MISSING=MISSING):
+            if not isinstance(cur, dict):
+                return MISSING
+            return cur.get(key, MISSING)
+        return get_value
+
+    if len(segments) == 2 and not any([_is_index(s) for s in segments]):
+        key1, key2 = segments
+
+        def get_value(cur, isinstance=isinstance, dict=dict,
+                      MISSING=MISSING):
+            if not isinstance(cur, dict):
+                return MISSING
+            cur = cur.get(key1, MISSING)
+            if not isinstance(cur, dict):
+                return MISSING
+            return cur.get(key2, MISSING)
+        return get_value
+
+    steps = tuple([(_is_index(seg), seg) for seg in segments])
+
+    def get_value(cur, isinstance=isinstance, dict=dict, list=list,
+                  len=len, MISSING=MISSING):
+        for is_index, seg in steps:
+            if is_index:
+                if not isinstance(cur, list) \
+                        or not -len(cur) <= seg < len(cur):
+                    return MISSING
+                cur = cur[seg]
+            else:
+                if not isinstance(cur, dict):
+                    return MISSING
+                cur = cur.get(seg, MISSING)
+        return cur
+    return get_value
+
+
+class PathAccessor(tuple):
+    """A parsed path: a tuple of segments, which when called on a
+    target returns the value at that path, or MISSING."""
+    def __new__(cls, segments):
+        ret = super(PathAccessor, cls).__new__(cls, segments)
+        ret._get_value = _build_accessor(ret)
+        return ret
+
+    def __call__(self, target):
+        return self._get_value(target)
+
+
+# known weakness of the path approach is that the dictionaries cannot
+# have string keys containing just integers
+def parse_path(path, sep=DEFAULT_SEP):
+    try:
+        return _accessor_cache[(path, sep)]
+    except KeyError:
+        pass
+    try:
+        path_segs = path.split(sep)
+    except:
+        raise TypeError('expected string, not %r' % path)
+    ret = []
+    for p in path_segs:
+        p = p.strip()
+        if not p:
+            continue
+        try:
+            ret.append(int(p))
+        except ValueError:
+            ret.append(p)
+    ret = _accessor_cache[(path, sep)] = PathAccessor(ret)
+    return ret
+
+
+def get_path(target, path, default=_MISSING, sep=DEFAULT_SEP):
+    if isinstance(path, basestring):
+        path = parse_path(path, sep=sep)
+    elif not isinstance(path, PathAccessor):
+        path = PathAccessor(path)
+    ret = path(target)
+    if ret is _MISSING:
+        if default is not _MISSING:
+            return default
+        raise KeyError('error retrieving path %r' % (path,))
+    return ret
+
+
+def _always_missing(target):
+    return _MISSING
+
+
+def parse_group_by(group_by, sep=DEFAULT_SEP):
+    """Returns an accessor for the group key described by *group_by*:
+    the value at a single path, or a tuple of the values at several
+    comma-separated paths. If any of the paths are missing, or no
+    group_by is given, the accessor returns MISSING."""
+    if not group_by:
+        return _always_missing
+    if GROUP_BY_SEP not in group_by:
+        return parse_path(group_by, sep=sep)
+    try:
+        return _accessor_cache[(group_by, GROUP_BY_SEP, sep)]
+    except KeyError:
+        pass
+    accessors = [parse_path(p, sep=sep) for p in group_by.split(GROUP_BY_SEP)]
+
+    def get_key(target):
+        ret = tuple([accessor(target) for accessor in accessors])
+        if _MISSING in ret:
+            return _MISSING
+        return ret
+
+    _accessor_cache[(group_by, GROUP_BY_SEP, sep)] = get_key
+    return get_key
+
+
+def format_key(key):
+    "Group keys are reported as strings, with tuple values comma-joined."
+    if isinstance(key, tuple):
+        return GROUP_BY_SEP.join([unicode(k) for k in key])
+    return unicode(key)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""The QueryCache wraps a DAL to cache the results of reads, like
+select_records(), in a least-recently-used cache.
+
+Results are cached alongside the store's write generation, a number
+which changes whenever records are added (the record count, for the
+line and columnar DALs). A cached result is only returned while the
+generation is unchanged, so writes invalidate results without any
+explicit bookkeeping, and a cache shared by several readers never
+returns a result older than the last write.
+
+Unlimited group-by counts over stores that can count from a given
+line (see LineDAL.count_lines()) are not thrown away after writes.
+Instead, only the records added since the count was made are counted,
+and merged into it.
+
+Every lookup is counted as a hit, a miss, or an extension, for sizing
+the cache, along with how many lookups found an outdated entry. See
+get_cache_stats(). The cache is bounded by number of entries, not
+memory, and each entry holds one result.
+
+Writes and other DAL attributes pass through to the wrapped DAL.
+"""
+
+import threading
+from functools import partial
+
+from boltons.cacheutils import LRU
+
+DEFAULT_MAX_SIZE = 128
+CACHED_METHODS = ('select_records', 'select_buckets', 'select_approx')
+
+_MISSING = object()
+
+
+class QueryCache(object):
+    def __init__(self, data_store, max_size=DEFAULT_MAX_SIZE):
+        self.data_store = data_store
+        self.max_size = int(max_size)
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.stale_count = 0  # lookups finding an entry outdated by writes
+        self.extend_count = 0  # outdated entries brought up to date
+
+        self._cache = LRU(max_size=self.max_size)
+        self._stats_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # a store without one of the cached methods still raises
+        # AttributeError, so callers can check for support
+        method = getattr(self.data_store, name)
+        if name in CACHED_METHODS:
+            return partial(self._call_cached, name, method)
+        return method
+
+    def _count(self, attr_name):
+        with self._stats_lock:
+            setattr(self, attr_name, getattr(self, attr_name) + 1)
+
+    def _call_cached(self, name, method, *a, **kw):
+        generation = self.data_store.write_generation
+        key = (name, a, tuple(sorted(kw.items())))
+        if (name == 'select_records' and not a and not kw.get('limit')
+                and hasattr(self.data_store, 'count_lines')):
+            return self._select_extendable(key, generation, *a, **kw)
+        entry = self._cache.get(key, _MISSING)
+        if entry is not _MISSING:
+            if entry[0] == generation:
+                self._count('hit_count')
+                return entry[1]
+            self._count('stale_count')
+        self._count('miss_count')
+        ret = method(*a, **kw)
+        # the result may include writes made after generation was
+        # read, in which case it's merely recomputed once more than
+        # necessary
+        self._cache[key] = (generation, ret)
+        return ret
+
+    def _select_extendable(self, key, generation, limit=None, group_by=None):
+        entry = self._cache.get(key, _MISSING)
+        if entry is not _MISSING:
+            stop, group_count, record_count, result = entry
+            if stop == generation:
+                self._count('hit_count')
+                return result
+            self._count('stale_count')
+            if stop < generation:
+                new_count, new_record_count, stop = \
+                    self.data_store.count_lines(group_by, start=stop)
+                group_count = group_count.copy()
+                group_count.update(new_count)
+                record_count += new_record_count
+                self._count('extend_count')
+                return self._set_extendable(key, stop, group_count,
+                                            record_count)
+        self._count('miss_count')
+        group_count, record_count, stop = \
+            self.data_store.count_lines(group_by)
+        return self._set_extendable(key, stop, group_count, record_count)
+
+    def _set_extendable(self, key, stop, group_count, record_count):
+        result = group_count.to_result(record_count)
+        self._cache[key] = (stop, group_count, record_count, result)
+        return result
+
+    def clear(self):
+        self._cache.clear()
+
+    def get_cache_stats(self):
+        return {'hit_count': self.hit_count,
+                'miss_count': self.miss_count,
+                'stale_count': self.stale_count,
+                'extend_count': self.extend_count,
+                'size': len(self._cache),
+                'max_size': self.max_size}
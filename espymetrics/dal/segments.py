@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Segmented storage for the line-based DAL.
+
+Records are appended to an active file, which is rolled over to a
+sealed segment once it reaches a size or age threshold. Sealed
+segments never change again, so they are gzip-compressed in the
+background. Repetitive JSON lines like ours compress roughly 20:1, and
+scans of compressed segments trade a little CPU for much less I/O.
+
+A manifest lists the sealed segments in order, along with their line
+counts and uncompressed sizes, so that line numbers and export byte
+ranges can be mapped onto segments without decompressing them.
+Segment paths in the manifest are relative to the store's directory.
+
+Rollover renames the active file to a numbered segment
+(``metrics_data.jsonl.000001``) and then saves the manifest. If the
+process dies in between, the segment is adopted on the next load.
+"""
+
+import io
+import os
+import json
+import gzip
+import shutil
+
+
+GZIP_EXT = '.gz'
+DEFAULT_COMPRESS_LEVEL = 6
+_COPY_BUF_SIZE = 1024 * 1024
+
+
+def open_segment(path):
+    """Opens a segment for reading, decompressing transparently. If the
+    segment was compressed since its path was looked up, the
+    compressed version is opened instead."""
+    if not path.endswith(GZIP_EXT) and not os.path.exists(path):
+        path += GZIP_EXT
+    if path.endswith(GZIP_EXT):
+        return io.BufferedReader(gzip.GzipFile(path, 'rb'))
+    return open(path, 'rb')
+
+
+def compress_segment(path, level=DEFAULT_COMPRESS_LEVEL):
+    gz_path = path + GZIP_EXT
+    tmp_path = gz_path + '.tmp'
+    with open(path, 'rb') as src:
+        dst = gzip.GzipFile(tmp_path, 'wb', compresslevel=level)
+        try:
+            shutil.copyfileobj(src, dst, _COPY_BUF_SIZE)
+        finally:
+            dst.close()
+    os.rename(tmp_path, gz_path)
+    return gz_path
+
+
+def count_lines(path):
+    line_count, byte_size = 0, 0
+    with open_segment(path) as f:
+        for line in f:
+            line_count += 1
+            byte_size += len(line)
+    return line_count, byte_size
+
+
+class SegmentManifest(object):
+    def __init__(self):
+        self.segments = []  # dicts with name, line_count, and byte_size
+        self.next_seq = 1
+        self.active_started = None  # time of the active file's first write
+
+    @classmethod
+    def from_path(cls, manifest_path):
+        ret = cls()
+        try:
+            with open(manifest_path, 'rb') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return ret
+        ret.segments = state['segments']
+        ret.next_seq = state['next_seq']
+        ret.active_started = state['active_started']
+        return ret
+
+    def save(self, manifest_path):
+        state = {'segments': self.segments,
+                 'next_seq': self.next_seq,
+                 'active_started': self.active_started}
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, manifest_path)
+        return
+
+    @property
+    def line_count(self):
+        return sum([s['line_count'] for s in self.segments])
+
+    def get_next_name(self, base_name):
+        return '%s.%06d' % (base_name, self.next_seq)
+
+    def add_segment(self, name, line_count, byte_size):
+        segment = {'name': name,
+                   'line_count': line_count,
+                   'byte_size': byte_size}
+        self.segments.append(segment)
+        self.next_seq += 1
+        self.active_started = None
+        return segment
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Fixed-size summaries of streams of string keys, for group-bys over
+paths with too many distinct values to count exactly, like ``uuid``.
+
+``HyperLogLog`` estimates how many distinct keys have been added. With
+the default precision of 14, it uses 16KB, and the estimate's relative
+standard error is 1.04 / sqrt(2 ** 14), about 0.8%.
+
+``SpaceSaving`` keeps the most frequent keys, and an overestimate of
+their counts, in a fixed number of slots. Every key added more than
+N / capacity times is kept, where N is the number of keys added, and
+no count is overestimated by more than N / capacity. The possible
+overestimate of each key is tracked, and reported with the counts.
+
+Both are updated in constant time, and have a state which can be
+saved as JSON.
+"""
+
+import math
+import base64
+import struct
+import hashlib
+
+DEFAULT_PRECISION = 14
+DEFAULT_CAPACITY = 1000
+
+
+def _hash64(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self._value_bits = 64 - precision
+        self._value_mask = (1 << self._value_bits) - 1
+        if registers is None:
+            registers = bytearray(self.size)
+        self.registers = registers
+
+    @property
+    def std_error(self):
+        return 1.04 / math.sqrt(self.size)
+
+    def add(self, key):
+        hashed = _hash64(key)
+        index = hashed >> self._value_bits
+        # the position of the leftmost 1 bit in the rest of the hash
+        rank = self._value_bits - (hashed & self._value_mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('expected precision %r, not %r'
+                             % (self.precision, other.precision))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        raw = alpha * size * size / sum([2.0 ** -r for r in self.registers])
+        zeros = self.registers.count('\x00')
+        if raw <= 2.5 * size and zeros:
+            return int(round(size * math.log(float(size) / zeros)))
+        return int(round(raw))
+
+    def get_state(self):
+        return {'precision': self.precision,
+                'registers': base64.b64encode(str(self.registers))}
+
+    @classmethod
+    def from_state(cls, state):
+        registers = bytearray(base64.b64decode(state['registers']))
+        return cls(state['precision'], registers)
+
+
+class SpaceSaving(object):
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}  # key -> count, possibly overestimated
+        self.errors = {}  # key -> how much count may be overestimated
+        self._keys_by_count = {}  # count -> set of keys
+        self._min_count = 0
+
+    def add(self, key):
+        count = self.counts.get(key)
+        if count is not None:
+            self._set_count(key, count + 1, count)
+            return
+        if len(self.counts) < self.capacity:
+            self.errors[key] = 0
+            self._set_count(key, 1)
+            return
+        # replace a least frequent key, assuming the new one might have
+        # been seen as often
+        min_count = self._min_count
+        evicted = self._keys_by_count[min_count].pop()
+        del self.counts[evicted]
+        del self.errors[evicted]
+        self.errors[key] = min_count
+        self._set_count(key, min_count + 1, min_count)
+
+    def _set_count(self, key, count, old_count=None):
+        keys_by_count = self._keys_by_count
+        self.counts[key] = count
+        keys_by_count.setdefault(count, set()).add(key)
+        if old_count is None:
+            self._min_count = 1  # new keys start at the bottom
+            return
+        old_keys = keys_by_count[old_count]
+        old_keys.discard(key)
+        if not old_keys:
+            del keys_by_count[old_count]
+            if old_count == self._min_count:
+                self._min_count = count
+
+    def get_top(self, limit=None):
+        "Returns a list of (key, count, error) tuples, most frequent first."
+        ret = sorted(self.counts.items(), key=lambda kc: (-kc[1], kc[0]))
+        if limit:
+            ret = ret[:limit]
+        return [(key, count, self.errors[key]) for key, count in ret]
+
+    def get_state(self):
+        return {'capacity': self.capacity,
+                'counts': dict(self.counts),
+                'errors': dict(self.errors)}
+
+    @classmethod
+    def from_state(cls, state):
+        ret = cls(state['capacity'])
+        for key, count in state['counts'].items():
+            ret.counts[key] = count
+            ret.errors[key] = state['errors'][key]
+            ret._keys_by_count.setdefault(count, set()).add(key)
+        if ret.counts:
+            ret._min_count = min(ret._keys_by_count)
+        return ret
@@ -24,10 +24,32 @@ unexpected generated SQL output. That said, in my experience,
 SQLAlchemy's expression language is pretty enterprise-ready. Still,
 raw SQL here for simplicity.
 
+Connections are long-lived. Writes go through one dedicated writer
+connection, serialized by a lock, and reads take a connection from a
+small pool, which keeps up to *max_idle_read_conns* of them open
+between reads, and closes the rest. The database runs in WAL
+(write-ahead log) mode, so readers see a consistent snapshot and
+neither block nor are blocked by the writer.
+
+Group-bys name columns, or objects and arrays of the schema, like
+python, whose values are put back together from the columns under
+them, as in the columnar DAL. Columns grouped by *autoindex_threshold*
+times get a secondary index, built on a background thread rather than
+by the request which crossed the threshold. Stores which only read,
+like the --workers mode's, pass 0 to leave indexing to the writer.
+
 """
 
+import os
 import sqlite3
-from boltons.iterutils import remap, get_path
+import threading
+from collections import Counter
+
+from boltons.iterutils import remap, get_path, PathAccessError
+
+from paths import GROUP_BY_SEP, MISSING
+from environments import EnvironmentTable
+from aggregates import GroupCount
 # further reading: http://sedimental.org/remap.html
 
 
@@ -38,6 +60,29 @@ CREATE_QTMPL = ('CREATE TABLE IF NOT EXISTS {table_name}'
                 ' ({cols_types})')
 INSERT_QTMPL = ('INSERT INTO {table_name} ({cols})'
                 ' VALUES ({placeholders})')
+INDEX_QTMPL = ('CREATE INDEX IF NOT EXISTS {index_name}'
+               ' ON {table_name} ({cols})')
+GROUP_QTMPL = ('SELECT {cols}, COUNT(*) FROM {table_name}'
+               ' GROUP BY {cols}')
+# the subquery takes the most recent rows, which are then grouped
+LIMIT_GROUP_QTMPL = ('SELECT {cols}, COUNT(*) FROM'
+                     ' (SELECT {cols} FROM {table_name}'
+                     '  ORDER BY rowid DESC LIMIT ?)'
+                     ' GROUP BY {cols}')
+MAX_ROWID_QTMPL = 'SELECT MAX(rowid) FROM {table_name}'
+COUNT_QTMPL = 'SELECT COUNT(*) FROM {table_name}'
+
+# columns grouped by this many times get a secondary index
+DEFAULT_AUTOINDEX_THRESHOLD = 3
+DEFAULT_MAX_IDLE_READ_CONNS = 4
+
+# synchronous=NORMAL is durable against application crashes in WAL
+# mode, only the last transactions may roll back on power loss.
+# negative cache_size is in KiB.
+DEFAULT_PRAGMAS = [('journal_mode', 'WAL'),
+                   ('synchronous', 'NORMAL'),
+                   ('cache_size', -64 * 1024),
+                   ('mmap_size', 256 * 1024 * 1024)]
 
 
 def flatten_fields(msg_proto, **kwargs):
@@ -64,22 +109,132 @@ def flatten_fields(msg_proto, **kwargs):
     return sorted(ret, key=lambda x: x[0])
 
 
+def get_container_fields(flat_fields, sep=SEP):
+    """Returns the objects and arrays of a schema flattened by
+    flatten_fields(), by name, each a list of (relative path, column
+    name) pairs of the fields under it. Group-bys may name them."""
+    ret = {}
+    for path, name, _ in flat_fields:
+        for i in range(1, len(path)):
+            prefix = sep.join([str(p) for p in path[:i]])
+            ret.setdefault(prefix, []).append((path[i:], name))
+    return ret
+
+
+def _rebuild(leaves):
+    # puts a container back together from (relative path, value)
+    # pairs. containers keyed by indexes become lists.
+    ret = {}
+    for path, value in leaves:
+        cur = ret
+        for seg in path[:-1]:
+            cur = cur.setdefault(seg, {})
+        cur[path[-1]] = value
+
+    def to_value(target):
+        if not isinstance(target, dict):
+            return target
+        items = [(k if isinstance(k, int) else unicode(k), to_value(v))
+                 for k, v in target.items()]
+        if all([isinstance(k, int) for k, _ in items]):
+            return [v for _, v in sorted(items)]
+        return dict(items)
+
+    return to_value(ret)
+
+
+def get_group_key(groups, values):
+    """Returns the group-by key of a row of column *values*, decoded,
+    with None for nulls. *groups* has a list of (relative path, column)
+    pairs per group-by path, as from get_container_fields(), with an
+    empty path for a field's own column. Objects and arrays are put
+    back together from their non-null fields. Returns MISSING if any
+    path has only nulls, as the other DALs count those as misses."""
+    key, values = [], iter(values)
+    for group in groups:
+        # zipped against the shared iterator, so each group takes its
+        # own columns' values, in order
+        leaves = [(path, value) for (path, _), value in zip(group, values)
+                  if value is not None]
+        if not leaves:
+            return MISSING
+        key.append(_rebuild(leaves) if leaves[0][0] else leaves[0][1])
+    if len(key) == 1:
+        return key[0]
+    return tuple(key)
+
+
+# values are bound to text columns, which store numbers as strings, so
+# group keys are converted back per the type of the prototype's field,
+# to be formatted as the other DALs format them
+def _decode_bool(value):
+    return {u'1': True, u'0': False}.get(value, value)
+
+
+def _decode_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _decode_float(value):
+    try:
+        int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            pass
+    return value  # e.g., an int, in a float field
+
+
 class SQLiteDAL(object):
     _extension = '.db'
+    _environments_extension = '.envs'
 
-    def __init__(self, file_path, table_name, message_proto, autoinitdb=True):
+    def __init__(self, file_path, table_name, message_proto, autoinitdb=True,
+                 pragmas=DEFAULT_PRAGMAS, group_by_paths=(),
+                 autoindex_threshold=DEFAULT_AUTOINDEX_THRESHOLD,
+                 max_idle_read_conns=DEFAULT_MAX_IDLE_READ_CONNS):
         self.file_path = file_path
         self.table_name = table_name
         self.message_proto = message_proto
+        self.pragmas = list(pragmas)
+        self.autoindex_threshold = autoindex_threshold
+        self.max_idle_read_conns = max_idle_read_conns
+        self._group_by_counts = Counter()
+        self._indexed_group_bys = set()
         self._flat_fields = flatten_fields(self.message_proto)
+        # environments are stored in full with each record, and only
+        # kept here for expanding records sent with just an env_id
+        self.environments = EnvironmentTable(file_path
+                                             + self._environments_extension)
 
+        self._write_lock = threading.Lock()
+        self._write_conn = None
+        self._idle_read_conns = []
+        self._read_conns_lock = threading.Lock()
+
+        self._container_fields = get_container_fields(self._flat_fields)
         self._init_queries()
         if autoinitdb:
             self.init_db()
+        for group_by in group_by_paths:
+            self.create_index(group_by)
 
     def _init_queries(self):
         ff = self._flat_fields
         self._col_map = dict([(k, v) for _, k, v in ff])
+        self._col_decoders = {}
+        for path, col, _ in ff:
+            proto_value = get_path(self.message_proto, path)
+            if isinstance(proto_value, bool):
+                self._col_decoders[col] = _decode_bool
+            elif isinstance(proto_value, (int, long)):
+                self._col_decoders[col] = _decode_int
+            elif isinstance(proto_value, float):
+                self._col_decoders[col] = _decode_float
 
         self._col_types_str = ', '.join(['%s %s' % (k, v) for _, k, v in ff])
         self._create_q = CREATE_QTMPL.format(table_name=self.table_name,
@@ -91,32 +246,193 @@ class SQLiteDAL(object):
                                              placeholders=placeholders_str)
         return
 
+    def _connect(self):
+        # check_same_thread is off so pooled connections can move
+        # between threads; each is still only used by one thread at a
+        # time.
+        conn = sqlite3.connect(self.file_path, check_same_thread=False)
+        for name, value in self.pragmas:
+            conn.execute('PRAGMA %s=%s' % (name, value))
+        return conn
+
+    def _get_write_conn(self):
+        # only call with the write lock held
+        if self._write_conn is None:
+            self._write_conn = self._connect()
+        return self._write_conn
+
+    def _read(self, query, params=()):
+        "Returns all rows of *query*, run on a pooled read connection."
+        conn = None
+        with self._read_conns_lock:
+            if self._idle_read_conns:
+                conn = self._idle_read_conns.pop()
+        if conn is None:
+            conn = self._connect()
+            conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                return conn.execute(query, params).fetchall()
+        finally:
+            with self._read_conns_lock:
+                if len(self._idle_read_conns) < self.max_idle_read_conns:
+                    self._idle_read_conns.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
     def init_db(self):
         # TODO: check that schema matches in existing db case
-        conn = sqlite3.connect(self.file_path)
-        with conn:
-            conn.execute(self._create_q)
+        with self._write_lock:
+            conn = self._get_write_conn()
+            with conn:
+                conn.execute(self._create_q)
         return
 
-    def add_record(self, in_dict):
+    def _get_bindables(self, in_dict):
         bindables = []
         for path, col, _ in self._flat_fields:
-            val = get_path(in_dict, path)
+            try:
+                val = get_path(in_dict, path)
+            except PathAccessError:
+                val = None
             bindables.append(val)
-        conn = sqlite3.connect(self.file_path)
-        with conn:
-            conn.execute(self._insert_q, bindables)
+        return bindables
+
+    def add_record(self, in_dict):
+        self.add_records([in_dict])
+
+    def add_records(self, in_dicts):
+        rows = [self._get_bindables(in_dict) for in_dict in in_dicts]
+        with self._write_lock:
+            conn = self._get_write_conn()
+            with conn:
+                conn.executemany(self._insert_q, rows)
         return
 
+    def flush(self):
+        pass  # every add_records() call commits its own transaction
+
+    def close(self):
+        with self._write_lock:
+            if self._write_conn is not None:
+                self._write_conn.close()
+                self._write_conn = None
+        with self._read_conns_lock:
+            conns, self._idle_read_conns = self._idle_read_conns, []
+        for conn in conns:
+            conn.close()
+
+    @property
+    def write_generation(self):
+        "Changes whenever records are added. See dal/query_cache.py."
+        query = MAX_ROWID_QTMPL.format(table_name=self.table_name)
+        max_rowid = self._read(query)[0][0]
+        return max_rowid or 0
+
+    def open_export(self, start=None, stop=None):
+        if start is not None or stop is not None:
+            raise ValueError('the SQLite DAL only exports whole databases,'
+                             ' not record ranges')
+        # move committed transactions from the WAL into the main
+        # database file, so that the file is complete on its own
+        with self._write_lock:
+            self._get_write_conn().execute('PRAGMA wal_checkpoint')
+        return [(open(self.file_path, 'rb'),
+                 0, os.path.getsize(self.file_path))]
+
     def raw_query(self, query):
-        conn = sqlite3.connect(self.file_path)
-        conn.row_factory = sqlite3.Row
-        with conn:
-            rows = conn.execute(query).fetchall()
-        return rows
+        return self._read(query)
+
+    def _get_group_by_cols(self, group_by):
+        # group_by paths use the same separator as the flattened
+        # column names, so they're the same strings. Only known column
+        # names are ever interpolated into queries.
+        if not group_by:
+            return None
+        cols = [c.strip() for c in group_by.split(GROUP_BY_SEP)]
+        if not all([c in self._col_map for c in cols]):
+            return None
+        return cols
+
+    def create_index(self, group_by):
+        """Create a secondary index on the column (or comma-separated
+        columns) named by *group_by*."""
+        cols = self._get_group_by_cols(group_by)
+        if not cols:
+            raise ValueError('expected columns of table %r, not %r'
+                             % (self.table_name, group_by))
+        index_name = 'ix_%s_%s' % (self.table_name, '__'.join(cols))
+        query = INDEX_QTMPL.format(index_name=index_name,
+                                   table_name=self.table_name,
+                                   cols=', '.join(cols))
+        with self._write_lock:
+            conn = self._get_write_conn()
+            with conn:
+                conn.execute(query)
+        self._indexed_group_bys.add(group_by)
+        return
+
+    def _track_group_by(self, group_by):
+        self._group_by_counts[group_by] += 1
+        if group_by in self._indexed_group_bys or not self.autoindex_threshold:
+            return
+        if self._group_by_counts[group_by] >= self.autoindex_threshold:
+            # built on a thread of its own, off the request path. it's
+            # marked as indexed first, so that it's only built once.
+            self._indexed_group_bys.add(group_by)
+            thread = threading.Thread(target=self._create_autoindex,
+                                      args=(group_by,),
+                                      name='SQLiteDAL-autoindex')
+            thread.daemon = True
+            thread.start()
+        return
+
+    def _create_autoindex(self, group_by):
+        try:
+            self.create_index(group_by)
+        except sqlite3.Error:
+            self._indexed_group_bys.discard(group_by)  # tried again later
+
+    def _get_group_fields(self, name):
+        # (relative path, column name) pairs, as from
+        # get_container_fields(), or None if there's no such field
+        if name in self._col_map:
+            return [((), name)]
+        return self._container_fields.get(name)
 
     def select_records(self, limit=None, group_by=None):
-        pass
+        names = [n.strip() for n in group_by.split(GROUP_BY_SEP)] \
+            if group_by else []
+        groups = [self._get_group_fields(name) for name in names]
+        if not groups or None in groups:
+            # like a path missing from every record, every row is a miss
+            query = COUNT_QTMPL.format(table_name=self.table_name)
+            row_count = self._read(query)[0][0]
+            if limit:
+                row_count = min(row_count, limit)
+            return GroupCount(group_by,
+                              error_count=row_count).to_result(row_count)
+        if self._get_group_by_cols(group_by):
+            self._track_group_by(group_by)  # only fields are indexed
+        cols = [col for group in groups for _, col in group]
+        fmt_kw = {'cols': ', '.join(cols), 'table_name': self.table_name}
+        if limit:
+            query = LIMIT_GROUP_QTMPL.format(**fmt_kw)
+            params = (limit,)
+        else:
+            query = GROUP_QTMPL.format(**fmt_kw)
+            params = ()
+        rows = self._read(query, params)
+
+        decoders = [self._col_decoders.get(col) for col in cols]
+        group_count = GroupCount(group_by)
+        for row in rows:
+            row = tuple(row)
+            values = [decode(v) if decode and v is not None else v
+                      for decode, v in zip(decoders, row[:-1])]
+            group_count.add_key(get_group_key(groups, values), row[-1])
+        return group_count.to_result(group_count.record_count)
 
 
 if __name__ == '__main__':
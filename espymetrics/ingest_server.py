@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""An event-driven HTTP front end for imports, for many concurrent,
+mostly idle, keep-alive connections.
+
+The clastic app serves each connection on its own thread. This server
+handles every connection on a single thread, with asyncore, so an
+open connection costs a socket and a buffer, not a thread and its
+stack. It only serves imports: POSTs to two paths, with a
+Content-Length, of one record, or of a JSON Lines batch of them, as
+the app's /on_import and /on_import_batch endpoints take. Either body
+may be compressed. Records are checked and prepared by the same
+function as the app's, and responses have the same status, headers,
+and body, so clients can't tell the two apart.
+
+Records are handed to the data store's add_record_async() (see
+dal/batch_writer.py), and a request's response is sent once all its
+records are acknowledged, without blocking the loop. Responses to
+pipelined requests are sent in request order. If the writer's queue is
+full, the request gets a 503 right away, rather than the loop waiting
+for a slow disk. The rest of a batch that was partly queued is queued
+as its first records are acknowledged. Data stores without
+add_record_async() are wrapped in a BatchWriter of their own, which
+writes one record at a time, so the loop thread never writes to the
+store.
+
+HTTP/1.1 connections are kept alive unless the client asks otherwise,
+HTTP/1.0 connections only if the client asks for it. Connections idle
+for longer than the keep-alive timeout are closed.
+
+(asyncore is the standard library's event loop on Python 2, where
+asyncio isn't available.)
+"""
+
+import os
+import time
+import json
+import Queue
+import fcntl
+import errno
+import socket
+import asyncore
+import asynchat
+import threading
+from collections import deque
+
+from content_encoding import (decode_body, UnsupportedEncoding,
+                              DecodedTooLarge, DEFAULT_MAX_DECODED_SIZE)
+from dal.environments import ENV_ID_KEY
+from dal.batch_writer import BatchWriter
+
+DEFAULT_PATH = '/v1/on_import'
+DEFAULT_BATCH_PATH = '/v1/on_import_batch'
+DEFAULT_KEEPALIVE_TIMEOUT = 75.0
+DEFAULT_MAX_BODY_SIZE = 1024 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+LISTEN_BACKLOG = 1024
+POLL_INTERVAL = 1.0  # seconds between idle connection sweeps
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 409: 'Conflict',
+           411: 'Length Required', 413: 'Request Entity Too Large',
+           415: 'Unsupported Media Type', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+# clastic's error bodies use sentence case
+ERROR_TITLES = {400: 'Bad Request', 404: 'Not found',
+                405: 'Method not allowed', 409: 'A conflict occurred',
+                411: 'Length required', 413: 'Request entity too large',
+                415: 'Unsupported media type', 500: 'Internal server error',
+                503: 'Service or resource unavailable'}
+
+
+def _render_error(code, detail=None):
+    # the same text clastic renders for its HTTP exceptions
+    lines = ['%s - %s' % (code, ERROR_TITLES[code])]
+    if detail:
+        lines.extend(['', detail])
+    return code, 'text/plain; charset=utf-8', '\n'.join(lines)
+
+
+def _render_json(obj):
+    # the same JSON as clastic's render_basic
+    body = json.dumps(obj, indent=2, sort_keys=True)
+    return 200, 'application/json; charset=utf-8', body
+
+
+def _render_prepare_error(e, line_no=None):
+    code = getattr(e, 'code', 500)
+    if code not in REASONS:
+        code = 500
+    detail = getattr(e, 'detail', None)
+    if line_no is not None:
+        detail = 'line %s: %s' % (line_no, detail)
+    return _render_error(code, detail)
+
+
+class _Trigger(asyncore.file_dispatcher):
+    """Wakes the loop to run functions passed to call_soon() from other
+    threads, like the BatchWriter's."""
+    def __init__(self, map):
+        read_fd, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map=map)
+        os.close(read_fd)  # the dispatcher reads from its own dup
+        flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._calls = deque()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def call_soon(self, func, *a):
+        self._calls.append((func, a))
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError as ose:
+            if ose.errno != errno.EAGAIN:
+                raise
+            # the pipe is full of wakeups the loop has yet to read
+
+    def handle_read(self):
+        self.recv(4096)
+        while self._calls:
+            func, a = self._calls.popleft()
+            func(*a)
+
+    def handle_close(self):
+        self.close()
+        os.close(self._write_fd)
+
+
+class IngestChannel(asynchat.async_chat):
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.last_active = time.time()
+        self._buf = []
+        self._buf_size = 0
+        self._request = None
+        self._responses = deque()  # one slot per request, in order
+        self._closing = False
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.last_active = time.time()
+        if self._closing:
+            return
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._request is None and self._buf_size > MAX_HEADER_SIZE:
+            self._respond_now(_render_error(400, 'request headers too large'))
+
+    def found_terminator(self):
+        self.last_active = time.time()
+        data, self._buf, self._buf_size = ''.join(self._buf), [], 0
+        if self._closing:
+            return
+        if self._request is None:
+            self._handle_headers(data)
+        else:
+            request, self._request = self._request, None
+            self.set_terminator('\r\n\r\n')
+            self._handle_request(request, data)
+
+    def _handle_headers(self, data):
+        lines = data.lstrip('\r\n').split('\r\n')
+        try:
+            method, path, version = lines[0].split()
+        except ValueError:
+            self._respond_now(_render_error(400, 'malformed request line'))
+            return
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        request = (method, path.split('?', 1)[0], version, keep_alive,
+                   headers.get('content-encoding'))
+
+        paths = (self.server.path, self.server.batch_path)
+        if method != 'POST' or request[1] not in paths:
+            code = 404 if request[1] not in paths else 405
+            # the body, if any, isn't read, so the connection is done
+            self._respond_now(_render_error(code), version)
+            return
+        try:
+            length = int(headers['content-length'])
+        except (KeyError, ValueError):
+            self._respond_now(_render_error(411), version)
+            return
+        if length > self.server.max_body_size:
+            self._respond_now(_render_error(413), version)
+            return
+        if headers.get('expect', '').lower() == '100-continue':
+            self.push('%s 100 Continue\r\n\r\n' % version)
+        if not length:
+            self._handle_request(request, '')
+            return
+        self._request = request
+        self.set_terminator(length)
+
+    def _handle_request(self, request, body):
+        keep_alive = request[3]
+        slot = [request[2], keep_alive, None]
+        self._responses.append(slot)
+        if not keep_alive:
+            self._closing = True  # ignore anything pipelined after this
+        try:
+            body = decode_body(body, request[4],
+                               max_size=self.server.max_decoded_size)
+        except UnsupportedEncoding as ue:
+            self._fill(slot, _render_error(415, str(ue)))
+            return
+        except DecodedTooLarge as dtl:
+            self._fill(slot, _render_error(413, str(dtl)))
+            return
+        except ValueError as ve:
+            self._fill(slot, _render_error(400, str(ve)))
+            return
+        if request[1] == self.server.batch_path:
+            self._handle_batch(body, slot)
+            return
+        try:
+            record = self.server.prepare_record(body)
+        except Exception as e:
+            self._fill(slot, _render_prepare_error(e))
+            return
+        self.server.write_record(record, self, slot)
+
+    def _handle_batch(self, body, slot):
+        # checked in full before any of it is written, as by the app
+        records = []
+        for line_no, line in enumerate(body.split('\n'), 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(self.server.prepare_record(line))
+            except Exception as e:
+                self._fill(slot, _render_prepare_error(e, line_no))
+                return
+        if not records:
+            self._fill(slot, _render_error(400, 'expected json lines body'))
+            return
+        self.server.write_records(records, self, slot)
+
+    def _respond_now(self, response, version='HTTP/1.1'):
+        # for requests which end the connection, after any responses
+        # still pending
+        slot = [version, False, None]
+        self._responses.append(slot)
+        self._closing = True
+        self._fill(slot, response)
+
+    def _fill(self, slot, response):
+        slot[2] = response
+        if not self.connected:
+            return  # the client left before its response was ready
+        while self._responses and self._responses[0][2] is not None:
+            version, keep_alive, (code, ctype, body) = \
+                self._responses.popleft()
+            lines = ['%s %s %s' % (version, code, REASONS[code]),
+                     'Content-Type: ' + ctype,
+                     'Content-Length: %d' % len(body)]
+            if not keep_alive:
+                lines.append('Connection: close')
+            elif version != 'HTTP/1.1':
+                lines.append('Connection: keep-alive')
+            self.push('\r\n'.join(lines) + '\r\n\r\n' + body)
+            if not keep_alive:
+                self._responses.clear()
+                self.close_when_done()
+                return
+        return
+
+    def handle_error(self):
+        self.server.error_count += 1
+        asynchat.async_chat.handle_error(self)  # logs and closes
+
+
+class IngestServer(asyncore.dispatcher):
+    """Serves imports to *data_store*, one record per POST to *path*, and
+    JSON Lines batches of them to *batch_path*. *prepare_record* takes
+    a record's JSON and returns the record to write, or raises an
+    exception with the *code* and *detail* of the error response, like
+    clastic's BadRequest. Compressed bodies, on either path, are
+    decoded first, as by the app's RequestDataMiddleware.
+    *max_body_size* caps bodies as sent, and *max_decoded_size* once
+    decoded.
+
+    Responses acknowledge the record's env_id, if it has one, as the
+    app's do, so *prepare_record* should only leave env_ids whose
+    environment it stored."""
+    def __init__(self, address, data_store, prepare_record,
+                 path=DEFAULT_PATH, batch_path=DEFAULT_BATCH_PATH,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 max_body_size=DEFAULT_MAX_BODY_SIZE,
+                 max_decoded_size=DEFAULT_MAX_DECODED_SIZE):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.data_store = data_store
+        self.prepare_record = prepare_record
+        self.path = path
+        self.batch_path = batch_path
+        self.keepalive_timeout = float(keepalive_timeout)
+        self.max_body_size = int(max_body_size)
+        self.max_decoded_size = int(max_decoded_size)
+        self.request_count = 0
+        self.error_count = 0
+
+        self._add_record_async = getattr(data_store, 'add_record_async',
+                                         None)
+        if self._add_record_async is None:
+            writer = BatchWriter(data_store, max_batch_size=1)
+            self._add_record_async = writer.add_record_async
+        self._trigger = _Trigger(self.map)
+        self._stopping = threading.Event()
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(LISTEN_BACKLOG)
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, _ = pair
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        IngestChannel(self, sock)
+
+    def write_record(self, record, channel, slot):
+        ack = {'success': True}
+        if ENV_ID_KEY in record:
+            ack[ENV_ID_KEY] = record[ENV_ID_KEY]
+        self._write(ack, [record], channel, slot)
+
+    def write_records(self, records, channel, slot):
+        ack = {'success': True, 'record_count': len(records)}
+        self._write(ack, records, channel, slot)
+
+    def _write(self, ack, records, channel, slot):
+        self.request_count += 1
+        unqueued = deque(records)
+        state = {'unacked': len(records), 'error': None}
+
+        def queue_more():
+            while unqueued:
+                try:
+                    self._add_record_async(unqueued[0], on_ack)
+                except Queue.Full:
+                    return  # retried as queued records are acked
+                unqueued.popleft()
+
+        def on_ack(error):
+            # called on the writer thread, handled on the loop thread
+            self._trigger.call_soon(handle_ack, error)
+
+        def handle_ack(error):
+            if state['error'] is None:
+                state['error'] = error
+            state['unacked'] -= 1
+            if unqueued:
+                queue_more()
+            if state['unacked']:
+                return
+            if state['error'] is not None:
+                response = _render_error(500, repr(state['error']))
+            else:
+                response = _render_json(ack)
+            channel._fill(slot, response)
+
+        queue_more()
+        if len(unqueued) == len(records):
+            channel._fill(slot, _render_error(503, 'too many writes pending,'
+                                              ' try again later'))
+
+    def _close_idle(self):
+        cutoff = time.time() - self.keepalive_timeout
+        for channel in self.map.values():
+            if isinstance(channel, IngestChannel) \
+                    and channel.last_active < cutoff \
+                    and not channel._responses:
+                channel.close()
+
+    def serve_forever(self):
+        # poll() isn't limited to FD_SETSIZE (1024) connections, as
+        # select() is
+        last_sweep = time.time()
+        while not self._stopping.is_set():
+            asyncore.loop(timeout=POLL_INTERVAL, use_poll=True,
+                          map=self.map, count=1)
+            if time.time() - last_sweep > POLL_INTERVAL:
+                self._close_idle()
+                last_sweep = time.time()
+        for dispatcher in self.map.values():
+            dispatcher.close()
+
+    def shutdown(self):
+        "Stop serve_forever(), from another thread."
+        self._stopping.set()
+        self._trigger.call_soon(lambda: None)  # wake the loop
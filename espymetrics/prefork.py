@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Pre-forked serving, to spread requests across cores.
+
+The parent process opens the store for writing, binds the listening
+socket, and forks worker processes, which all accept connections from
+that socket. Each worker opens its own read-only view of the store
+(see read_only in dal/line_dal.py) and serves reads from it.
+
+Writes are funneled to the parent, the store's single writer, over a
+Unix socket. Only one process ever appends to the store or saves its
+index, counters, and manifest, so lines from different workers can't
+interleave, and readers in the workers pick up each write as a whole
+line. The parent batches writes with a BatchWriter, and a worker's
+import is acknowledged once the parent has written it, per the
+durability mode.
+
+Workers are forked by a supervisor process, which the parent forks
+before it starts any threads, as forking a threaded process isn't
+safe. The supervisor stays single-threaded, so when a worker exits, it
+forks a replacement. Workers which exit soon after starting are
+replaced after a delay, so a worker which can't start doesn't turn
+into a fork loop. The parent waits for the store's background threads,
+like segment compression, to finish before forking the supervisor.
+
+Workers and the supervisor ignore SIGINT. When the parent gets SIGINT
+or SIGTERM, it stops the supervisor with SIGTERM, which stops the
+workers in turn. If the supervisor exits on its own, the parent stops.
+"""
+
+import os
+import time
+import errno
+import shutil
+import signal
+import tempfile
+import threading
+from multiprocessing.connection import Listener, Client
+
+from werkzeug.serving import make_server
+
+LISTEN_BACKLOG = 64
+MIN_WORKER_LIFETIME = 1.0  # seconds, workers exiting sooner are replaced
+RESPAWN_DELAY = 1.0  # seconds later
+
+
+class WriteServer(object):
+    """Serves add_record() and add_records() calls from RemoteWriters,
+    one thread per connection."""
+    def __init__(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix='espymetrics-')
+        self.address = os.path.join(self._tmp_dir, 'writer.sock')
+        self.authkey = os.urandom(16)
+        self._listener = Listener(self.address, family='AF_UNIX',
+                                  backlog=LISTEN_BACKLOG,
+                                  authkey=self.authkey)
+        self.data_store = None
+        self._closed = False
+
+    def start(self, data_store):
+        "Start accepting writes for *data_store*, on a background thread."
+        self.data_store = data_store
+        thread = threading.Thread(target=self._accept_forever,
+                                  name='WriteServer')
+        thread.daemon = True
+        thread.start()
+
+    def _accept_forever(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                if self._closed:
+                    return
+                continue  # e.g., a failed authentication
+            thread = threading.Thread(target=self._serve, args=(conn,),
+                                      name='WriteServer-conn')
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        try:
+            while True:
+                name, arg = conn.recv()
+                error = None
+                try:
+                    getattr(self.data_store, name)(arg)
+                except Exception as e:
+                    # not every exception can be pickled
+                    error = RuntimeError('%s: %s'
+                                         % (e.__class__.__name__, e))
+                conn.send(error)
+        except (EOFError, IOError):
+            pass  # the worker closed the connection or exited
+        finally:
+            conn.close()
+
+    def close_listener(self):
+        self._closed = True
+        self._listener.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+class RemoteWriter(object):
+    """Wraps a read-only data store, sending its writes to the
+    WriteServer at *address*. Each thread gets its own connection."""
+
+    def __init__(self, data_store, address, authkey):
+        self.data_store = data_store
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        # reads and other DAL attributes go straight to the DAL
+        return getattr(self.data_store, name)
+
+    def _call(self, name, arg):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = Client(self.address, family='AF_UNIX',
+                                             authkey=self.authkey)
+        conn.send((name, arg))
+        error = conn.recv()
+        if error is not None:
+            raise error
+        return
+
+    def add_record(self, indict):
+        self._call('add_record', indict)
+
+    def add_records(self, records):
+        self._call('add_records', list(records))
+
+    def flush(self):
+        pass  # the writer flushes, per its durability mode
+
+
+def serve_prefork(host, port, worker_count, data_store, create_worker_app,
+                  wrap_writer=None):
+    """Serves on *host* and *port* from *worker_count* forked workers,
+    until interrupted. *data_store* is the writable store, and is
+    closed on exit. In each worker, *create_worker_app* is called with
+    a function that wraps a read-only store in a RemoteWriter, and
+    returns the WSGI application to serve. The writes received are
+    passed to *wrap_writer(data_store)*, if set, e.g., a BatchWriter.
+    """
+    server = make_server(host, port, None, threaded=True)
+    write_server = WriteServer()
+    data_store.flush()  # so no buffered writes are copied into workers
+    wait_for_compression = getattr(data_store, 'wait_for_compression', None)
+    if wait_for_compression is not None:
+        wait_for_compression()  # no threads may run when forking
+
+    supervisor_pid = os.fork()
+    if not supervisor_pid:
+        _run_supervisor(server, write_server, create_worker_app,
+                        worker_count)
+    server.socket.close()
+
+    if wrap_writer is not None:
+        data_store = wrap_writer(data_store)
+    write_server.start(data_store)
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print(' * Serving on http://%s:%s/ from %s workers'
+          % (host, port, worker_count))
+    try:
+        while not stopping:
+            try:
+                os.waitpid(supervisor_pid, 0)
+            except OSError as ose:
+                if ose.errno == errno.EINTR:
+                    continue
+                raise
+            supervisor_pid = None
+            print(' * Worker supervisor exited, stopping')
+            break
+    finally:
+        if supervisor_pid is not None:
+            try:
+                os.kill(supervisor_pid, signal.SIGTERM)
+                os.waitpid(supervisor_pid, 0)
+            except OSError:
+                pass
+        write_server.close_listener()
+        data_store.close()
+    return
+
+
+def _run_supervisor(server, write_server, create_worker_app, worker_count):
+    # never returns. keeps *worker_count* workers running until it
+    # gets SIGTERM, then stops them.
+    status = 1
+    started = {}  # pid: start time
+    try:
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(signum)
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, stop)
+        while not stopping:
+            while len(started) < worker_count and not stopping:
+                pid = os.fork()
+                if not pid:
+                    _run_worker(server, write_server, create_worker_app)
+                started[pid] = time.time()
+            try:
+                pid, _ = os.wait()
+            except OSError as ose:
+                if ose.errno == errno.EINTR:
+                    continue
+                raise
+            start_time = started.pop(pid, None)
+            if start_time is None or stopping:
+                continue
+            print(' * Worker %s exited, starting a new one' % pid)
+            if time.time() - start_time < MIN_WORKER_LIFETIME:
+                time.sleep(RESPAWN_DELAY)
+        status = 0
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    finally:
+        for pid in started:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in started:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        os._exit(status)
+
+
+def _run_worker(server, write_server, create_worker_app):
+    # never returns. os._exit() skips cleanup inherited from the
+    # parent, like flushing its copy of the store's file buffers.
+    status = 1
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        address, authkey = write_server.address, write_server.authkey
+
+        def wrap_store(read_store):
+            return RemoteWriter(read_store, address, authkey)
+
+        server.app = create_worker_app(wrap_store)
+        server.serve_forever()
+        status = 0
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    finally:
+        os._exit(status)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Benchmark what the espymetrics client adds to importing an
+instrumented package, as in `python -c "import pkg"`.
+
+The instrumented package collects with get_all_info() and sends from
+a thread, with send_import_analytics(in_process=True), on import, to a
+local server. It is timed with the host facts cache cold (removed
+before each run) and warm, against an uninstrumented package.
+Packages which defer the work with deferred.defer_import_analytics()
+are timed too, at exit and on a thread, with the cache warm.
+
+Reported are the time taken by the import itself, and the wall time
+of the whole program, which includes any work done at exit.
+
+Usage: python tools/bench_collect_import.py [--runs N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'espymetrics', 'client')
+
+PKG_TMPLS = {'sync': 'import collect\n'
+                     'collect.send_import_analytics(port=%(port)d,'
+                     ' in_process=True)\n',
+             'exit': 'import deferred\n'
+                     'deferred.defer_import_analytics(port=%(port)d)\n',
+             'thread': 'import deferred\n'
+                       'deferred.defer_import_analytics(port=%(port)d,'
+                       ' when="thread")\n'}
+# (mode, package, cache)
+MODES = [('baseline', 'plain_pkg', 'warm'),
+         ('cold', 'sync_pkg', 'cold'),
+         ('warm', 'sync_pkg', 'warm'),
+         ('exit', 'exit_pkg', 'warm'),
+         ('thread', 'thread_pkg', 'warm')]
+PROGRAM_TMPL = ('import sys, time; start = time.time(); import %s; '
+                'sys.stderr.write("import %%f\\n" %% (time.time() - start))')
+
+
+def serve(sock):
+    while True:
+        conn, _ = sock.accept()
+        conn.recv(65536)
+        conn.sendall(b'HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n')
+        conn.close()
+
+
+def make_pkg(pkg_dir, name, source):
+    os.mkdir(os.path.join(pkg_dir, name))
+    with open(os.path.join(pkg_dir, name, '__init__.py'), 'w') as f:
+        f.write(source)
+
+
+def run_import(name, env):
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', PROGRAM_TMPL % name],
+                            env=env, stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    wall = time.time() - start
+    import_time = [float(line.split()[1]) for line in stderr.splitlines()
+                   if line.startswith(b'import ')]
+    return import_time[0], wall
+
+
+def main():
+    prs = argparse.ArgumentParser()
+    prs.add_argument('--runs', type=int, default=20)
+    args = prs.parse_args()
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    server = threading.Thread(target=serve, args=(sock,))
+    server.daemon = True
+    server.start()
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_collect_import-')
+    try:
+        make_pkg(tmp_dir, 'plain_pkg', '')
+        for name, tmpl in PKG_TMPLS.items():
+            make_pkg(tmp_dir, name + '_pkg',
+                     tmpl % {'port': sock.getsockname()[1]})
+        env = dict(os.environ, HOME=tmp_dir,
+                   PYTHONPATH=os.pathsep.join([tmp_dir, CLIENT_DIR]))
+        facts_path = os.path.join(tmp_dir, '.espymetrics_facts.json')
+        # compile and cache the modules' bytecode before timing
+        for name in PKG_TMPLS:
+            run_import(name + '_pkg', env)
+
+        baseline = None
+        for mode, name, cache in MODES:
+            import_times, walls = [], []
+            for _ in range(args.runs):
+                if cache == 'cold' and os.path.exists(facts_path):
+                    os.remove(facts_path)
+                import_time, wall = run_import(name, env)
+                import_times.append(import_time)
+                walls.append(wall)
+            import_time = sum(import_times) / len(import_times) * 1000
+            wall = sum(walls) / len(walls) * 1000
+            if baseline is None:
+                baseline = (import_time, wall)
+            print('%-10s %5.1fms import (+%5.1fms), %6.1fms program'
+                  ' (+%5.1fms)' % (mode, import_time,
+                                   import_time - baseline[0],
+                                   wall, wall - baseline[1]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Benchmark ColumnarDAL group-by counts over a large number of records.
+
+Usage: python tools/bench_columnar_dal.py [--records N]
+"""
+
+import os
+import sys
+import copy
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'espymetrics', 'dal'))
+
+import columnar_dal
+from common import MESSAGE_PROTO
+from columnar_dal import ColumnarDAL
+
+
+BATCH_SIZE = 10000
+USERNAMES = ['user%d' % i for i in range(100)]
+GROUP_BYS = ['username', 'python$is_64bit', 'python$version_info$0']
+
+
+def make_batch(size):
+    ret = []
+    for _ in range(size):
+        record = copy.deepcopy(MESSAGE_PROTO)
+        record['username'] = random.choice(USERNAMES)
+        record['python']['is_64bit'] = random.random() < 0.9
+        record['python']['version_info'][0] = random.choice([2, 3])
+        ret.append(record)
+    return ret
+
+
+def main():
+    prs = argparse.ArgumentParser()
+    prs.add_argument('--records', type=int, default=1000000)
+    args = prs.parse_args()
+
+    print('numpy: %s' % ('yes' if columnar_dal.numpy else 'no'))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dal = ColumnarDAL(os.path.join(tmp_dir, 'bench.cols'), MESSAGE_PROTO)
+        batch = make_batch(BATCH_SIZE)
+        start = time.time()
+        for _ in range(args.records // BATCH_SIZE):
+            dal.add_records(batch)
+        print('loaded %d records in %.2fs'
+              % (dal.total_count, time.time() - start))
+
+        for group_by in GROUP_BYS:
+            for limit in (None, 1000):
+                start = time.time()
+                res = dal.select_records(limit=limit, group_by=group_by)
+                print('group_by=%s limit=%s: %d keys in %.1fms'
+                      % (group_by, limit, res['grouped_key_count'],
+                         (time.time() - start) * 1000))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Benchmark storing records with an env_id in place of their host
+environment (see dal/environments.py), against storing them in full.
+
+Reported are the bytes per record sent, plain and gzipped, and stored
+by the LineDAL, then the time to count all records by a path inside
+the environment, which deduplicated records look up in the
+environment table, and by one outside it, with each JSON backend.
+
+Usage: python tools/bench_environments.py [--records N] [--envs N]
+"""
+
+import os
+import sys
+import copy
+import time
+import uuid
+import zlib
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'espymetrics', 'dal'))
+
+import jsoncodec
+from common import MESSAGE_PROTO
+from line_dal import LineDAL
+from environments import split_environment, expand_record, ENV_ID_KEY
+
+
+BATCH_SIZE = 1000
+USERNAMES = ['user%d' % i for i in range(100)]
+GROUP_BYS = ('linux_dist$name', 'username')
+
+
+def make_envs(count):
+    ret = []
+    for i in range(count):
+        env, _ = split_environment(MESSAGE_PROTO)
+        env = copy.deepcopy(env)
+        env['uname']['node'] = 'host%d' % i
+        env['linux_dist']['name'] = random.choice(['Ubuntu', 'CentOS'])
+        ret.append(env)
+    return ret
+
+
+def make_record(env):
+    _, record = split_environment(MESSAGE_PROTO)
+    record = copy.deepcopy(record)
+    record['username'] = random.choice(USERNAMES)
+    record['uuid'] = str(uuid.uuid4())
+    record['python']['argv'] = 'job.py --run %d' % random.randint(0, 9999)
+    return expand_record(record, copy.deepcopy(env))
+
+
+def gzip_size(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return len(compressor.compress(data) + compressor.flush())
+
+
+def to_stored(record, environments):
+    # as the app's prepare_import_record() stores a full record
+    env, rest = split_environment(record)
+    rest[ENV_ID_KEY] = environments.add(env)
+    return jsoncodec.EncodedRecord(dict(record, env_id=rest[ENV_ID_KEY]),
+                                   jsoncodec.dumps(rest))
+
+
+def main():
+    prs = argparse.ArgumentParser()
+    prs.add_argument('--records', type=int, default=200000)
+    prs.add_argument('--envs', type=int, default=20)
+    args = prs.parse_args()
+
+    envs = make_envs(args.envs)
+    batch = [make_record(random.choice(envs)) for _ in range(BATCH_SIZE)]
+    full_bodies = [jsoncodec.dumps(r) for r in batch]
+    short_bodies = []
+    for record in batch:
+        env, rest = split_environment(record)
+        rest[ENV_ID_KEY] = 'x' * 20
+        short_bodies.append(jsoncodec.dumps(rest))
+    for name, bodies in (('full', full_bodies), ('env_id', short_bodies)):
+        print('sent, %-7s %5d bytes/record, %4d gzipped'
+              % (name, sum(map(len, bodies)) / len(bodies),
+                 sum(map(gzip_size, bodies)) / len(bodies)))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        paths = {}
+        for name in ('full', 'env_id'):
+            file_path = paths[name] = os.path.join(tmp_dir, name + '.jsonl')
+            dal = LineDAL(file_path)
+            if name == 'env_id':
+                stored = [to_stored(r, dal.environments) for r in batch]
+            else:
+                stored = batch
+            for _ in range(args.records // BATCH_SIZE):
+                dal.add_records(stored)
+            dal.close()
+            size = os.path.getsize(file_path)
+            print('stored, %-6s %5d bytes/record, %.1fMB in all'
+                  % (name, size / dal.total_count, size / 1e6))
+
+        for backend in jsoncodec.get_available_backends():
+            jsoncodec.set_backend(backend)
+            for group_by in GROUP_BYS:
+                results = []
+                for name in ('full', 'env_id'):
+                    dal = LineDAL(paths[name], scan_processes=1)
+                    start = time.time()
+                    results.append(dal.select_records(group_by=group_by))
+                    print('%-10s %-16s %-6s %.2fs'
+                          % (backend, group_by, name, time.time() - start))
+                    dal.close()
+                assert results[0] == results[1]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Benchmark unlimited LineDAL group-by counts with a growing number of
+scan processes.
+
+Usage: python tools/bench_parallel_scan.py [--records N] [--max-processes N]
+"""
+
+import os
+import sys
+import copy
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'espymetrics', 'dal'))
+
+from common import MESSAGE_PROTO
+from line_dal import LineDAL
+
+
+BATCH_SIZE = 1000
+USERNAMES = ['user%d' % i for i in range(100)]
+GROUP_BY = 'username'
+
+
+def make_batch(size):
+    ret = []
+    for _ in range(size):
+        record = copy.deepcopy(MESSAGE_PROTO)
+        record['username'] = random.choice(USERNAMES)
+        ret.append(record)
+    return ret
+
+
+def main():
+    prs = argparse.ArgumentParser()
+    prs.add_argument('--records', type=int, default=500000)
+    prs.add_argument('--max-processes', type=int,
+                     default=multiprocessing.cpu_count())
+    args = prs.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    file_path = os.path.join(tmp_dir, 'bench.jsonl')
+    try:
+        dal = LineDAL(file_path)
+        batch = make_batch(BATCH_SIZE)
+        for _ in range(args.records // BATCH_SIZE):
+            dal.add_records(batch)
+        dal.close()
+        print('%d records, %.1fMB' % (dal.total_count,
+                                      os.path.getsize(file_path) / 1e6))
+
+        processes = 1
+        while processes <= args.max_processes:
+            dal = LineDAL(file_path, scan_processes=processes)
+            start = time.time()
+            dal.select_records(group_by=GROUP_BY)
+            print('%2d processes: %.2fs' % (processes, time.time() - start))
+            dal.close()
+            processes *= 2
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the overhead socklusion adds to an instrumented program,
+sending from a child process (send_data()) versus from a background
+thread (send_data_async()).
+
+Each mode runs a short program that imports socklusion, sends one
+message to a local server, and exits. Reported are the wall time of
+the whole program, compared to one that sends nothing, and its peak
+memory. send_data() also starts a second interpreter, whose peak
+memory is measured separately.
+
+Usage: python tools/bench_socklusion.py [--runs N]
+"""
+
+import os
+import sys
+import time
+import socket
+import resource
+import argparse
+import threading
+import subprocess
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'espymetrics', 'client')
+
+PROGRAM_TMPL = '''
+import sys, resource
+sys.path.insert(0, %(client_dir)r)
+import socklusion
+msg = 'POST / HTTP/1.0\\r\\nContent-Length: 2\\r\\n\\r\\n{}'
+%(send)s
+sys.stderr.write('rss %%d\\n'
+                 %% resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+SENDS = [('baseline', 'pass'),
+         ('subprocess', 'socklusion.send_data(msg, "127.0.0.1", %(port)d)'),
+         ('thread', 'socklusion.send_data_async(msg, "127.0.0.1", %(port)d)')]
+
+
+def serve(sock, received):
+    while True:
+        conn, _ = sock.accept()
+        data = conn.recv(4096)
+        conn.sendall('HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n')
+        conn.close()
+        if data:
+            received.append(time.time())
+
+
+def run_program(program):
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', program],
+                            stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    wall = time.time() - start
+    rss = [int(line.split()[1]) for line in stderr.splitlines()
+           if line.startswith('rss ')]
+    return wall, rss[0] if rss else 0
+
+
+def measure_child_rss(port, msg):
+    # must run before any other child process, as only the peak RSS
+    # of all waited-for children is available
+    proc = subprocess.Popen([sys.executable,
+                             os.path.join(CLIENT_DIR, 'socklusion.py'),
+                             '--child', '--host', '127.0.0.1',
+                             '--port', str(port)], stdin=subprocess.PIPE)
+    proc.communicate(msg)
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def main():
+    prs = argparse.ArgumentParser()
+    prs.add_argument('--runs', type=int, default=20)
+    args = prs.parse_args()
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    port = sock.getsockname()[1]
+    received = []
+    server = threading.Thread(target=serve, args=(sock, received))
+    server.daemon = True
+    server.start()
+
+    child_rss = measure_child_rss(port, 'POST / HTTP/1.0\r\n\r\n')
+    print('send_data() child interpreter: %.1fMB peak RSS'
+          % (child_rss / 1024.0))
+    baseline = None
+    for name, send in SENDS:
+        program = PROGRAM_TMPL % {'client_dir': CLIENT_DIR,
+                                  'send': send % {'port': port}}
+        del received[:]
+        walls, rsses = [], []
+        for _ in range(args.runs):
+            wall, rss = run_program(program)
+            walls.append(wall)
+            rsses.append(rss)
+        time.sleep(0.5)  # let child processes finish sending
+        wall = sum(walls) / len(walls) * 1000
+        if baseline is None:
+            baseline = wall
+        print('%-10s %6.1fms per program (+%5.1fms), %5.1fMB peak RSS,'
+              ' %d sends received'
+              % (name, wall, wall - baseline, max(rsses) / 1024.0,
+                 len(received)))
+
+
+if __name__ == '__main__':
+    main()
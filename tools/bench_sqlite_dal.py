@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Benchmark SQLiteDAL writes, alone and alongside concurrent readers.
+
+Usage: python tools/bench_sqlite_dal.py [--records N] [--readers N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'espymetrics', 'dal'))
+
+from common import MESSAGE_PROTO
+from sqlite_dal import SQLiteDAL
+
+
+TABLE_NAME = 'on_import_data'
+
+
+def bench_writes(dal, record_count):
+    start = time.time()
+    for _ in range(record_count):
+        dal.add_record(MESSAGE_PROTO)
+    return time.time() - start
+
+
+def bench_mixed(dal, record_count, reader_count):
+    query = 'SELECT COUNT(*) FROM %s' % TABLE_NAME
+    stop = threading.Event()
+    stats = {'queries': 0, 'errors': 0}
+
+    def read():
+        while not stop.is_set():
+            try:
+                dal.raw_query(query)
+            except Exception:
+                stats['errors'] += 1
+            else:
+                stats['queries'] += 1
+
+    readers = [threading.Thread(target=read) for _ in range(reader_count)]
+    for reader in readers:
+        reader.start()
+    write_errors = 0
+    start = time.time()
+    for _ in range(record_count):
+        try:
+            dal.add_record(MESSAGE_PROTO)
+        except Exception:
+            write_errors += 1
+    duration = time.time() - start
+    stop.set()
+    for reader in readers:
+        reader.join()
+    return duration, stats['queries'], stats['errors'], write_errors
+
+
+def main():
+    prs = argparse.ArgumentParser()
+    prs.add_argument('--records', type=int, default=2000)
+    prs.add_argument('--readers', type=int, default=4)
+    args = prs.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dal = SQLiteDAL(os.path.join(tmp_dir, 'bench.db'),
+                        TABLE_NAME, MESSAGE_PROTO)
+        duration = bench_writes(dal, args.records)
+        print('writes only: %d records in %.3fs (%.0f records/s)'
+              % (args.records, duration, args.records / duration))
+
+        res = bench_mixed(dal, args.records, args.readers)
+        duration, query_count, read_errors, write_errors = res
+        print('with %d readers: %d records in %.3fs (%.0f records/s),'
+              ' %d queries (%.0f queries/s), %d read errors,'
+              ' %d write errors'
+              % (args.readers, args.records, duration,
+                 args.records / duration, query_count,
+                 query_count / duration, read_errors, write_errors))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""Benchmark posting many records to a local stand-in server: one
+connection per record, as socklusion sends them, versus a persistent
+connection (transport.PersistentConnection), without and with
+pipelining. Each is run over plain TCP and over TLS.
+
+The stand-in server is a threaded HTTP/1.1 server which keeps
+connections alive and answers every POST with a small JSON body, like
+/v1/on_import. TLS uses a throwaway self-signed certificate, made with
+the openssl command, and is skipped if that isn't available.
+
+Over loopback, round trips are nearly free. To see the cost of the
+round trips each mode waits on, --rtt puts a relay in front of the
+server which delays the data in each direction by half the given
+round-trip time, in milliseconds.
+
+Usage: python tools/bench_transport.py [--records N] [--rtt MS]
+"""
+
+import os
+import sys
+import time
+import ssl
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import deque
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'espymetrics', 'client'))
+import collect
+import transport
+import socklusion
+
+RESPONSE = (b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: application/json; charset=utf-8\r\n'
+            b'Content-Length: 24\r\n\r\n'
+            b'{\n  "success": true\n}\n\n\n')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.wfile.write(RESPONSE)  # in one write, to not wait on Nagle
+
+    def log_message(self, *a):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    ssl_context = None
+
+    def get_request(self):
+        sock, addr = HTTPServer.get_request(self)
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        return sock, addr
+
+    def shutdown_request(self, request):
+        if self.ssl_context is not None:
+            try:
+                request = request.unwrap()  # sends TLS close_notify
+            except (socket.error, ValueError):
+                pass
+        HTTPServer.shutdown_request(self, request)
+
+    def handle_error(self, request, client_address):
+        pass  # e.g., clients closing TLS connections without close_notify
+
+
+def start_server(ssl_context=None):
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    server.ssl_context = ssl_context
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address[1]
+
+
+def _pump(src, dst, delay):
+    # forwards from *src* to *dst*, each chunk *delay* seconds after
+    # it arrived, without holding up the chunks behind it
+    chunks = deque()
+    ready = threading.Condition()
+
+    def send():
+        while True:
+            with ready:
+                while not chunks:
+                    ready.wait()
+                due, data = chunks.popleft()
+            time.sleep(max(0, due - time.time()))
+            try:
+                if not data:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+            except socket.error:
+                return  # the other end is gone
+
+    sender = threading.Thread(target=send)
+    sender.daemon = True
+    sender.start()
+    while True:
+        try:
+            data = src.recv(65536)
+        except socket.error:
+            data = b''
+        with ready:
+            chunks.append((time.time() + delay, data))
+            ready.notify()
+        if not data:
+            return
+
+
+def start_relay(port, rtt):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+
+    def relay():
+        while True:
+            client, _ = sock.accept()
+            upstream = socket.create_connection(('127.0.0.1', port))
+            for conn in (client, upstream):
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for src, dst in ((client, upstream), (upstream, client)):
+                thread = threading.Thread(target=_pump,
+                                          args=(src, dst, rtt / 2.0))
+                thread.daemon = True
+                thread.start()
+
+    thread = threading.Thread(target=relay)
+    thread.daemon = True
+    thread.start()
+    return sock.getsockname()[1]
+
+
+def make_ssl_context(tmp_dir):
+    cert_path = os.path.join(tmp_dir, 'cert.pem')
+    key_path = os.path.join(tmp_dir, 'key.pem')
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey',
+                               'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=localhost',
+                               '-keyout', key_path, '-out', cert_path],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER',
+                                     ssl.PROTOCOL_SSLv23))
+    context.load_cert_chain(cert_path, key_path)
+    return context
+
+
+def send_per_connection(port, wrap_ssl, bodies):
+    for body in bodies:
+        msg = collect.build_post_message(body, host='127.0.0.1')
+        socklusion.send_data_child(msg, '127.0.0.1', port=port,
+                                   wrap_ssl=wrap_ssl, want_response=True,
+                                   response_stream=_NullStream())
+    return ''
+
+
+def send_persistent(port, wrap_ssl, bodies, max_pipeline):
+    conn = transport.PersistentConnection('127.0.0.1', port,
+                                          wrap_ssl=wrap_ssl,
+                                          max_pipeline=max_pipeline)
+    with conn:
+        # in batches, as a batch job might send them, reconnecting for
+        # each to show TLS session resumption
+        batch_size = 100
+        for i in range(0, len(bodies), batch_size):
+            responses = conn.post_many('/v1/on_import',
+                                       bodies[i:i + batch_size])
+            assert all(status == 200 for status, _ in responses)
+            conn.close()
+    return '%d connections, %d TLS resumptions' % (conn.connect_count,
+                                                   conn.tls_resume_count)
+
+
+class _NullStream(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def main():
+    prs = argparse.ArgumentParser()
+    prs.add_argument('--records', type=int, default=2000)
+    prs.add_argument('--rtt', type=float, default=0.0,
+                     help='simulated round-trip time, in milliseconds')
+    args = prs.parse_args()
+
+    record = collect.get_json_lib().dumps(
+        collect.get_all_info(facts_path=None))
+    bodies = [record] * args.records
+    modes = [('per-connection', send_per_connection, {}),
+             ('keep-alive', send_persistent, {'max_pipeline': 1}),
+             ('pipelined', send_persistent, {'max_pipeline': 32})]
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_transport-')
+    try:
+        ports = [('tcp', start_server(), False)]
+        ssl_context = make_ssl_context(tmp_dir)
+        if ssl_context is None:
+            print('openssl not found, skipping TLS')
+        else:
+            ports.append(('tls', start_server(ssl_context), True))
+        if args.rtt:
+            ports = [(name, start_relay(port, args.rtt / 1000.0), wrap_ssl)
+                     for name, port, wrap_ssl in ports]
+        for transport_name, port, wrap_ssl in ports:
+            for name, send, kwargs in modes:
+                if send is send_per_connection and wrap_ssl \
+                        and not hasattr(ssl, 'wrap_socket'):
+                    print('%-3s %-15s skipped, socklusion needs'
+                          ' ssl.wrap_socket()' % (transport_name, name))
+                    continue
+                start = time.time()
+                note = send(port, wrap_ssl, bodies, **kwargs)
+                duration = time.time() - start
+                print('%-3s %-15s %7.0f records/s  %s'
+                      % (transport_name, name, len(bodies) / duration,
+                         note))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()